@@ -1,25 +1,20 @@
-import dotenv
-import pandas as pd
 import streamlit as st
-from waii_sdk_py import WAII
-from waii_sdk_py.chat import ChatRequest
 
 # Define constants
 ENV = st.secrets["ENV"]
-WAII_API_KEY = st.secrets[ENV]["WAII_API_KEY"]
-WAII_API_URL = st.secrets[ENV]["WAII_API_URL"]
-SNOWFLAKE_WAREHOUSE = st.secrets[ENV]["SNOWFLAKE_WAREHOUSE"]
-SNOWFLAKE_DATABASE = st.secrets[ENV]["SNOWFLAKE_DATABASE"]
-SNOWFLAKE_ACCOUNT = st.secrets[ENV]["SNOWFLAKE_ACCOUNT"]
-SNOWFLAKE_USER = st.secrets[ENV]["SNOWFLAKE_USER"]
+ANSWER_POLL_SECONDS = 0.5
 
 # Configure page
 st.set_page_config(page_title="Chat with Otto", page_icon="🎱")
 
+from assets import asset_url
 from auth_functions import user_logged_in
-from ui_utils import render_message, render_sidebar_tips, render_placeholder_image, render_auth_form, render_account_panel
+from auth_ui import render_account_panel, render_auth_form, render_unknown_tenant
+from instrumentation import admin_requested, render_metrics_page, set_tenant, start_metrics_server, traced
 
-st.logo("virsec_logo.svg")
+start_metrics_server()
+
+st.logo(asset_url("virsec_logo.svg"))
 st.title("Meet OTTO")
 
 # Initialize user state
@@ -28,22 +23,34 @@ if "user_info" not in st.session_state:
 
 
 def update_user_info():
-    st.session_state.user_domain = st.session_state.user_info["users"][0]["email"].split("@")[1].lower()
-    st.session_state.tenant_name = st.secrets[ENV]["TENANTS_BY_DOMAIN"][st.session_state.user_domain]["NAME"]
-    st.session_state.tenant_id = st.secrets[ENV]["TENANTS_BY_DOMAIN"][st.session_state.user_domain]["TENANT_ID"]
-    st.session_state.tenant_role = st.secrets[ENV]["TENANTS_BY_DOMAIN"][st.session_state.user_domain]["ROLE"]
+    # The tenant is resolved once per session from the prebuilt index, and again only when the user
+    # or the tenant configuration (the secrets file) changes; returns False for an unknown domain
+    email = st.session_state.user_info["users"][0]["email"]
+    tenant_index = get_tenant_index()
+    if st.session_state.get("tenant_resolved_for") != (tenant_index.version, email):
+        tenant = tenant_index.resolve(email)
+        if tenant is None:
+            return False
+        st.session_state.tenant = tenant
+        st.session_state.tenant_resolved_for = (tenant_index.version, email)
+        st.session_state.user_id = st.session_state.user_info["users"][0]["localId"]
+        st.session_state.user_domain = email.rpartition("@")[2].lower()
+        st.session_state.tenant_name = tenant.name
+        st.session_state.tenant_id = tenant.tenant_id
+        st.session_state.tenant_role = tenant.role
+    return True
 
 
+@traced("app.initialize_waii")
 def initialize_waii():
-    waii_db_connection = f"snowflake://{SNOWFLAKE_USER}@{SNOWFLAKE_ACCOUNT}/{SNOWFLAKE_DATABASE}?role={st.session_state.tenant_role}&warehouse={SNOWFLAKE_WAREHOUSE}"
-    print(waii_db_connection)
-    WAII.initialize(url=WAII_API_URL, api_key=WAII_API_KEY)
-    WAII.Database.activate_connection(waii_db_connection)
+    # Clients are created and activated once per tenant role and shared through the registry
+    st.session_state.waii = get_waii_client(st.session_state.tenant_role)
+    get_suggested_answers().register(st.session_state.tenant_id, st.session_state.tenant_role)
 
 
 def initialize_message_state():
     if "messages" not in st.session_state:
-        st.session_state.messages = []
+        restore_conversation()
 
     if "prev_response_uuid" not in st.session_state:
         st.session_state.prev_response_uuid = None
@@ -51,41 +58,202 @@ def initialize_message_state():
     if "pending_prompt" not in st.session_state:
         st.session_state.pending_prompt = None
 
+    if "pending_answer" not in st.session_state:
+        st.session_state.pending_answer = None
+
+    if "question_chain" not in st.session_state:
+        st.session_state.question_chain = []
+
+
+def restore_conversation():
+    # A new session (reload, reconnect, signing in again) continues the stored conversation: the last
+    # turns are loaded with their results and charts, and follow-ups continue Waii's conversation
+    store = get_conversation_store()
+    messages, earlier = store.load(st.session_state.user_id, st.session_state.tenant_id, CONVERSATION_WINDOW_TURNS * 2)
+    st.session_state.messages = messages
+    st.session_state.earlier_messages = earlier
+    st.session_state.history_window = CONVERSATION_WINDOW_TURNS * 2
+    st.session_state.prev_response_uuid, st.session_state.question_chain = store.load_state(
+        st.session_state.user_id, st.session_state.tenant_id
+    )
+    for message in messages:
+        if message.get("data") is not None:
+            get_session_result_store().add(message["data"])
+
+
+def load_earlier_messages():
+    # "Load earlier": the page of stored messages before the oldest one shown
+    before_id = next((message["stored_id"] for message in st.session_state.messages if "stored_id" in message), None)
+    messages, earlier = get_conversation_store().load(
+        st.session_state.user_id, st.session_state.tenant_id, CONVERSATION_WINDOW_TURNS * 2, before_id
+    )
+    for message in messages:
+        if message.get("data") is not None:
+            get_session_result_store().add(message["data"])
+    st.session_state.messages[:0] = messages
+    st.session_state.earlier_messages = earlier
+    st.session_state.history_window += len(messages)
+
 
+def save_conversation():
+    get_conversation_store().sync(
+        st.session_state.user_id,
+        st.session_state.tenant_id,
+        st.session_state.messages,
+        st.session_state.prev_response_uuid,
+        st.session_state.question_chain,
+    )
+
+
+def trim_conversation():
+    # Only the window stays in the session (and is rendered); older messages, already stored, give
+    # back their results and come back through "Load earlier"
+    messages = st.session_state.messages
+    dropped = 0
+    while len(messages) - dropped > st.session_state.history_window and "stored_id" in messages[dropped]:
+        if messages[dropped].get("data") is not None:
+            get_session_result_store().discard(messages[dropped]["data"])
+            forget_exports(messages[dropped]["data"])
+        dropped += 1
+    del messages[:dropped]
+    st.session_state.earlier_messages += dropped
+
+
+@traced("app.ask")
 def ask(question):
+    # A precomputed or cached answer is shown straight away; otherwise the question goes to the chat
+    # job queue and the script finishes, leaving the page usable while render_pending_answer() polls for it
     user_message = {"name": "user", "text": question}
     render_message(user_message, persist=True)
-    response = WAII.Chat.chat_message(ChatRequest(ask=question, parent_uuid=st.session_state.prev_response_uuid))
-    st.session_state.prev_response_uuid = response.chat_uuid
-    ai_message = {
-        "name": "Otto",
-        "text": response.response,
-        "sql": response.response_data.query.query if response.response_data.query else None,
-        "data": pd.DataFrame(response.response_data.data.rows) if response.response_data.data else None,
-        "chart": response.response_data.chart.chart_spec.plot if response.response_data.chart else None,
-    }
-    render_message(ai_message, persist=True)
-
-
-if not user_logged_in():
+    # Suggested questions stand on their own, so their answers are served whatever came before
+    suggested = get_suggested_answers().get(st.session_state.tenant_id, st.session_state.tenant_role, question)
+    if suggested is not None:
+        ai_message, chat_uuid = suggested
+        render_message(ai_message, persist=False)
+        # Follow-ups continue the suggested answer's own Waii conversation, which starts at this question
+        st.session_state.question_chain = []
+        add_answer(question, ai_message, chat_uuid)
+        return
+    answer_cache = get_answer_cache()
+    cache_key = question_cache_key(
+        st.session_state.tenant_id, st.session_state.tenant_role, question, st.session_state.question_chain
+    )
+    cached_answer = answer_cache.get(cache_key)
+    if cached_answer is not None:
+        ai_message = message_from_cache(cached_answer)
+        render_message(ai_message, persist=False)
+        answer_cache.remember_render(cache_key, ai_message.get("render_cache"))
+        add_answer(question, ai_message, cached_answer["chat_uuid"] or st.session_state.prev_response_uuid)
+        return
+    request = ChatRequest(
+        ask=question,
+        parent_uuid=st.session_state.prev_response_uuid,
+        additional_context=chat_context(st.session_state.messages),
+    )
+    try:
+        job = get_chat_job_queue().submit(
+            cache_key,
+            st.session_state.waii,
+            request,
+            on_complete=lambda job: answer_cache.put(cache_key, job.message(), job.chat_uuid),
+            refine_from=refinement_parent(st.session_state.messages),
+        )
+    except RuntimeError as e:
+        render_message({"name": "Otto", "text": str(e)}, persist=True)
+        return
+    st.session_state.pending_answer = {"job": job, "question": question, "message": {"name": "Otto", "text": ""}}
+    render_pending_answer()
+
+
+def add_answer(question, ai_message, chat_uuid):
+    # Follow-ups continue from the answer's Waii conversation (for a cached answer, one that asked the
+    # same chain); an answer refined locally has none and keeps the conversation it refined
+    st.session_state.prev_response_uuid = chat_uuid
+    st.session_state.question_chain.append(normalize_question(question))
+    st.session_state.messages.append(ai_message)
+    if ai_message.get("data") is not None:
+        get_session_result_store().add(ai_message["data"])
+
+
+def collect_pending_answer():
+    # Moves a finished background answer into the conversation
+    pending = st.session_state.pending_answer
+    if pending is None or not pending["job"].done:
+        return
+    st.session_state.pending_answer = None
+    job = pending["job"]
+    if job.status == COMPLETED:
+        ai_message = job.message()
+        add_answer(pending["question"], ai_message, job.chat_uuid or st.session_state.prev_response_uuid)
+    else:
+        ai_message = {"name": "Otto", "text": f"Sorry, I couldn't answer that: {job.error}"}
+        st.session_state.messages.append(ai_message)
+
+
+@st.fragment(run_every=ANSWER_POLL_SECONDS)
+def render_pending_answer():
+    # Only this fragment reruns while Waii works; the whole page reruns once the answer is in
+    pending = st.session_state.pending_answer
+    if pending is None:
+        return
+    job = pending["job"]
+    chat_job_queue = get_chat_job_queue()
+    if job.done:
+        st.rerun()
+    if render_chat_job(job, pending["message"], chat_job_queue.position(job)):
+        chat_job_queue.cancel(job)
+        st.session_state.pending_answer = None
+        st.session_state.messages.append({"name": "Otto", "text": "Question cancelled."})
+        st.rerun()
+
+
+if admin_requested():
+    render_metrics_page()
+elif not user_logged_in():
     render_auth_form()
 else:
-    update_user_info()
-    render_sidebar_tips()
+    # The chat's dependencies (pandas, pyarrow, plotly via ui_utils, the Waii SDK) are imported the
+    # first time a logged-in user reaches this point, not on the login page; later runs hit sys.modules
+    from waii_sdk_py.chat import ChatRequest
+
+    from chat_jobs import COMPLETED, get_chat_job_queue
+    from conversation_store import CONVERSATION_WINDOW_TURNS, get_conversation_store
+    from local_refinement import chat_context, refinement_parent
+    from result_cache import get_answer_cache, message_from_cache, normalize_question, question_cache_key
+    from result_store import get_session_result_store
+    from suggested_answers import get_suggested_answers
+    from tenants import get_tenant_index
+    from ui_utils import forget_exports, render_chat_job, render_message, render_placeholder_image, render_sidebar_tips
+    from waii_functions import get_waii_client
+
+    if not update_user_info():
+        render_unknown_tenant()
+        st.stop()
+    set_tenant(st.session_state.tenant_id)
+    render_sidebar_tips(disabled=bool(st.session_state.get("pending_prompt") or st.session_state.get("pending_answer")))
     render_account_panel()
     initialize_waii()
     initialize_message_state()
+    collect_pending_answer()
+    save_conversation()
+    trim_conversation()
 
     # If no messages exist, render placeholder image
     if not st.session_state.messages and not st.session_state.pending_prompt:
         render_placeholder_image()
 
-    # Render pre-existing messages
+    if st.session_state.earlier_messages:
+        st.button(f"Load earlier messages ({st.session_state.earlier_messages})", key="load-earlier", on_click=load_earlier_messages)
+
+    # Render pre-existing messages; the answer being worked on shows its step, SQL and rows in
+    # render_pending_answer() as Waii sends them, and is drawn here once it is complete
     for message in st.session_state.messages:
         render_message(message, persist=False)
 
-    # If a question is asked, save it to session state and rerun to flush the placeholder image
-    if prompt := st.chat_input("Ask me anything..."):
+    # If a question is asked, save it to session state and rerun to flush the placeholder image.
+    # One question at a time: a follow-up needs the answer it follows
+    waiting = bool(st.session_state.pending_prompt or st.session_state.pending_answer)
+    if prompt := st.chat_input("Ask me anything...", disabled=waiting):
         st.session_state.pending_prompt = prompt
         st.rerun()
 
@@ -94,3 +262,8 @@ else:
         prompt = st.session_state.pending_prompt
         st.session_state.pending_prompt = None
         ask(prompt)
+    elif st.session_state.pending_answer:
+        render_pending_answer()
+
+    # Stores what this run added: a cached answer, charts drawn for the first time
+    save_conversation()
@@ -0,0 +1,112 @@
+import base64
+import mimetypes
+import os
+import threading
+import time
+from pathlib import Path
+
+import streamlit as st
+
+from instrumentation import get_metrics_registry
+
+## -------------------------------------------------------------------------------------------------
+## Static assets -----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+ASSET_DIR = Path(__file__).resolve().parent / "static"
+STATIC_URL_PREFIX = "/app/static/"
+# In development, edited assets are picked up by comparing mtimes on each use
+RELOAD_ASSETS = st.secrets[ENV].get("RELOAD_ASSETS", False)
+
+
+def style_svg(style):
+    return lambda svg: svg.replace(b"<svg", f'<svg style="{style}"'.encode())
+
+
+class AssetRegistry:
+    def __init__(self, directory=ASSET_DIR, reload=RELOAD_ASSETS, static_serving=None):
+        self.directory = Path(directory)
+        self.reload = reload
+        self.static_serving = st.get_option("server.enableStaticServing") if static_serving is None else static_serving
+        self.transforms = {}
+        self.assets = {}
+        self.reads = 0
+        self.stats = 0
+        self.encodes = 0
+        self.load_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def register(self, name, filename=None, transform=None):
+        # Variants of one file (e.g. an SVG with inline styles) are registered under their own name
+        self.transforms[name] = (filename or name, transform)
+        return self
+
+    def preload(self):
+        for name in self.transforms:
+            self.get(name)
+        return self
+
+    def get(self, name):
+        filename, transform = self.transforms.setdefault(name, (name, None))
+        path = self.directory / filename
+        with self.lock:
+            asset = self.assets.get(name)
+            if asset is not None and self.reload:
+                self.stats += 1
+                if os.stat(path).st_mtime_ns != asset["mtime"]:
+                    asset = None
+            if asset is None:
+                asset = self.assets[name] = self._load(path, transform)
+            return asset
+
+    def _load(self, path, transform):
+        started = time.perf_counter()
+        content = path.read_bytes()
+        self.reads += 1
+        if transform is not None:
+            content = transform(content)
+        mime_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+        self.load_seconds += time.perf_counter() - started
+        return {"content": content, "mime_type": mime_type, "mtime": os.stat(path).st_mtime_ns, "data_uri": None}
+
+    def content(self, name):
+        return self.get(name)["content"]
+
+    def text(self, name):
+        return self.get(name)["content"].decode()
+
+    def data_uri(self, name):
+        asset = self.get(name)
+        if asset["data_uri"] is None:
+            self.encodes += 1
+            asset["data_uri"] = "data:{0};base64,{1}".format(asset["mime_type"], base64.b64encode(asset["content"]).decode())
+        return asset["data_uri"]
+
+    def url(self, name):
+        # Untransformed files are served by Streamlit's static file endpoint when it is enabled,
+        # so the browser fetches (and caches) them once instead of receiving them in every delta
+        filename, transform = self.transforms.setdefault(name, (name, None))
+        if self.static_serving and transform is None:
+            return STATIC_URL_PREFIX + filename
+        return self.data_uri(name)
+
+    def io_counts(self):
+        with self.lock:
+            return {"reads": self.reads, "stats": self.stats, "encodes": self.encodes, "load_seconds": self.load_seconds}
+
+
+@st.cache_resource
+def get_asset_registry():
+    registry = AssetRegistry()
+    registry.register("bot-small.svg")
+    registry.register("bot_avatar.svg")
+    registry.register("otto_avatar.png")
+    registry.register("virsec_logo.svg")
+    registry.register("bot-placeholder.svg", "bot.svg", style_svg("width: 70%; height: auto; object-fit: contain;"))
+    get_metrics_registry().register_collector("assets", registry.io_counts)
+    return registry.preload()
+
+
+def asset_url(name):
+    return get_asset_registry().url(name)
@@ -1,7 +1,13 @@
+import asyncio
 import json
+import threading
+import time
+
 import requests
 import streamlit as st
 
+from instrumentation import get_metrics_registry, traced
+
 # USE_COOKIES = False
 
 
@@ -11,72 +17,180 @@ import streamlit as st
 
 ENV = st.secrets["ENV"]
 FIREBASE_WEB_API_KEY = st.secrets[ENV]["FIREBASE_WEB_API_KEY"]
+FIREBASE_PROJECT_ID = st.secrets[ENV].get("FIREBASE_PROJECT_ID")
+IDENTITY_TOOLKIT_URL = st.secrets[ENV].get(
+    "IDENTITY_TOOLKIT_URL", "https://www.googleapis.com/identitytoolkit/v3/relyingparty"
+)
+FIREBASE_CERTS_URL = st.secrets[ENV].get(
+    "FIREBASE_CERTS_URL", "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+)
+ACCOUNT_INFO_TTL_SECONDS = 300
+
+
+AUTH_API_TIMEOUT_SECONDS = 10
+AUTH_API_MAX_RETRIES = 3
+AUTH_API_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.time() - self.opened_at >= self.reset_seconds else "open"
+
+    def check(self):
+        # While open, fail fast instead of tying up a Streamlit worker on a struggling upstream
+        with self.lock:
+            if self.state == "open":
+                raise CircuitOpenError("Identity Toolkit circuit is open, try again later")
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.time()
+
+
+class AuthApiClient:
+    def __init__(
+        self,
+        base_url,
+        api_key,
+        timeout=AUTH_API_TIMEOUT_SECONDS,
+        max_retries=AUTH_API_MAX_RETRIES,
+        backoff_seconds=0.25,
+        pool_size=20,
+        circuit_breaker=None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.session = requests.Session()
+        self.session.headers["content-type"] = "application/json; charset=UTF-8"
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.retries = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def post(self, action, payload, timeout=None, retry_server_errors=True):
+        self.circuit_breaker.check()
+        request_ref = "{0}/{1}?key={2}".format(self.base_url, action, self.api_key)
+        # Calls that send email or create accounts are only retried when the upstream rejected them outright
+        retry_statuses = AUTH_API_RETRY_STATUSES if retry_server_errors else {429}
+        for attempt in range(self.max_retries + 1):
+            try:
+                request_object = self.session.post(request_ref, json=payload, timeout=timeout or self.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt == self.max_retries or not retry_server_errors:
+                    self._record_failure()
+                    raise
+                delay = self.backoff_seconds * 2**attempt
+            else:
+                if request_object.status_code not in retry_statuses or attempt == self.max_retries:
+                    break
+                delay = retry_after(request_object, self.backoff_seconds * 2**attempt)
+            with self.lock:
+                self.retries += 1
+            time.sleep(delay)
+
+        if request_object.status_code >= 500 or request_object.status_code == 429:
+            self._record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        raise_detailed_error(request_object)
+        return request_object.json()
 
+    def get(self, url, timeout=None):
+        return self.session.get(url, timeout=timeout or self.timeout)
 
-def sign_in_with_email_and_password(email, password):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/verifyPassword?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"email": email, "password": password, "returnSecureToken": True})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
+    def _record_failure(self):
+        with self.lock:
+            self.failures += 1
+        self.circuit_breaker.record_failure()
 
+    def metrics(self):
+        pool_manager = self.session.get_adapter(self.base_url).poolmanager
+        pools = [pool_manager.pools[key] for key in pool_manager.pools.keys()]
+        requests_sent = sum(pool.num_requests for pool in pools)
+        connections_opened = sum(pool.num_connections for pool in pools)
+        return {
+            "requests": requests_sent,
+            "connections_opened": connections_opened,
+            "pool_hits": requests_sent - connections_opened,
+            "retries": self.retries,
+            "failures": self.failures,
+            "circuit_state": self.circuit_breaker.state,
+        }
 
-def get_account_info(id_token):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getAccountInfo?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"idToken": id_token})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
 
+def retry_after(request_object, default):
+    value = request_object.headers.get("retry-after", "")
+    return min(float(value), 30.0) if value.replace(".", "", 1).isdigit() else default
 
-def send_email_verification(id_token):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"requestType": "VERIFY_EMAIL", "idToken": id_token})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
 
+@st.cache_resource
+def get_auth_api_client():
+    client = AuthApiClient(IDENTITY_TOOLKIT_URL, FIREBASE_WEB_API_KEY)
+    get_metrics_registry().register_collector("auth_api", client.metrics)
+    return client
 
-def send_password_reset_email(email):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/getOobConfirmationCode?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"requestType": "PASSWORD_RESET", "email": email})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
 
+@traced("auth.sign_in_with_email_and_password")
+def sign_in_with_email_and_password(email, password, timeout=None):
+    data = {"email": email, "password": password, "returnSecureToken": True}
+    return get_auth_api_client().post("verifyPassword", data, timeout=timeout)
 
-def create_user_with_email_and_password(email, password):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/signupNewUser?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"email": email, "password": password, "returnSecureToken": True})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
 
+@traced("auth.get_account_info")
+def get_account_info(id_token, timeout=None):
+    data = {"idToken": id_token}
+    return get_auth_api_client().post("getAccountInfo", data, timeout=timeout)
+
+
+@traced("auth.send_email_verification")
+def send_email_verification(id_token, timeout=None):
+    data = {"requestType": "VERIFY_EMAIL", "idToken": id_token}
+    return get_auth_api_client().post("getOobConfirmationCode", data, timeout=timeout, retry_server_errors=False)
 
-def delete_user_account(id_token):
-    request_ref = "https://www.googleapis.com/identitytoolkit/v3/relyingparty/deleteAccount?key={0}".format(
-        FIREBASE_WEB_API_KEY
-    )
-    headers = {"content-type": "application/json; charset=UTF-8"}
-    data = json.dumps({"idToken": id_token})
-    request_object = requests.post(request_ref, headers=headers, data=data)
-    raise_detailed_error(request_object)
-    return request_object.json()
+
+@traced("auth.send_password_reset_email")
+def send_password_reset_email(email, timeout=None):
+    data = {"requestType": "PASSWORD_RESET", "email": email}
+    return get_auth_api_client().post("getOobConfirmationCode", data, timeout=timeout, retry_server_errors=False)
+
+
+@traced("auth.create_user_with_email_and_password")
+def create_user_with_email_and_password(email, password, timeout=None):
+    data = {"email": email, "password": password, "returnSecureToken": True}
+    return get_auth_api_client().post("signupNewUser", data, timeout=timeout, retry_server_errors=False)
+
+
+@traced("auth.delete_user_account")
+def delete_user_account(id_token, timeout=None):
+    data = {"idToken": id_token}
+    return get_auth_api_client().post("deleteAccount", data, timeout=timeout)
 
 
 def raise_detailed_error(request_object):
@@ -86,6 +200,180 @@ def raise_detailed_error(request_object):
         raise requests.exceptions.HTTPError(error, request_object.text)
 
 
+## -------------------------------------------------------------------------------------------------
+## Token verification ------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+
+class PublicKeyCache:
+    def __init__(self, certs_url, client, default_max_age=3600, min_refresh_interval=60):
+        self.certs_url = certs_url
+        self.client = client
+        self.default_max_age = default_max_age
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = {}
+        self.fetched_at = 0.0
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, key_id):
+        with self.lock:
+            # Refresh when the certs expire or an unknown key id shows up (Google rotates keys),
+            # but do not let tokens with bogus key ids trigger a fetch on every rerun
+            now = time.time()
+            if now >= self.expires_at or (key_id not in self.keys and now - self.fetched_at >= self.min_refresh_interval):
+                self._refresh()
+            if key_id not in self.keys:
+                import jwt
+
+                raise jwt.InvalidTokenError("Unknown key id: {0}".format(key_id))
+            return self.keys[key_id]
+
+    def _refresh(self):
+        from cryptography.x509 import load_pem_x509_certificate
+
+        request_object = self.client.get(self.certs_url)
+        raise_detailed_error(request_object)
+        self.keys = {
+            key_id: load_pem_x509_certificate(cert.encode()).public_key()
+            for key_id, cert in request_object.json().items()
+        }
+        self.fetched_at = time.time()
+        self.expires_at = time.time() + parse_max_age(request_object.headers.get("cache-control"), self.default_max_age)
+
+
+class AccountInfoCache:
+    def __init__(self, ttl_seconds=ACCOUNT_INFO_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, id_token):
+        with self.lock:
+            entry = self.entries.get(id_token)
+            if entry is None:
+                return None
+            expires_at, account_info = entry
+            if time.time() >= expires_at:
+                del self.entries[id_token]
+                return None
+            return account_info
+
+    def put(self, id_token, account_info, token_expires_at=None):
+        expires_at = time.time() + self.ttl_seconds
+        if token_expires_at is not None:
+            expires_at = min(expires_at, token_expires_at)
+        with self.lock:
+            # Drop expired entries so tokens of users who never sign out do not pile up
+            now = time.time()
+            for stale_token in [token for token, (expiry, _) in self.entries.items() if expiry <= now]:
+                del self.entries[stale_token]
+            self.entries[id_token] = (expires_at, account_info)
+
+    def forget(self, id_token):
+        with self.lock:
+            self.entries.pop(id_token, None)
+
+
+def parse_max_age(cache_control, default):
+    for directive in (cache_control or "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            return int(value)
+    return default
+
+
+@st.cache_resource
+def get_public_key_cache():
+    return PublicKeyCache(FIREBASE_CERTS_URL, get_auth_api_client())
+
+
+@st.cache_resource
+def get_account_info_cache():
+    return AccountInfoCache()
+
+
+@traced("auth.verify_id_token")
+def verify_id_token(id_token):
+    # Check signature, expiry, audience and issuer locally instead of asking the Identity Toolkit.
+    # PyJWT and cryptography are imported here, off the login page's import path
+    import jwt
+
+    key_id = jwt.get_unverified_header(id_token).get("kid")
+    return jwt.decode(
+        id_token,
+        get_public_key_cache().get(key_id),
+        algorithms=["RS256"],
+        audience=FIREBASE_PROJECT_ID,
+        issuer="https://securetoken.google.com/{0}".format(FIREBASE_PROJECT_ID),
+        options={"require": ["exp", "iat", "aud", "iss", "sub"]},
+    )
+
+
+def get_cached_account_info(id_token, token_expires_at=None):
+    cache = get_account_info_cache()
+    account_info = cache.get(id_token)
+    if account_info is None:
+        account_info = get_account_info(id_token)
+        cache.put(id_token, account_info, token_expires_at)
+    return account_info
+
+
+## -------------------------------------------------------------------------------------------------
+## Async auth flows --------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+
+async def run_blocking(function, *args):
+    # The pooled client is blocking, so each call gets its own worker thread and the flows below
+    # only wait where one call needs another's output
+    return await asyncio.to_thread(function, *args)
+
+
+async def sign_in_async(email, password):
+    id_token = (await run_blocking(sign_in_with_email_and_password, email, password))["idToken"]
+
+    # Account info only needs the token, so fetch it while the token is checked locally
+    account_info_task = asyncio.ensure_future(run_blocking(get_account_info, id_token))
+    try:
+        email_verified, token_expires_at = None, None
+        if FIREBASE_PROJECT_ID:
+            claims = await run_blocking(verify_id_token, id_token)
+            email_verified, token_expires_at = claims.get("email_verified"), claims["exp"]
+        if email_verified is None:
+            email_verified = (await account_info_task)["users"][0]["emailVerified"]
+
+        # The verification email can go out without waiting for account info
+        if not email_verified:
+            await asyncio.gather(account_info_task, run_blocking(send_email_verification, id_token))
+
+        account_info = await account_info_task
+    finally:
+        # A rejected token (or any other failure) leaves the fetch unwanted: cancel it, and collect
+        # its outcome so a failed fetch is not reported as a never-retrieved exception
+        if not account_info_task.done():
+            account_info_task.cancel()
+        await asyncio.gather(account_info_task, return_exceptions=True)
+
+    # Seed the cache so user_logged_in() after the rerun does not fetch account info again
+    get_account_info_cache().put(id_token, account_info, token_expires_at)
+    return id_token, account_info, email_verified
+
+
+async def delete_account_async(email, password, current_id_token=None):
+    # Deleting needs a fresh token, so the two calls are inherently serial
+    id_token = (await run_blocking(sign_in_with_email_and_password, email, password))["idToken"]
+    await run_blocking(delete_user_account, id_token)
+    for token in (id_token, current_id_token):
+        if token:
+            get_account_info_cache().forget(token)
+
+
+def run_sync(coroutine):
+    # Streamlit scripts run on a thread without an event loop, so each flow gets a short-lived one
+    return asyncio.run(coroutine)
+
+
 ## -------------------------------------------------------------------------------------------------
 ## Authentication functions ------------------------------------------------------------------------
 ## -------------------------------------------------------------------------------------------------
@@ -93,8 +381,8 @@ def raise_detailed_error(request_object):
 
 def sign_in(email: str, password: str) -> None:
     try:
-        # Attempt to sign in with email and password
-        id_token = sign_in_with_email_and_password(email, password)["idToken"]
+        # Attempt to sign in with email and password, fetching account information alongside
+        id_token, user_info, email_verified = run_sync(sign_in_async(email, password))
         st.session_state.id_token = id_token
 
         # if USE_COOKIES:
@@ -105,12 +393,8 @@ def sign_in(email: str, password: str) -> None:
         # cookies["id_token"] = id_token
         # pass
 
-        # Get account information
-        user_info = get_account_info(id_token)["users"][0]
-
-        # If email is not verified, send verification email and do not sign in
-        if not user_info["emailVerified"]:
-            send_email_verification(id_token)
+        # If email is not verified, the verification email has been sent, so do not sign in
+        if not email_verified:
             st.session_state.auth_warning = "Check your email to verify your account"
 
         # Save user info to session state and rerun
@@ -171,20 +455,23 @@ def reset_password(email: str) -> None:
 
 
 def sign_out() -> None:
-    if USE_COOKIES:
-        # cookies["id_token"] = ""
-        pass
+    # if USE_COOKIES:
+    # cookies["id_token"] = ""
+    if "id_token" in st.session_state:
+        get_account_info_cache().forget(st.session_state.id_token)
     st.session_state.clear()
     st.session_state.auth_success = "You have successfully signed out"
 
 
 def delete_account(password: str) -> None:
     try:
-        # Confirm email and password by signing in (and save id_token)
-        id_token = sign_in_with_email_and_password(st.session_state.user_info["email"], password)["idToken"]
+        # Confirm email and password by signing in, then attempt to delete account
+        email = st.session_state.user_info["users"][0]["email"]
+        run_sync(delete_account_async(email, password, st.session_state.get("id_token")))
+        # The stored conversations go with the account
+        from conversation_store import get_conversation_store
 
-        # Attempt to delete account
-        delete_user_account(id_token)
+        get_conversation_store().delete_user(st.session_state.user_info["users"][0]["localId"])
         st.session_state.clear()
         st.session_state.auth_success = "You have successfully deleted your account"
 
@@ -206,7 +493,9 @@ def user_logged_in():
         # st.session_state.id_token = cookies["id_token"]
         else:
             return False
-        retrieved_user_info = get_account_info(st.session_state.id_token)
+        # Without a project id the token cannot be checked locally, so fall back to the TTL alone
+        token_expires_at = verify_id_token(id_token)["exp"] if FIREBASE_PROJECT_ID else None
+        retrieved_user_info = get_cached_account_info(id_token, token_expires_at)
         if retrieved_user_info:
             st.session_state.user_info = retrieved_user_info
             return (
@@ -0,0 +1,50 @@
+import streamlit as st
+
+from auth_functions import sign_in, create_account, sign_out, reset_password
+
+## -------------------------------------------------------------------------------------------------
+## Login page --------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+# Kept apart from ui_utils so the login page does not import plotly, pandas or the Waii SDK
+
+
+def render_auth_form():
+    auth_form = st.form("auth_form")
+    email = auth_form.text_input("Email")
+    password = auth_form.text_input("Password", type="password")
+    sign_in_button = auth_form.form_submit_button("Sign In", width="stretch")
+    sign_up_button = auth_form.form_submit_button("Sign Up", width="stretch")
+    password_reset_button = auth_form.form_submit_button("Forgot Password?", width="stretch")
+
+    if sign_in_button:
+        sign_in(email, password)
+
+    if sign_up_button:
+        create_account(email, password)
+
+    if password_reset_button:
+        reset_password(email)
+
+    if "auth_success" in st.session_state:
+        auth_form.success(st.session_state.auth_success)
+    if "auth_warning" in st.session_state:
+        auth_form.warning(st.session_state.auth_warning)
+
+
+def render_account_panel():
+    with st.sidebar.container(border=True, height=160):
+        if "user_info" in st.session_state:
+            st.markdown(
+                f"User: `{st.session_state.user_info['users'][0]['email']}`\n\nAccount: `{st.session_state.tenant_name}`"
+            )
+        if st.button("Sign Out", width="stretch"):
+            sign_out()
+            st.rerun()
+
+
+def render_unknown_tenant():
+    st.error("Your email domain is not set up for Otto yet. Please contact your administrator.")
+    if st.button("Sign Out"):
+        sign_out()
+        st.rerun()
@@ -0,0 +1,76 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from benchmarks.support import offline_secrets, use_secrets
+
+# Asset registry startup time, and files opened per rerun by the sidebar, placeholder and chat
+# avatars (counted with an audit hook, so Streamlit's own reads of avatar paths are included)
+
+ASSET_OPENS = []
+
+
+def count_asset_opens(event, args):
+    if event == "open" and isinstance(args[0], str) and args[0].endswith((".svg", ".png")):
+        ASSET_OPENS.append(args[0])
+
+
+def assets_script():
+    import streamlit as st
+    from ui_utils import render_message, render_placeholder_image, render_sidebar_tips
+
+    render_sidebar_tips()
+    render_placeholder_image()
+    for index in range(st.session_state.bench_messages):
+        render_message({"name": "Otto" if index % 2 else "User", "text": "Message {0}".format(index)}, persist=False)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--reruns", type=int, default=10)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    use_secrets(offline_secrets())
+    sys.addaudithook(count_asset_opens)
+    from assets import get_asset_registry
+
+    start = time.perf_counter()
+    registry = get_asset_registry()
+    startup_ms = (time.perf_counter() - start) * 1000
+    print("startup: {0:.2f} ms ({1:.2f} ms reading and transforming), {2}".format(startup_ms, registry.load_seconds * 1000, registry.io_counts()))
+
+    app = AppTest.from_function(assets_script, default_timeout=60)
+    for key, value in offline_secrets().items():
+        app.secrets[key] = value
+    app.session_state.bench_messages = args.messages
+    app.run()
+    assert not app.exception, app.exception
+    before = registry.io_counts()
+    del ASSET_OPENS[:]
+    timings = []
+    for _ in range(args.reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    after = registry.io_counts()
+    print("per rerun ({0} messages): {1:.1f} ms, {2:.1f} asset file opens, {3:.1f} registry reads, {4:.1f} stats, {5:.1f} encodes".format(
+        args.messages,
+        statistics.median(timings) * 1000,
+        len(ASSET_OPENS) / args.reruns,
+        (after["reads"] - before["reads"]) / args.reruns,
+        (after["stats"] - before["stats"]) / args.reruns,
+        (after["encodes"] - before["encodes"]) / args.reruns,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+from benchmarks.support import use_secrets
+
+# Compares the pooled auth client with one connection per call, then shows retries and the circuit breaker
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeIdentityToolkit(latency=args.latency).start()
+    use_secrets(fake.secrets())
+    import requests
+    from auth_functions import AuthApiClient, CircuitBreaker, CircuitOpenError
+
+    try:
+        fake.add_user("analyst@example.com", "hunter22")
+        id_token = fake.mint_id_token("analyst@example.com")
+
+        timings = []
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            requests.post(fake.relyingparty_url + "/getAccountInfo?key=fake-key", json={"idToken": id_token}, timeout=10)
+            timings.append(time.perf_counter() - start)
+        print("one connection per call: median {0:.2f} ms".format(statistics.median(timings) * 1000))
+
+        client = AuthApiClient(fake.relyingparty_url, "fake-key", backoff_seconds=0.01)
+        timings = []
+        for _ in range(args.calls):
+            start = time.perf_counter()
+            client.post("getAccountInfo", {"idToken": id_token})
+            timings.append(time.perf_counter() - start)
+        print("pooled client:           median {0:.2f} ms".format(statistics.median(timings) * 1000))
+        print("metrics:", client.metrics())
+
+        fake.fail_next(2, status=503)
+        client.post("getAccountInfo", {"idToken": id_token})
+        print("after two injected 503s:", client.metrics())
+
+        client = AuthApiClient(
+            fake.relyingparty_url,
+            "fake-key",
+            max_retries=0,
+            circuit_breaker=CircuitBreaker(failure_threshold=3, reset_seconds=60),
+        )
+        fake.fail_next(3, status=503)
+        for _ in range(4):
+            try:
+                client.post("getAccountInfo", {"idToken": id_token})
+            except CircuitOpenError as error:
+                print("fail fast:", error)
+            except requests.exceptions.HTTPError:
+                pass
+        print("after upstream outage:", client.metrics())
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
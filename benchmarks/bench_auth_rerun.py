@@ -0,0 +1,67 @@
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+
+# Measures the cost of the auth check that runs at the top of every rerun,
+# with the account info cache and with it cleared before each rerun
+
+
+def rerun_script():
+    import streamlit as st
+    from auth_functions import get_account_info_cache, user_logged_in
+
+    if st.session_state.get("bench_clear_cache"):
+        get_account_info_cache().entries.clear()
+    st.session_state.logged_in = user_logged_in()
+
+
+def measure(fake, id_token, reruns, clear_cache):
+    app = AppTest.from_function(rerun_script, default_timeout=30)
+    for key, value in fake.secrets().items():
+        app.secrets[key] = value
+    app.session_state.id_token = id_token
+    app.session_state.bench_clear_cache = clear_cache
+    app.run()
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+        assert app.session_state.logged_in
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reruns", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.1, help="Simulated Identity Toolkit latency in seconds")
+    args = parser.parse_args()
+
+    fake = FakeIdentityToolkit(latency=args.latency).start()
+    try:
+        fake.add_user("analyst@example.com", "hunter22")
+        id_token = fake.mint_id_token("analyst@example.com")
+        for label, clear_cache in (("without cache", True), ("with cache", False)):
+            fake.calls.clear()
+            timings = measure(fake, id_token, args.reruns, clear_cache)
+            print(
+                "{0:>14}: median {1:7.2f} ms, max {2:7.2f} ms, getAccountInfo calls {3}".format(
+                    label,
+                    statistics.median(timings) * 1000,
+                    max(timings) * 1000,
+                    fake.calls["getAccountInfo"],
+                )
+            )
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import offline_secrets, use_secrets
+
+# Time for autoplot to pick and build a chart as row counts grow: the original version (copy,
+# infer_objects, plot every row) against the profiled one, first call and repeat calls on the same result
+
+
+def original_autoplot(px, df_, chart_type="bar"):
+    df = df_.copy().infer_objects()
+    x_col = df.columns[0]
+    y_col = next(col for col in df.columns[1:] if df[col].dtype in ["int64", "float64"])
+    if chart_type == "bar":
+        return px.bar(df, x=x_col, y=y_col)
+    return px.pie(df, values=y_col, names=x_col)
+
+
+def timed(function, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    use_secrets(offline_secrets())
+    import pandas as pd
+    import plotly.express as px
+
+    from result_store import ResultTable
+    from result_views import profile_result, recommend_chart
+    from result_views import autoplot
+
+    fake = FakeWaii()
+    print("{0:>10} {1:>11} {2:>12} {3:>12} {4:>12} {5:>12} {6:>8}".format("rows", "input", "original ms", "first ms", "repeat ms", "profile ms", "chart"))
+    for rows in args.rows:
+        rows_data = fake.make_rows(rows)
+        for name, make in (("DataFrame", lambda: pd.DataFrame(rows_data)[["SEVERITY", "OPEN_DAYS", "CVSS_SCORE"]]), ("ResultTable", lambda: ResultTable.from_rows(rows_data))):
+            data = make()
+            # The original only recognised int64/float64 columns, so it gets the uncompacted frame
+            frame = data if name == "DataFrame" else pd.DataFrame(rows_data)
+            _, original_ms = timed(lambda: original_autoplot(px, frame).to_json())
+            fig, first_ms = timed(lambda: autoplot(data).to_json())
+            _, repeat_ms = timed(lambda: autoplot(data).to_json(), args.repeat)
+            _, profile_ms = timed(lambda: recommend_chart(profile_result(data)), args.repeat)
+            chart = recommend_chart(profile_result(data))["type"]
+            print("{0:>10,} {1:>11} {2:>12.1f} {3:>12.1f} {4:>12.1f} {5:>12.3f} {6:>8}".format(rows, name, original_ms, first_ms, repeat_ms, profile_ms, chart))
+
+
+if __name__ == "__main__":
+    main()
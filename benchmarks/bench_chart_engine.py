@@ -0,0 +1,57 @@
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import CHART_CODE, FakeWaii
+from benchmarks.support import offline_secrets, use_secrets
+
+# Chart latency in the worker processes against exec() on the calling thread, and how long a
+# session is blocked by runaway chart code (a busy loop, a huge allocation) with and without them
+
+RUNAWAY = {
+    "busy loop": "while True:\n    pass",
+    "allocation": "blocks = [bytearray(256 * 1024 * 1024) for _ in range(64)]",
+}
+
+
+def timed(function):
+    start = time.perf_counter()
+    try:
+        function()
+        outcome = "ok"
+    except Exception as error:
+        outcome = type(error).__name__
+    return (time.perf_counter() - start) * 1000, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+
+    use_secrets(offline_secrets())
+    from chart_engine import ChartEngine
+    from result_store import ResultTable
+
+    table = ResultTable.from_rows(FakeWaii().make_rows(args.rows)).table()
+    engine = ChartEngine("#244466", workers=2, timeout=args.timeout, cpu_seconds=int(args.timeout) * 2, memory_bytes=2 * 1024**3)
+    cold_ms, _ = timed(lambda: engine.render(CHART_CODE, table))
+    in_process = [timed(lambda: exec(CHART_CODE.replace("st.plotly_chart(fig, use_container_width=True)", "fig.to_json()"), {"df": table.to_pandas()}))[0] for _ in range(args.repeat)]
+    in_worker = [timed(lambda: engine.render(CHART_CODE, table))[0] for _ in range(args.repeat)]
+    print("{0:,} rows: first chart (worker start-up) {1:.0f} ms".format(args.rows, cold_ms))
+    print("  median in process {0:.1f} ms, in worker {1:.1f} ms".format(statistics.median(in_process), statistics.median(in_worker)))
+    for name, code in RUNAWAY.items():
+        elapsed_ms, outcome = timed(lambda: engine.render(code, table))
+        print("  {0}: session blocked {1:.0f} ms ({2}); on the session thread it would have no limit".format(name, elapsed_ms, outcome))
+    elapsed_ms, outcome = timed(lambda: engine.render(CHART_CODE, table))
+    print("  next chart after the failures: {0:.0f} ms ({1})".format(elapsed_ms, outcome))
+    print(engine.metrics())
+
+
+if __name__ == "__main__":
+    main()
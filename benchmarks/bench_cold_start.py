@@ -0,0 +1,123 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Cold first run of app.py in a fresh interpreter under -X importtime: the login page for a visitor
+# and the chat page for a logged-in user. Streamlit itself is imported before the window opens, so
+# only what the app's own run imports is counted. Exits non-zero when the login page imports one of
+# the chat's heavy dependencies or takes longer than --budget-ms, so regressions are caught
+
+HEAVY_MODULES = ["pandas", "pyarrow", "plotly", "waii_sdk_py", "jwt", "cryptography.x509"]
+START_MARKER = "--- app run start ---"
+END_MARKER = "--- app run end ---"
+
+
+def child(page):
+    from streamlit.testing.v1 import AppTest
+
+    from benchmarks.support import use_secrets
+
+    secrets = {"ENV": "bench", "bench": {}}
+    if page == "chat":
+        from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+        from benchmarks.fake_waii import FakeWaii
+
+        identity_toolkit = FakeIdentityToolkit(latency=0).start()
+        waii = FakeWaii(latency=0, connect_latency=0).start()
+        identity_toolkit.add_user("analyst@acme.com", "password")
+        secrets["bench"].update(identity_toolkit.secrets()["bench"])
+        secrets["bench"].update(waii.secrets()["bench"])
+        secrets["bench"]["TENANTS_BY_DOMAIN"] = {"acme.com": {"NAME": "Acme", "TENANT_ID": "acme", "ROLE": "ACME_ROLE"}}
+    else:
+        secrets["bench"].update({"FIREBASE_WEB_API_KEY": "fake-key"})
+    use_secrets(secrets)
+
+    os.chdir(ROOT)
+    app = AppTest.from_file(str(ROOT / "app.py"), default_timeout=60)
+    for key, value in secrets.items():
+        app.secrets[key] = value
+    if page == "chat":
+        # The connection key is spelled out: building it with waii_functions would import the chat's
+        # modules before the measured run
+        app.session_state.id_token = identity_toolkit.mint_id_token("analyst@acme.com")
+        waii.add_connection("snowflake://bench_user@bench-account/BENCH_DB?role=ACME_ROLE&warehouse=BENCH_WH")
+
+    print(START_MARKER, file=sys.stderr, flush=True)
+    start = time.perf_counter()
+    app.run()
+    elapsed = time.perf_counter() - start
+    print(END_MARKER, file=sys.stderr, flush=True)
+    assert not app.exception, app.exception
+    print("{0:.1f}".format(elapsed * 1000))
+
+
+def parse_importtime(stderr):
+    # Lines look like "import time:  self [us] | cumulative | name", nested imports indented in name
+    imports = []
+    inside = False
+    for line in stderr.splitlines():
+        if line == START_MARKER:
+            inside = True
+        elif line == END_MARKER:
+            inside = False
+        elif inside and line.startswith("import time:") and "|" in line:
+            fields = line.split(":", 1)[1].split("|")
+            if len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            self_us, cumulative_us, name = fields
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            imports.append({"name": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us), "depth": depth})
+    return imports
+
+
+def measure(page):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", str(Path(__file__).resolve()), "--child", page],
+        capture_output=True,
+        text=True,
+        cwd=ROOT,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr[-2000:])
+    imports = parse_importtime(process.stderr)
+    return float(process.stdout.strip().splitlines()[-1]), imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child", choices=["login", "chat"])
+    parser.add_argument("--top", type=int, default=8)
+    parser.add_argument("--budget-ms", type=float, default=1000)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    failures = []
+    for page in ("login", "chat"):
+        run_ms, imports = measure(page)
+        top_level = sorted((entry for entry in imports if entry["depth"] == 0), key=lambda entry: -entry["cumulative_us"])
+        names = {entry["name"] for entry in imports}
+        heavy = [module for module in HEAVY_MODULES if module in names]
+        print("{0}: first run {1:.1f} ms, {2} modules imported in {3:.1f} ms, heavy: {4}".format(
+            page, run_ms, len(imports), sum(entry["self_us"] for entry in imports) / 1000, ", ".join(heavy) or "none"))
+        for entry in top_level[: args.top]:
+            print("  {0:>10.1f} ms  {1}".format(entry["cumulative_us"] / 1000, entry["name"]))
+        if page == "login":
+            if heavy:
+                failures.append("login page imports {0}".format(", ".join(heavy)))
+            if run_ms > args.budget_ms:
+                failures.append("login page first run {0:.1f} ms is over the {1:.0f} ms budget".format(run_ms, args.budget_ms))
+    for failure in failures:
+        print("FAIL:", failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
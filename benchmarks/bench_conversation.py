@@ -0,0 +1,119 @@
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import chat_history, use_secrets
+
+# Rerun time and session memory as a conversation grows: every message kept in the session and
+# rendered (as before), against the stored conversation with only the last turns in the session.
+# Also the time to restore a stored conversation in a new session, and the Waii calls that takes
+
+EMAIL = "analyst@acme.example"
+
+
+def all_messages_script():
+    import streamlit as st
+    from ui_utils import render_message
+
+    for message in st.session_state.messages:
+        render_message(message, persist=False)
+
+
+def session_bytes(messages):
+    # What the session holds per message: results still in memory, cached figures and the text parts
+    total = 0
+    for message in messages:
+        data = message.get("data")
+        if data is not None and getattr(data, "in_memory", True):
+            total += data.nbytes
+        total += len((message.get("render_cache") or {}).get("figure") or "")
+        total += sum(len(message.get(part) or "") for part in ("text", "sql", "chart"))
+    return total
+
+
+def timed_reruns(app, reruns):
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    assert not app.exception, app.exception
+    return statistics.median(timings)
+
+
+def measure_all_messages(messages, reruns):
+    app = AppTest.from_function(all_messages_script, default_timeout=300)
+    app.session_state.messages = messages
+    app.run()
+    return timed_reruns(app, reruns), session_bytes(app.session_state.messages)
+
+
+def measure_stored(identity_toolkit, reruns):
+    app = AppTest.from_file(str(ROOT / "app.py"), default_timeout=300)
+    app.session_state.id_token = identity_toolkit.mint_id_token(EMAIL)
+    start = time.perf_counter()
+    app.run()
+    restore = time.perf_counter() - start
+    assert not app.exception, app.exception
+    return restore, timed_reruns(app, reruns), session_bytes(app.session_state.messages)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 100, 200])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--window", type=int, default=10, help="turns kept in the session")
+    parser.add_argument("--reruns", type=int, default=5)
+    args = parser.parse_args()
+
+    identity_toolkit = FakeIdentityToolkit(latency=0).start()
+    waii = FakeWaii(latency=0).start()
+    identity_toolkit.add_user(EMAIL, "password")
+    user = identity_toolkit.users[EMAIL]
+    secrets = identity_toolkit.secrets()
+    secrets["bench"].update(waii.secrets()["bench"])
+    secrets["bench"]["TENANTS_BY_DOMAIN"] = {"acme.example": {"NAME": "Acme", "TENANT_ID": "acme", "ROLE": "ACME_ROLE"}}
+    secrets["bench"]["CONVERSATION_DB"] = os.path.join(tempfile.mkdtemp(prefix="otto-bench-"), "conversations.sqlite3")
+    secrets["bench"]["CONVERSATION_WINDOW_TURNS"] = args.window
+    secrets["bench"]["CONVERSATION_MAX_MESSAGES"] = 2 * max(args.turns)
+    use_secrets(secrets)
+    os.chdir(ROOT)
+    from conversation_store import get_conversation_store
+    from waii_functions import waii_connection_key
+
+    waii.add_connection(waii_connection_key("ACME_ROLE"))
+    store = get_conversation_store()
+
+    print("{0:>6} | {1:>12} {2:>12} | {3:>12} {4:>12} {5:>10} {6:>12}".format(
+        "turns", "all rerun ms", "all MB", "window ms", "window MB", "restore ms", "waii asks"))
+    for turns in args.turns:
+        messages = chat_history(turns, rows=args.rows)
+        all_rerun, all_bytes = measure_all_messages(messages, args.reruns)
+
+        store.delete_user(user["localId"])
+        store.sync(user["localId"], "acme", messages, None, ["question {0}".format(turn) for turn in range(turns)])
+        asks = len(waii.asks)
+        restore, window_rerun, window_bytes = measure_stored(identity_toolkit, args.reruns)
+        print("{0:>6} | {1:>12.1f} {2:>12.1f} | {3:>12.1f} {4:>12.1f} {5:>10.1f} {6:>12}".format(
+            turns,
+            all_rerun * 1000,
+            all_bytes / 1024 / 1024,
+            window_rerun * 1000,
+            window_bytes / 1024 / 1024,
+            restore * 1000,
+            len(waii.asks) - asks,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import offline_secrets, use_secrets
+
+# Exporting a result: serialized whole in memory (what handing the frame to st.download_button
+# takes), against written batch by batch to the export cache; a repeated download of the same rows
+# (another session's copy of the answer), and the file streamed by the export server
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def rss_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * PAGE_SIZE
+
+
+class PeakMemory:
+    # Highest RSS above the starting point while the block runs, sampled every few milliseconds
+    def __enter__(self):
+        self.start = rss_bytes()
+        self.peak = self.start
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, rss_bytes())
+            time.sleep(0.002)
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, rss_bytes())
+
+    @property
+    def growth_mb(self):
+        return (self.peak - self.start) / 1024 / 1024
+
+
+def in_memory(table, export_format):
+    import io
+
+    df = table.to_pandas()
+    if export_format == "csv":
+        return df.to_csv(index=False).encode()
+    buffer = io.BytesIO()
+    if export_format == "parquet":
+        df.to_parquet(buffer)
+    else:
+        df.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 500_000])
+    parser.add_argument("--formats", nargs="+", default=["csv", "parquet", "xlsx"])
+    parser.add_argument("--skip-in-memory", action="store_true", help="only time the chunked exports")
+    args = parser.parse_args()
+
+    secrets = offline_secrets()
+    secrets["bench"]["EXPORT_DIR"] = tempfile.mkdtemp(prefix="otto-exports-")
+    secrets["bench"]["EXPORT_URL"] = "http://127.0.0.1:0"
+    use_secrets(secrets)
+    from http.server import ThreadingHTTPServer
+
+    import result_exports
+    from result_store import ResultTable
+
+    exports = result_exports.ResultExports(directory=secrets["bench"]["EXPORT_DIR"])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), result_exports.ExportHandler)
+    server.exports = exports
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{0}".format(server.server_address[1])
+
+    print("{0:>9} {1:>8} | {2:>10} {3:>10} | {4:>10} {5:>10} {6:>9} | {7:>10} {8:>12}".format(
+        "rows", "format", "memory ms", "memory MB", "chunked ms", "chunked MB", "file MB", "repeat ms", "served MB/s"))
+    for rows in args.rows:
+        fake = FakeWaii(rows=rows)
+        table = ResultTable.from_rows(fake.make_rows(rows)).table()
+        for export_format in args.formats:
+            memory_ms = memory_mb = float("nan")
+            if not args.skip_in_memory:
+                with PeakMemory() as peak:
+                    start = time.perf_counter()
+                    data = in_memory(table, export_format)
+                    memory_ms = (time.perf_counter() - start) * 1000
+                memory_mb = max(peak.growth_mb, len(data) / 1024 / 1024)
+                del data
+
+            with PeakMemory() as peak:
+                start = time.perf_counter()
+                path = exports.export(ResultTable(table), export_format)
+                chunked_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            assert exports.export(ResultTable(table), export_format) == path
+            repeat_ms = (time.perf_counter() - start) * 1000
+
+            start = time.perf_counter()
+            with urllib.request.urlopen(result_exports.export_link(path, "result." + export_format, base_url=base_url)) as response:
+                served = 0
+                while chunk := response.read(1024 * 1024):
+                    served += len(chunk)
+            served_seconds = time.perf_counter() - start
+            assert served == os.path.getsize(path)
+
+            print("{0:>9,} {1:>8} | {2:>10.0f} {3:>10.1f} | {4:>10.0f} {5:>10.1f} {6:>9.1f} | {7:>10.1f} {8:>12.0f}".format(
+                rows, export_format, memory_ms, memory_mb, chunked_ms, peak.growth_mb, served / 1024 / 1024, repeat_ms,
+                served / 1024 / 1024 / served_seconds))
+    print()
+    print(exports.metrics())
+
+
+if __name__ == "__main__":
+    main()
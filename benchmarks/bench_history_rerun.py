@@ -0,0 +1,62 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from benchmarks.support import chat_history, offline_secrets, use_secrets
+
+# Rerun time as a function of history length, drawing past answers from the render cache
+# and with the cache dropped before every rerun (the chart code runs again for every message)
+
+
+def history_script():
+    import streamlit as st
+    from ui_utils import render_message
+
+    for message in st.session_state.messages:
+        if st.session_state.bench_drop_cache:
+            message.pop("render_cache", None)
+        render_message(message, persist=False)
+
+
+def measure(messages, reruns, drop_cache):
+    app = AppTest.from_function(history_script, default_timeout=120)
+    for key, value in offline_secrets().items():
+        app.secrets[key] = value
+    app.session_state.messages = messages
+    app.session_state.bench_drop_cache = drop_cache
+    app.run()
+    timings = []
+    for _ in range(reruns):
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+    assert not app.exception
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--reruns", type=int, default=5)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    use_secrets(offline_secrets())
+    print("{0:>6} {1:>14} {2:>14}".format("turns", "no cache ms", "cached ms"))
+    for turns in args.turns:
+        messages = chat_history(turns, rows=args.rows)
+        uncached = measure(messages, args.reruns, drop_cache=True)
+        cached = measure(messages, args.reruns, drop_cache=False)
+        print("{0:>6} {1:>14.1f} {2:>14.1f}".format(turns, uncached * 1000, cached * 1000))
+
+
+if __name__ == "__main__":
+    main()
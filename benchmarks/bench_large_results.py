@@ -0,0 +1,65 @@
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import offline_secrets, use_secrets
+
+# Payload sent to the browser and time to draw a result's table and charts as row counts grow,
+# shipping everything versus the large-result mode (paged table, aggregated/downsampled charts)
+
+CHARTS = {
+    "bar": lambda px, df: px.bar(df, x="ASSET", y="CVSS_SCORE", color="SEVERITY"),
+    "pie": lambda px, df: px.pie(df, names="ASSET", values="OPEN_DAYS"),
+    "line": lambda px, df: px.line(df.reset_index(), x="index", y="CVSS_SCORE"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000, 500_000])
+    args = parser.parse_args()
+
+    use_secrets(offline_secrets())
+    import plotly.express as px
+    import pyarrow as pa
+
+    from result_store import ResultTable
+    from result_views import LARGE_RESULT_ROWS, RESULT_PAGE_ROWS, reduce_figure
+
+    def ipc_bytes(table):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().size
+
+    fake = FakeWaii()
+    print("{0:>8} {1:>6} {2:>14} {3:>14} {4:>10} {5:>10}".format("rows", "part", "full KB", "reduced KB", "full ms", "reduced ms"))
+    for rows in args.rows:
+        fake.rows = rows
+        result = ResultTable.from_rows(fake.make_rows(rows))
+        table = result.table()
+        page = table.slice(0, RESULT_PAGE_ROWS) if table.num_rows > LARGE_RESULT_ROWS else table
+        start = time.perf_counter()
+        full_bytes = ipc_bytes(table)
+        full_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        page_bytes = ipc_bytes(page)
+        page_ms = (time.perf_counter() - start) * 1000
+        print("{0:>8,} {1:>6} {2:>14,.0f} {3:>14,.0f} {4:>10.1f} {5:>10.1f}".format(rows, "table", full_bytes / 1024, page_bytes / 1024, full_ms, page_ms))
+
+        df = result.to_pandas()
+        for name, build in CHARTS.items():
+            start = time.perf_counter()
+            full_json = build(px, df).to_json()
+            full_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            reduced_json = reduce_figure(build(px, df)).to_json()
+            reduced_ms = (time.perf_counter() - start) * 1000
+            print("{0:>8,} {1:>6} {2:>14,.0f} {3:>14,.0f} {4:>10.1f} {5:>10.1f}".format(rows, name, len(full_json) / 1024, len(reduced_json) / 1024, full_ms, reduced_ms))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import use_secrets
+
+# Many concurrent sessions driving app.py through AppTest against the local Identity Toolkit and Waii
+# stand-ins: each session opens the login page, signs in through the form, then asks its questions,
+# polls until each answer is in and reruns a few times after it. Reports p50/p95/p99 per step,
+# throughput and RSS per session for each session count. AppTest runs the script like the server
+# does but does not ship deltas over a websocket, so browser transfer is not part of these numbers
+
+PASSWORD = "load-test-password"
+POLL_SECONDS = 0.5
+
+
+def share_server_state():
+    # AppTest installs a mock Runtime for the length of each run and clears it afterwards, which
+    # breaks the runs still going on other threads; keep handing out the last one instead. It also
+    # compiles the script again on every run, where the server keeps one script cache (concurrent
+    # ast.parse calls can fail on Python 3.11). The secrets come from use_secrets() rather than
+    # AppTest.secrets, which swaps st.secrets globally too
+    script_cache = ScriptCache()
+    script_cache.get_bytecode(str(ROOT / "app.py"))
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+    last = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            last[:] = [cls._instance]
+        if not last:
+            raise RuntimeError("Runtime hasn't been created!")
+        return last[0]
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or bool(last))
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_questions(path, field):
+    # One JSON object per line; the question is taken from `field`, or the first of the usual names
+    questions = []
+    with open(path) as trace:
+        for line in trace:
+            if line.strip():
+                record = json.loads(line)
+                for name in [field] if field else ["question", "ask", "title"]:
+                    if record.get(name):
+                        questions.append(record[name])
+                        break
+    return questions
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.messages = set()
+        self.lock = threading.Lock()
+
+    def timed(self, step, run):
+        start = time.perf_counter()
+        try:
+            app = run()
+            failures = [exception.message for exception in app.exception]
+        except RuntimeError as error:
+            # AppTest raises when the run does not finish within its timeout
+            app, failures = None, [str(error)]
+        elapsed = time.perf_counter() - start
+        if failures:
+            self.fail(step, *failures)
+        else:
+            self.record(step, elapsed)
+        return app
+
+    def record(self, step, elapsed):
+        with self.lock:
+            self.timings[step].append(elapsed)
+
+    def fail(self, step, *messages):
+        with self.lock:
+            self.errors[step] += 1
+            self.messages.update(messages)
+
+
+def run_session(index, args, questions, recorder, apps):
+    rng = random.Random(index)
+    email = "user{0}@tenant{1}.example".format(index, index % args.tenants)
+    app = AppTest.from_file(str(ROOT / "app.py"), default_timeout=args.timeout)
+    apps.append(app)
+
+    if recorder.timed("login_page", app.run) is None:
+        return
+    app.text_input[0].set_value(email)
+    app.text_input[1].set_value(PASSWORD)
+    sign_in_button = next(button for button in app.button if button.label == "Sign In")
+    recorder.timed("sign_in", sign_in_button.click().run)
+    if "waii" not in app.session_state:
+        return
+
+    for _ in range(args.questions):
+        question = rng.choice(questions)
+        if args.unique:
+            question = "{0} (session {1})".format(question, index)
+        time.sleep(rng.uniform(0, args.think))
+        # A run that failed or timed out leaves no chat input to type into; the session ends there
+        if not app.chat_input:
+            recorder.fail("ask", "No chat input on the page")
+            return
+        asked = time.perf_counter()
+        if recorder.timed("ask", app.chat_input[0].set_value(question).run) is None:
+            return
+        # The answer arrives from the chat job queue; AppTest cannot run the polling fragment on its
+        # own, so each poll here is a whole-page rerun (the browser only reruns the fragment)
+        while app.session_state.pending_answer is not None:
+            time.sleep(POLL_SECONDS)
+            if recorder.timed("poll", app.run) is None:
+                return
+        recorder.record("answer", time.perf_counter() - asked)
+        for _ in range(args.reruns):
+            time.sleep(rng.uniform(0, args.think))
+            recorder.timed("rerun", app.run)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--tenants", type=int, default=4)
+    parser.add_argument("--questions", type=int, default=3, help="questions asked per session")
+    parser.add_argument("--reruns", type=int, default=3, help="plain reruns after each answer")
+    parser.add_argument("--think", type=float, default=0.2, help="max random pause between steps (s)")
+    parser.add_argument("--trace", help="JSONL file of questions to replay, e.g. requests.jsonl")
+    parser.add_argument("--field", help="field holding the question in --trace")
+    parser.add_argument("--unique", action="store_true", help="make every session's questions distinct (no answer cache hits)")
+    parser.add_argument("--auth-latency", type=float, default=0.05)
+    parser.add_argument("--waii-latency", type=float, default=1.0)
+    parser.add_argument("--rows", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    identity_toolkit = FakeIdentityToolkit(latency=args.auth_latency).start()
+    waii = FakeWaii(latency=args.waii_latency, rows=args.rows).start()
+    secrets = identity_toolkit.secrets()
+    secrets["bench"].update(waii.secrets()["bench"])
+    secrets["bench"]["TENANTS_BY_DOMAIN"] = {
+        "tenant{0}.example".format(tenant): {"NAME": "Tenant {0}".format(tenant), "TENANT_ID": "tenant-{0}".format(tenant), "ROLE": "TENANT_{0}_ROLE".format(tenant)}
+        for tenant in range(args.tenants)
+    }
+    # Every run starts with no stored conversations
+    secrets["bench"]["CONVERSATION_DB"] = os.path.join(tempfile.mkdtemp(prefix="otto-load-"), "conversations.sqlite3")
+    use_secrets(secrets)
+    share_server_state()
+    os.chdir(ROOT)
+    from result_cache import get_answer_cache
+    from waii_functions import SUGGESTED_QUESTIONS, percentile, waii_connection_key
+
+    for tenant in range(args.tenants):
+        waii.add_connection(waii_connection_key("TENANT_{0}_ROLE".format(tenant)))
+    for index in range(max(args.sessions)):
+        identity_toolkit.add_user("user{0}@tenant{1}.example".format(index, index % args.tenants), PASSWORD)
+    questions = load_questions(args.trace, args.field) if args.trace else SUGGESTED_QUESTIONS
+
+    print("{0:>8} {1:>11} {2:>6} {3:>6} {4:>9} {5:>9} {6:>9} {7:>10} {8:>12}".format(
+        "sessions", "step", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "steps/s", "RSS/session"))
+    for sessions in args.sessions:
+        recorder = Recorder()
+        apps = []
+        asks_before = len(waii.asks)
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=sessions) as pool:
+            for future in [pool.submit(run_session, index, args, questions, recorder, apps) for index in range(sessions)]:
+                future.result()
+        elapsed = time.perf_counter() - start
+        rss_per_session = (rss_bytes() - rss_before) / sessions
+        for step in ["login_page", "sign_in", "ask", "poll", "answer", "rerun"]:
+            timings = recorder.timings[step]
+            if not timings and not recorder.errors[step]:
+                continue
+            print("{0:>8} {1:>11} {2:>6} {3:>6} {4:>9.1f} {5:>9.1f} {6:>9.1f} {7:>10.2f} {8:>10.1f}MB".format(
+                sessions,
+                step,
+                len(timings),
+                recorder.errors[step],
+                (percentile(timings, 50) or 0) * 1000,
+                (percentile(timings, 95) or 0) * 1000,
+                (percentile(timings, 99) or 0) * 1000,
+                len(timings) / elapsed,
+                rss_per_session / 1024 / 1024,
+            ))
+        print("{0:>8} {1:>11} {2:.1f}s wall, {3} questions sent to Waii, answer cache {4}".format(
+            sessions, "total", elapsed, len(waii.asks) - asks_before, get_answer_cache().stats()))
+        for message in sorted(recorder.messages):
+            print("{0:>8} {1:>11} {2}".format(sessions, "error", message.splitlines()[0] if message else message))
+        del apps[:]
+
+
+if __name__ == "__main__":
+    main()
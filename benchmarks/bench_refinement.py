@@ -0,0 +1,89 @@
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import use_secrets
+
+# Follow-up questions answered through Waii chat (a new warehouse query each) against refined
+# locally from the previous answer's rows: Waii generates the SQL, DuckDB runs it over the parent
+# result. The last follow-up is not a refinement and goes to chat either way
+
+FOLLOW_UPS = ["Only the critical ones", "Sort by the oldest", "Count them by severity", "Which assets have open findings?"]
+
+
+def answer(queue, key, client, question, parent):
+    from waii_sdk_py.chat import ChatRequest
+
+    start = time.perf_counter()
+    job = queue.submit(key, client, ChatRequest(ask=question, parent_uuid="parent-chat"), refine_from=parent)
+    while not job.done:
+        time.sleep(0.001)
+    assert job.error is None, job.error
+    return time.perf_counter() - start, job
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 9000], help="parent rows; Waii returns at most 10,000")
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds Waii takes for a chat answer")
+    parser.add_argument("--generate-latency", type=float, default=None, help="seconds Waii takes to generate a query")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--credits-per-query", type=float, default=None)
+    args = parser.parse_args()
+
+    waii = FakeWaii(latency=args.latency, generate_latency=args.generate_latency).start()
+    secrets = waii.secrets()
+    if args.credits_per_query is not None:
+        secrets["bench"]["WAREHOUSE_CREDITS_PER_QUERY"] = args.credits_per_query
+    use_secrets(secrets)
+    from waii_sdk_py.chat import ChatResponse
+
+    from chat_jobs import ChatJobQueue
+    from local_refinement import LocalRefiner
+    from waii_functions import ChatLatencyStats, chat_response_parts, get_waii_client, waii_connection_key
+
+    waii.add_connection(waii_connection_key("BENCH_ROLE"))
+    client = get_waii_client("BENCH_ROLE")
+    latency_stats = ChatLatencyStats()
+    refiner = LocalRefiner(latency_stats=latency_stats)
+    chat_queue = ChatJobQueue(workers=1, latency_stats=latency_stats)
+    local_queue = ChatJobQueue(workers=1, latency_stats=latency_stats, refiner=refiner)
+
+    print("{0:>9} {1:<36} {2:>10} {3:>10} {4:>8} {5:>8}".format("rows", "follow-up", "chat ms", "refine ms", "local", "rows out"))
+    for rows in args.rows:
+        waii.rows = rows
+        parent = chat_response_parts(ChatResponse(**waii.chat_response({})))
+        for question in FOLLOW_UPS:
+            chat_times, local_times = [], []
+            for attempt in range(args.repeat):
+                key = (rows, question, attempt)
+                elapsed, _ = answer(chat_queue, ("chat",) + key, client, question, None)
+                chat_times.append(elapsed)
+                elapsed, job = answer(local_queue, ("local",) + key, client, question, parent)
+                local_times.append(elapsed)
+            print("{0:>9,} {1:<36} {2:>10.1f} {3:>10.1f} {4:>8} {5:>8,}".format(
+                rows,
+                question,
+                statistics.median(chat_times) * 1000,
+                statistics.median(local_times) * 1000,
+                "yes" if job.parts.get("refined_locally") else "no",
+                len(job.parts["data"]),
+            ))
+
+    metrics = refiner.metrics()
+    print()
+    print("warehouse queries avoided: {0} of {1} follow-ups".format(metrics["warehouse_queries_avoided"], len(args.rows) * len(FOLLOW_UPS) * args.repeat))
+    print("local answer p50 / p95 ms: {0:.1f} / {1:.1f}".format(metrics["local_seconds_p50"] * 1000, metrics["local_seconds_p95"] * 1000))
+    print("seconds saved against the chat p50: {0:.1f}".format(metrics["seconds_saved"]))
+    if metrics["warehouse_credits_saved"] is not None:
+        print("warehouse credits saved: {0:.3f}".format(metrics["warehouse_credits_saved"]))
+    print("fallbacks: {0}".format({key: value for key, value in metrics.items() if key.startswith("fallback_")}))
+    print("waii chat asks: {0}, query generations: {1}".format(len(waii.asks), len(waii.generated)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import offline_secrets, use_secrets
+
+# Memory held by a session's results after N turns: DataFrames built from row dicts (the previous
+# storage), compact Arrow tables, and compact tables under the per-session budget with spilling
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--budget-mb", type=float, default=4)
+    args = parser.parse_args()
+
+    use_secrets(offline_secrets())
+    import pandas as pd
+
+    from result_store import ResultStore, ResultTable
+
+    fake = FakeWaii(rows=args.rows)
+    answers = [fake.chat_response({})["response_data"]["data"] for _ in range(args.turns)]
+
+    def dataframes():
+        return [pd.DataFrame(answer["rows"]) for answer in answers]
+
+    def arrow_tables():
+        return [ResultTable.from_rows(answer["rows"]) for answer in answers]
+
+    def budgeted():
+        store = ResultStore(budget_bytes=int(args.budget_mb * 1024 * 1024))
+        for answer in answers:
+            store.add(ResultTable.from_rows(answer["rows"]))
+        return store
+
+    import pyarrow as pa
+
+    frames = dataframes()
+    frames_bytes = sum(frame.memory_usage(deep=True).sum() for frame in frames)
+    del frames
+    baseline = pa.total_allocated_bytes()
+    tables = arrow_tables()
+    tables_bytes = pa.total_allocated_bytes() - baseline
+    del tables
+    baseline = pa.total_allocated_bytes()
+    store = budgeted()
+    store_bytes = pa.total_allocated_bytes() - baseline
+
+    mb = 1024 * 1024
+    print("{0} turns x {1} rows".format(args.turns, args.rows))
+    print("pandas from row dicts:   {0:8.1f} MB".format(frames_bytes / mb))
+    print("compact arrow:           {0:8.1f} MB".format(tables_bytes / mb))
+    print(
+        "arrow + {0:g} MB budget: {1:8.1f} MB, {2} of {3} results spilled to disk".format(
+            args.budget_mb, store_bytes / mb, sum(not result.in_memory for result in store.results), len(store.results)
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
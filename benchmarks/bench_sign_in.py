@@ -0,0 +1,90 @@
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+
+# End-to-end login latency (submit, rerun, first logged-in render) against the fake Identity Toolkit,
+# for the previous serial flow and the current sign_in()
+
+
+def login_script():
+    import streamlit as st
+    from auth_functions import (
+        get_account_info,
+        send_email_verification,
+        sign_in,
+        sign_in_with_email_and_password,
+        user_logged_in,
+    )
+
+    def serial_sign_in(email, password):
+        # The flow before sign_in_async: every call waits for the previous one
+        id_token = sign_in_with_email_and_password(email, password)["idToken"]
+        st.session_state.id_token = id_token
+        user_info = get_account_info(id_token)["users"][0]
+        if not user_info["emailVerified"]:
+            send_email_verification(id_token)
+        else:
+            st.rerun()
+
+    def serial_user_logged_in():
+        return "id_token" in st.session_state and get_account_info(st.session_state.id_token)["users"][0]["emailVerified"]
+
+    if st.session_state.bench_serial:
+        logged_in = serial_user_logged_in()
+    else:
+        logged_in = user_logged_in()
+    if logged_in:
+        st.session_state.logged_in = True
+    elif st.session_state.bench_serial:
+        serial_sign_in("analyst@example.com", "hunter22")
+    else:
+        sign_in("analyst@example.com", "hunter22")
+
+
+def measure(fake, logins, serial):
+    timings = []
+    for _ in range(logins):
+        app = AppTest.from_function(login_script, default_timeout=30)
+        for key, value in fake.secrets().items():
+            app.secrets[key] = value
+        app.session_state.bench_serial = serial
+        start = time.perf_counter()
+        app.run()
+        timings.append(time.perf_counter() - start)
+        assert app.session_state.logged_in
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.1, help="Simulated Identity Toolkit latency in seconds")
+    args = parser.parse_args()
+
+    fake = FakeIdentityToolkit(latency=args.latency).start()
+    try:
+        fake.add_user("analyst@example.com", "hunter22")
+        for label, serial in (("serial", True), ("async", False)):
+            fake.calls.clear()
+            timings = measure(fake, args.logins, serial)
+            print(
+                "{0:>6}: median {1:7.2f} ms, p95 {2:7.2f} ms, calls {3}".format(
+                    label,
+                    statistics.median(timings) * 1000,
+                    statistics.quantiles(timings, n=20)[-1] * 1000,
+                    dict(fake.calls),
+                )
+            )
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import use_secrets
+
+# The sidebar's suggested questions asked cold through Waii chat, against served from the refresher's
+# materialized answers (in memory, and from disk after a restart). Then the refresh schedule over a
+# few intervals: when each tenant's refresh starts, and how many tenants ever refresh at once
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, default=6)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds Waii takes for a chat answer")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--interval", type=float, default=40.0, help="refresh interval, seconds")
+    parser.add_argument("--stagger", type=float, default=0.1)
+    parser.add_argument("--cycles", type=int, default=2)
+    args = parser.parse_args()
+
+    waii = FakeWaii(latency=args.latency, rows=args.rows).start()
+    use_secrets(waii.secrets())
+    from chat_jobs import ChatJobQueue
+    from suggested_answers import SuggestedAnswers
+    from waii_functions import SUGGESTED_QUESTIONS, WaiiClientRegistry, waii_connection_key
+
+    tenants = [("tenant-{0}".format(index), "TENANT_{0}_ROLE".format(index)) for index in range(args.tenants)]
+    for _, tenant_role in tenants:
+        waii.add_connection(waii_connection_key(tenant_role))
+    registry = WaiiClientRegistry()
+    queue = ChatJobQueue(workers=8)
+    directory = tempfile.mkdtemp(prefix="otto-suggested-")
+
+    starts = []
+    running = []
+
+    class Timed(SuggestedAnswers):
+        def refresh_tenant(self, tenant_id, tenant_role):
+            started = time.time()
+            running.append(tenant_id)
+            try:
+                super().refresh_tenant(tenant_id, tenant_role)
+            finally:
+                starts.append((started, time.time(), tenant_id, len(running)))
+                running.remove(tenant_id)
+
+    suggested = Timed(queue, registry.get, directory=directory, refresh_seconds=args.interval, stagger_seconds=args.stagger, refresh=True)
+    began = time.time()
+    for tenant_id, tenant_role in tenants:
+        suggested.register(tenant_id, tenant_role)
+    while len(starts) < args.tenants * args.cycles:
+        time.sleep(0.05)
+
+    tenant_id, tenant_role = tenants[0]
+    cold_queue = ChatJobQueue(workers=1)
+    from waii_sdk_py.chat import ChatRequest
+
+    cold = []
+    for question in SUGGESTED_QUESTIONS:
+        start = time.perf_counter()
+        job = cold_queue.submit(question, registry.get(tenant_role), ChatRequest(ask=question))
+        while not job.done:
+            time.sleep(0.001)
+        cold.append(time.perf_counter() - start)
+    served = []
+    for question in SUGGESTED_QUESTIONS:
+        start = time.perf_counter()
+        assert suggested.get(tenant_id, tenant_role, question) is not None
+        served.append(time.perf_counter() - start)
+    restart_start = time.perf_counter()
+    restarted = SuggestedAnswers(queue, registry.get, directory=directory, refresh_seconds=args.interval, refresh=False)
+    load_ms = (time.perf_counter() - restart_start) * 1000
+    from_disk = []
+    for question in SUGGESTED_QUESTIONS:
+        start = time.perf_counter()
+        assert restarted.get(tenant_id, tenant_role, question) is not None
+        from_disk.append(time.perf_counter() - start)
+
+    print("{0:<44} {1:>10}".format("suggested question served", "median ms"))
+    print("{0:<44} {1:>10.1f}".format("cold, through Waii chat", statistics.median(cold) * 1000))
+    print("{0:<44} {1:>10.2f}".format("materialized, in memory", statistics.median(served) * 1000))
+    print("{0:<44} {1:>10.2f}".format("materialized, first read after a restart", statistics.median(from_disk) * 1000))
+    print("{0:<44} {1:>10.1f}".format("restart: loading the answer index", load_ms))
+    print()
+    print("{0:>4} {1:>12} {2:>10} {3:>12}".format("cycle", "first start", "last start", "max at once"))
+    starts.sort()
+    for cycle in range(args.cycles):
+        batch = starts[cycle * args.tenants : (cycle + 1) * args.tenants]
+        print("{0:>4} {1:>11.1f}s {2:>9.1f}s {3:>12}".format(
+            cycle + 1, batch[0][0] - began, batch[-1][0] - began, max(concurrent for _, _, _, concurrent in batch)))
+    gaps = [later[0] - earlier[1] for earlier, later in zip(starts, starts[1:])]
+    print()
+    print("refreshes: {0}, min gap between tenants {1:.2f}s, waii asks {2}".format(len(starts), min(gaps), len(waii.asks)))
+    print(suggested.metrics())
+
+
+if __name__ == "__main__":
+    main()
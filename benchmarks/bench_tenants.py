@@ -0,0 +1,93 @@
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.support import offline_secrets, use_secrets
+
+# Tenant resolution with many tenants: the three nested st.secrets lookups update_user_info() used to
+# do on every rerun, against building the index once and resolving an address in it (exact
+# domains, subdomains under a wildcard and unknown domains). Parsing secrets.toml is paid either way
+
+
+def tenants_by_domain(count, wildcard_share):
+    tenants = {}
+    for index in range(count):
+        domain = "tenant{0}.example".format(index)
+        if index < count * wildcard_share:
+            domain = "*." + domain
+        tenants[domain] = {"NAME": "Tenant {0}".format(index), "TENANT_ID": "tenant-{0}".format(index), "ROLE": "TENANT_{0}_ROLE".format(index)}
+    return tenants
+
+
+def sample_emails(count, wildcard_share, samples, rng):
+    emails = []
+    for _ in range(samples):
+        index = rng.randrange(count)
+        if index < count * wildcard_share:
+            emails.append("analyst@eu.tenant{0}.example".format(index))
+        elif rng.random() < 0.05:
+            emails.append("analyst@unknown{0}.example".format(index))
+        else:
+            emails.append("analyst@tenant{0}.example".format(index))
+    return emails
+
+
+def per_call_us(function, arguments):
+    start = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tenants", type=int, nargs="+", default=[100, 10_000, 50_000])
+    parser.add_argument("--wildcard-share", type=float, default=0.2)
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print("{0:>8} {1:>14} {2:>12} {3:>16} {4:>14} {5:>16}".format("tenants", "toml parse ms", "build ms", "secrets us/run", "index us", "session us/run"))
+    for count in args.tenants:
+        secrets = offline_secrets()
+        secrets["bench"]["TENANTS_BY_DOMAIN"] = tenants_by_domain(count, args.wildcard_share)
+        use_secrets(secrets)
+        import streamlit as st
+
+        st.secrets._reset()
+        start = time.perf_counter()
+        st.secrets.load_if_toml_exists()
+        parse_ms = (time.perf_counter() - start) * 1000
+        import tenants
+
+        emails = sample_emails(count, args.wildcard_share, args.samples, rng)
+        exact_emails = [email for email in emails if ".tenant" not in email and "unknown" not in email]
+
+        def nested_secrets_lookup(email):
+            domain = email.split("@")[1].lower()
+            return (
+                st.secrets["bench"]["TENANTS_BY_DOMAIN"][domain]["NAME"],
+                st.secrets["bench"]["TENANTS_BY_DOMAIN"][domain]["TENANT_ID"],
+                st.secrets["bench"]["TENANTS_BY_DOMAIN"][domain]["ROLE"],
+            )
+
+        start = time.perf_counter()
+        index = tenants.TenantIndex(tenants.load_tenants_by_domain())
+        build_ms = (time.perf_counter() - start) * 1000
+        assert len(index) == count
+
+        # The old path only handled exact domains (and raised KeyError for anything else)
+        secrets_us = per_call_us(nested_secrets_lookup, exact_emails[: max(1, len(exact_emails) // 10)])
+        index_us = per_call_us(index.resolve, emails)
+        # After the first run a session only compares the index version with the one it resolved against
+        tenants.get_tenant_index()
+        session_us = per_call_us(lambda email: tenants.get_tenant_index().version == index.version, emails)
+        print("{0:>8,} {1:>14.1f} {2:>12.1f} {3:>16.1f} {4:>14.2f} {5:>16.2f}".format(count, parse_ms, build_ms, secrets_us, index_us, session_us))
+        tenants.get_tenant_directory.clear()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.fake_waii import FakeWaii
+from benchmarks.support import use_secrets
+
+# Per-rerun cost of getting a ready Waii client (previous global re-initialize vs the per-tenant registry),
+# then many concurrent sessions across tenants asking at once to check no ask runs under another tenant's role
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--tenants", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=64)
+    args = parser.parse_args()
+
+    fake = FakeWaii(latency=0.05, connect_latency=0.05, rows=10).start()
+    use_secrets(fake.secrets())
+    from waii_sdk_py import WAII
+    from waii_sdk_py.chat import ChatRequest
+
+    from waii_functions import WAII_API_KEY, WAII_API_URL, WaiiClientRegistry, waii_connection_key
+
+    try:
+        roles = ["TENANT_{0}_ROLE".format(index) for index in range(args.tenants)]
+        for role in roles:
+            fake.add_connection(waii_connection_key(role))
+
+        timings = []
+        for _ in range(args.reruns):
+            start = time.perf_counter()
+            WAII.initialize(url=WAII_API_URL, api_key=WAII_API_KEY)
+            WAII.Database.activate_connection(waii_connection_key(roles[0]))
+            timings.append(time.perf_counter() - start)
+        print("global re-initialize per rerun: median {0:8.3f} ms".format(statistics.median(timings) * 1000))
+
+        registry = WaiiClientRegistry()
+        timings = []
+        for _ in range(args.reruns):
+            start = time.perf_counter()
+            registry.get(roles[0])
+            timings.append(time.perf_counter() - start)
+        print("registry per rerun:             median {0:8.3f} ms".format(statistics.median(timings) * 1000))
+
+        fake.calls.clear()
+        fake.asks.clear()
+        registry = WaiiClientRegistry()
+
+        def session(index):
+            role = roles[index % len(roles)]
+            client = registry.get(role)
+            client.chat.chat_message(ChatRequest(ask="session {0} as {1}".format(index, role)))
+            return role
+
+        with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+            list(pool.map(session, range(args.sessions)))
+        mismatched = [
+            (scope, ask) for scope, ask in fake.asks if scope != waii_connection_key(ask.rsplit(" as ", 1)[1])
+        ]
+        print(
+            "{0} concurrent sessions over {1} tenants: {2} clients created, {3} connection lookups, {4} cross-tenant asks".format(
+                args.sessions, len(roles), registry.clients_created, fake.calls["update-db-connect-info"], len(mismatched)
+            )
+        )
+        assert not mismatched
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import datetime
+import threading
+import time
+import uuid
+from collections import Counter
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+from benchmarks.fake_server import FakeServer
+
+# Local stand-in for the Identity Toolkit relyingparty API and the securetoken public certs endpoint
+
+
+class FakeIdentityToolkit(FakeServer):
+    def __init__(self, project_id="otto-bench", latency=0.05, cert_max_age=3600):
+        self.project_id = project_id
+        self.latency = latency
+        self.cert_max_age = cert_max_age
+        self.users = {}
+        self.tokens = {}
+        self.calls = Counter()
+        self.failures_to_inject = []
+        self.lock = threading.Lock()
+        self.key_id = uuid.uuid4().hex
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.cert_pem = self._self_signed_cert().public_bytes(serialization.Encoding.PEM).decode()
+
+    def _self_signed_cert(self):
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "securetoken.system.gserviceaccount.com")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(self.private_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(self.private_key, hashes.SHA256())
+        )
+
+    @property
+    def relyingparty_url(self):
+        return self.url + "/identitytoolkit/v3/relyingparty"
+
+    @property
+    def certs_url(self):
+        return self.url + "/certs"
+
+    def add_user(self, email, password, email_verified=True):
+        self.users[email] = {
+            "localId": uuid.uuid4().hex[:28],
+            "email": email,
+            "password": password,
+            "emailVerified": email_verified,
+        }
+
+    def mint_id_token(self, email, lifetime=3600):
+        user = self.users[email]
+        now = int(time.time())
+        claims = {
+            "iss": "https://securetoken.google.com/{0}".format(self.project_id),
+            "aud": self.project_id,
+            "auth_time": now,
+            "user_id": user["localId"],
+            "sub": user["localId"],
+            "iat": now,
+            "exp": now + lifetime,
+            "email": email,
+            "email_verified": user["emailVerified"],
+        }
+        id_token = jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.key_id})
+        self.tokens[id_token] = email
+        return id_token
+
+    def secrets(self, env="bench"):
+        return {
+            "ENV": env,
+            env: {
+                "FIREBASE_WEB_API_KEY": "fake-key",
+                "FIREBASE_PROJECT_ID": self.project_id,
+                "IDENTITY_TOOLKIT_URL": self.relyingparty_url,
+                "FIREBASE_CERTS_URL": self.certs_url,
+            },
+        }
+
+    def fail_next(self, count, status=503):
+        with self.lock:
+            self.failures_to_inject.extend([status] * count)
+
+    def handle(self, method, path, payload):
+        with self.lock:
+            self.calls[path.split("?")[0].rsplit("/", 1)[-1]] += 1
+            injected_status = self.failures_to_inject.pop(0) if self.failures_to_inject else None
+        time.sleep(self.latency)
+        if injected_status is not None:
+            return error(injected_status, "UNAVAILABLE")
+        if method == "GET" and path.startswith("/certs"):
+            return 200, {"cache-control": "public, max-age={0}".format(self.cert_max_age)}, {self.key_id: self.cert_pem}
+        action = path.split("?")[0].rsplit("/", 1)[-1]
+        if action == "verifyPassword":
+            user = self.users.get(payload.get("email"))
+            if user is None:
+                return error(400, "EMAIL_NOT_FOUND")
+            if user["password"] != payload.get("password"):
+                return error(400, "INVALID_PASSWORD")
+            return 200, {}, {"localId": user["localId"], "email": user["email"], "idToken": self.mint_id_token(user["email"])}
+        if action == "getAccountInfo":
+            email = self.tokens.get(payload.get("idToken"))
+            if email is None:
+                return error(400, "INVALID_ID_TOKEN")
+            user = {key: value for key, value in self.users[email].items() if key != "password"}
+            return 200, {}, {"kind": "identitytoolkit#GetAccountInfoResponse", "users": [user]}
+        if action == "getOobConfirmationCode":
+            return 200, {}, {"kind": "identitytoolkit#GetOobConfirmationCodeResponse"}
+        if action == "signupNewUser":
+            if payload.get("email") in self.users:
+                return error(400, "EMAIL_EXISTS")
+            self.add_user(payload["email"], payload["password"], email_verified=False)
+            return 200, {}, {"email": payload["email"], "idToken": self.mint_id_token(payload["email"])}
+        if action == "deleteAccount":
+            email = self.tokens.pop(payload.get("idToken"), None)
+            self.users.pop(email, None)
+            return 200, {}, {"kind": "identitytoolkit#DeleteAccountResponse"}
+        return error(404, "NOT_FOUND")
+
+
+def error(status, message):
+    return status, {}, {"error": {"code": status, "message": message}}
@@ -0,0 +1,152 @@
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+
+from benchmarks.fake_server import FakeServer
+
+# Local stand-in for the Waii API: connections, chat messages and their generated query, rows and
+# chart, and query generation for follow-ups
+
+SEVERITIES = ["critical", "high", "medium", "low"]
+VULNERABILITIES_QUERY = "SELECT CVE_ID, SEVERITY, ASSET, CVSS_SCORE, OPEN_DAYS FROM VULNERABILITIES"
+# Follow-ups by a word in the question: refinements of the chat answer's query, then one that is not
+FOLLOW_UP_QUERIES = [
+    ("critical", VULNERABILITIES_QUERY + " WHERE SEVERITY = 'critical' ORDER BY CVSS_SCORE DESC"),
+    ("oldest", VULNERABILITIES_QUERY + " ORDER BY OPEN_DAYS DESC"),
+    ("count", "SELECT SEVERITY, COUNT(*) AS FINDINGS, AVG(CVSS_SCORE) AS AVG_CVSS FROM VULNERABILITIES GROUP BY SEVERITY ORDER BY FINDINGS DESC"),
+    ("", "SELECT ASSET, COUNT(*) AS OPEN_FINDINGS FROM ASSET_FINDINGS WHERE STATUS = 'open' GROUP BY ASSET"),
+]
+
+CHART_CODE = """import plotly.express as px
+import streamlit as st
+
+fig = px.bar(df.groupby("SEVERITY", as_index=False)["CVSS_SCORE"].mean(), x="SEVERITY", y="CVSS_SCORE")
+st.plotly_chart(fig, use_container_width=True)
+"""
+
+
+class FakeWaii(FakeServer):
+    def __init__(self, latency=0.5, connect_latency=0.1, rows=200, seed=0, generate_latency=None):
+        self.latency = latency
+        # Generating a query is one LLM step of the several a chat answer takes
+        self.generate_latency = latency / 3 if generate_latency is None else generate_latency
+        self.connect_latency = connect_latency
+        self.rows = rows
+        self.random = random.Random(seed)
+        self.connection_keys = set()
+        self.calls = Counter()
+        self.asks = []
+        self.generated = []
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add_connection(self, key):
+        self.connection_keys.add(key)
+
+    def secrets(self, env="bench"):
+        return {
+            "ENV": env,
+            env: {
+                "WAII_API_KEY": "fake-waii-key",
+                "WAII_API_URL": self.url + "/api/",
+                "SNOWFLAKE_WAREHOUSE": "BENCH_WH",
+                "SNOWFLAKE_DATABASE": "BENCH_DB",
+                "SNOWFLAKE_ACCOUNT": "bench-account",
+                "SNOWFLAKE_USER": "bench_user",
+            },
+        }
+
+    def make_rows(self, count):
+        return [
+            {
+                "CVE_ID": "CVE-2024-{0:05d}".format(index),
+                "SEVERITY": SEVERITIES[index % len(SEVERITIES)],
+                "ASSET": "host-{0}".format(index % 97),
+                "CVSS_SCORE": round(self.random.uniform(1, 10), 1),
+                "OPEN_DAYS": self.random.randint(0, 365),
+            }
+            for index in range(count)
+        ]
+
+    def chat_response(self, payload):
+        return {
+            "response": "Here are the vulnerabilities that need attention first.\n\n<chart>\n\nThe full list is below.\n\n<data>",
+            "chat_uuid": uuid.uuid4().hex,
+            "is_new": True,
+            "timestamp_ms": int(time.time() * 1000),
+            "current_step": "Completed",
+            "response_selected_fields": ["data", "query", "chart"],
+            "response_data": {
+                "query": {
+                    "uuid": uuid.uuid4().hex,
+                    "query": VULNERABILITIES_QUERY + " ORDER BY CVSS_SCORE DESC",
+                },
+                "data": {
+                    "rows": self.make_rows(self.rows),
+                    "column_definitions": [
+                        {"name": "CVE_ID", "type": "TEXT"},
+                        {"name": "SEVERITY", "type": "TEXT"},
+                        {"name": "ASSET", "type": "TEXT"},
+                        {"name": "CVSS_SCORE", "type": "FLOAT"},
+                        {"name": "OPEN_DAYS", "type": "NUMBER"},
+                    ],
+                },
+                "chart": {"uuid": uuid.uuid4().hex, "chart_spec": {"spec_type": "plotly", "plot": CHART_CODE}},
+            },
+        }
+
+    def generated_query(self, payload):
+        ask = (payload.get("ask") or "").lower()
+        query = next(query for word, query in FOLLOW_UP_QUERIES if word in ask)
+        return {"uuid": uuid.uuid4().hex, "query": query, "is_new": True, "confidence_score": None}
+
+    def snapshot(self, response, progress):
+        # Parts appear in the order Waii produces them: query, then rows, then chart, then the answer text
+        stages = [
+            ("Generating Query", []),
+            ("Running Query", ["query"]),
+            ("Generating Chart", ["query", "data"]),
+            ("Preparing Result", ["query", "data", "chart"]),
+        ]
+        if progress >= 1:
+            return response
+        step, parts = stages[int(progress * len(stages))]
+        return {
+            "chat_uuid": response["chat_uuid"],
+            "current_step": step,
+            "response_data": {part: response["response_data"][part] for part in parts},
+        }
+
+    def handle(self, method, path, payload):
+        endpoint = path.split("?")[0].rsplit("/", 1)[-1]
+        with self.lock:
+            self.calls[endpoint] += 1
+        if endpoint == "update-db-connect-info":
+            time.sleep(self.connect_latency)
+            return 200, {}, {"connectors": [{"key": key, "db_type": "snowflake"} for key in sorted(self.connection_keys)]}
+        if endpoint in ("chat-message", "submit-chat-message", "get-chat-response", "generate-query"):
+            if payload.get("scope") not in self.connection_keys:
+                return 400, {}, {"detail": "Unknown scope {0}".format(payload.get("scope"))}
+        if endpoint == "chat-message":
+            with self.lock:
+                self.asks.append((payload.get("scope"), payload.get("ask")))
+            time.sleep(self.latency)
+            return 200, {}, self.chat_response(payload)
+        if endpoint == "generate-query":
+            with self.lock:
+                self.generated.append((payload.get("scope"), payload.get("ask"), payload.get("parent_uuid")))
+            time.sleep(self.generate_latency)
+            return 200, {}, self.generated_query(payload)
+        if endpoint == "submit-chat-message":
+            job_id = uuid.uuid4().hex
+            with self.lock:
+                self.asks.append((payload.get("scope"), payload.get("ask")))
+                self.jobs[job_id] = (time.time(), self.chat_response(payload))
+            return 200, {}, {"uuid": job_id}
+        if endpoint == "get-chat-response":
+            with self.lock:
+                submitted_at, response = self.jobs[payload["uuid"]]
+            return 200, {}, self.snapshot(response, (time.time() - submitted_at) / max(self.latency, 1e-9))
+        return 404, {}, {"detail": "Unknown endpoint {0}".format(endpoint)}
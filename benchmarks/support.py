@@ -0,0 +1,54 @@
+import json
+import tempfile
+
+from streamlit import config
+
+# Helpers for importing the app modules outside `streamlit run`, where st.secrets is read from disk
+
+
+def use_secrets(secrets):
+    secrets_file = tempfile.NamedTemporaryFile("w", suffix=".toml", delete=False)
+    secrets_file.write("\n".join(toml_lines(secrets)) + "\n")
+    secrets_file.close()
+    config.set_option("secrets.files", [secrets_file.name])
+    return secrets_file.name
+
+
+def toml_lines(values, table=None):
+    lines = ["[{0}]".format(table)] if table else []
+    lines.extend("{0} = {1}".format(json.dumps(key), json.dumps(value)) for key, value in values.items() if not isinstance(value, dict))
+    for key, value in values.items():
+        if isinstance(value, dict):
+            lines.extend(toml_lines(value, json.dumps(key) if table is None else "{0}.{1}".format(table, json.dumps(key))))
+    return lines
+
+
+def offline_secrets(env="bench"):
+    # Enough configuration to import the app modules when no upstream is contacted
+    return {
+        "ENV": env,
+        env: {
+            "FIREBASE_WEB_API_KEY": "fake-key",
+            "WAII_API_KEY": "fake-waii-key",
+            "WAII_API_URL": "http://127.0.0.1:9/api/",
+            "SNOWFLAKE_WAREHOUSE": "BENCH_WH",
+            "SNOWFLAKE_DATABASE": "BENCH_DB",
+            "SNOWFLAKE_ACCOUNT": "bench-account",
+            "SNOWFLAKE_USER": "bench_user",
+        },
+    }
+
+
+def chat_history(turns, rows=200):
+    # Messages shaped like the ones ask() stores, built from the fake Waii's answers
+    from benchmarks.fake_waii import FakeWaii
+    from waii_sdk_py.chat import ChatResponse
+
+    from waii_functions import chat_response_parts
+
+    fake = FakeWaii(rows=rows)
+    messages = []
+    for turn in range(turns):
+        messages.append({"name": "user", "text": "Question {0}".format(turn)})
+        messages.append({"name": "Otto", **chat_response_parts(ChatResponse(**fake.chat_response({})))})
+    return messages
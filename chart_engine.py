@@ -0,0 +1,239 @@
+import builtins
+import hashlib
+import json
+import os
+import pickle
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+import streamlit as st
+
+from chart_sandbox import compile_chart_code
+from instrumentation import get_metrics_registry
+from waii_functions import percentile
+
+## -------------------------------------------------------------------------------------------------
+## Chart engine ------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+CHART_WORKERS = st.secrets[ENV].get("CHART_WORKERS", 2)
+CHART_TIMEOUT_SECONDS = st.secrets[ENV].get("CHART_TIMEOUT_SECONDS", 15)
+CHART_CPU_SECONDS = st.secrets[ENV].get("CHART_CPU_SECONDS", 60)
+CHART_MEMORY_BYTES = st.secrets[ENV].get("CHART_MEMORY_BYTES", 2 * 1024 * 1024 * 1024)
+CHART_CODE_CACHE_ENTRIES = 256
+CHART_WORKER_START_SECONDS = 60
+CHART_QUEUE_SECONDS = 60
+
+
+class ChartCodeError(Exception):
+    pass
+
+
+def chart_error(response):
+    # The chart code's exception, rebuilt from its type name and message: a built-in exception type
+    # when it is one, a ChartCodeError otherwise
+    error_type = getattr(builtins, str(response.get("type")), None)
+    message = str(response.get("message", ""))
+    if isinstance(error_type, type) and issubclass(error_type, Exception):
+        try:
+            return error_type(message)
+        except TypeError:
+            pass
+    return ChartCodeError("{0}: {1}".format(response.get("type"), message))
+
+
+class ChartWorker:
+    # A `python -m chart_sandbox` process fed pickled requests over its stdin, answering with lines
+    # of JSON on its stdout: it runs Waii's code, so nothing it sends is unpickled. These are plain
+    # subprocesses rather than a multiprocessing pool: Streamlit installs the app script as __main__,
+    # which multiprocessing's spawn start method would run again in every worker
+    def __init__(self, cpu_seconds, memory_bytes):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "chart_sandbox", json.dumps([cpu_seconds, memory_bytes])],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        self.responses = queue.Queue()
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def _read_responses(self):
+        while True:
+            try:
+                line = self.process.stdout.readline()
+                response = json.loads(line)
+                if not isinstance(response, dict):
+                    raise ValueError("Unexpected chart worker response")
+                self.responses.put(response)
+            except Exception:
+                # EOF: the worker exited, was killed, or hit its CPU limit (SIGXCPU); or it wrote
+                # something that is not a response, and is stopped like a crashed one
+                self.responses.put({"status": "stopped"})
+                return
+
+    def wait_ready(self, timeout=CHART_WORKER_START_SECONDS):
+        return self._response(timeout)
+
+    def call(self, request, timeout):
+        self.process.stdin.write(pickle.dumps(request))
+        self.process.stdin.flush()
+        return self._response(timeout)
+
+    def _response(self, timeout):
+        try:
+            response = self.responses.get(timeout=timeout)
+        except queue.Empty:
+            self.kill()
+            raise TimeoutError("Chart code did not finish within {0} seconds".format(timeout))
+        if response.get("status") == "error":
+            raise chart_error(response)
+        if response.get("status") == "ready":
+            return None
+        if response.get("status") != "ok" or not isinstance(response.get("figure"), str):
+            self.kill()
+            raise RuntimeError("The chart worker stopped (CPU or memory limit, or crashed)")
+        return response["figure"]
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+        self.process.wait()
+
+
+class ChartEngine:
+    def __init__(
+        self,
+        bgcolor,
+        workers=CHART_WORKERS,
+        timeout=CHART_TIMEOUT_SECONDS,
+        cpu_seconds=CHART_CPU_SECONDS,
+        memory_bytes=CHART_MEMORY_BYTES,
+        cache_entries=CHART_CODE_CACHE_ENTRIES,
+    ):
+        self.bgcolor = bgcolor
+        self.workers = workers
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+        self.cache_entries = cache_entries
+        self.compiled = OrderedDict()
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(workers)
+        self.counters = Counter()
+        self.latencies = deque(maxlen=500)
+        self.lock = threading.Lock()
+        self.compile_lock = threading.Lock()
+
+    def compile(self, chart_code):
+        # Keyed by the hash of Waii's code, so a chart asked again (or redrawn in another session)
+        # is neither parsed nor compiled again; syntax errors are cached too
+        code_hash = hashlib.sha1(chart_code.encode()).hexdigest()
+        with self.lock:
+            entry = self.compiled.get(code_hash)
+            if entry is not None:
+                self.compiled.move_to_end(code_hash)
+                self.counters["compile_cache_hits"] += 1
+        if entry is None:
+            try:
+                # One parse at a time: concurrent ast.parse calls can fail on Python 3.11 ("AST
+                # constructor recursion depth mismatch"), and misses are rare once the cache is warm
+                with self.compile_lock:
+                    entry = (compile_chart_code(chart_code, self.bgcolor), None)
+            except SyntaxError as error:
+                entry = (None, error)
+            with self.lock:
+                self.counters["compiled"] += 1
+                self.compiled[code_hash] = entry
+                while len(self.compiled) > self.cache_entries:
+                    self.compiled.popitem(last=False)
+        if entry[1] is not None:
+            raise entry[1]
+        return code_hash, entry[0]
+
+    def _start_worker(self):
+        worker = ChartWorker(self.cpu_seconds, self.memory_bytes)
+        with self.lock:
+            self.counters["workers_started"] += 1
+        # Start-up (importing pandas and plotly) does not count against a chart's time limit
+        worker.wait_ready()
+        return worker
+
+    def _release_worker(self, worker):
+        if worker.alive and self.idle.qsize() < self.workers:
+            self.idle.put(worker)
+        else:
+            worker.kill()
+
+    def warm_up(self):
+        def start():
+            for _ in range(self.workers):
+                with self.slots:
+                    self._release_worker(self._start_worker())
+
+        threading.Thread(target=start, daemon=True).start()
+
+    def render(self, chart_code, table):
+        # Returns the figure as plotly JSON; raises SyntaxError, TimeoutError, RuntimeError (worker
+        # died, e.g. on the CPU limit) or whatever the chart code itself raised
+        started = time.perf_counter()
+        outcome = "failed_error"
+        try:
+            code_hash, code = self.compile(chart_code)
+            # Waiting for a free worker does not count against the chart's time limit either
+            if not self.slots.acquire(timeout=CHART_QUEUE_SECONDS):
+                outcome = "failed_busy"
+                raise TimeoutError("No chart worker became free within {0} seconds".format(CHART_QUEUE_SECONDS))
+            worker = None
+            try:
+                try:
+                    worker = self.idle.get_nowait()
+                except queue.Empty:
+                    worker = self._start_worker()
+                figure_json = worker.call((code_hash, code, table), self.timeout)
+            except TimeoutError:
+                outcome = "failed_timeout"
+                raise
+            except RuntimeError:
+                outcome = "failed_worker"
+                raise
+            finally:
+                # A killed worker is replaced on demand; only the stuck session's worker is lost
+                if worker is not None:
+                    self._release_worker(worker)
+                self.slots.release()
+            outcome = "succeeded"
+            return figure_json
+        except SyntaxError:
+            outcome = "failed_syntax"
+            raise
+        finally:
+            with self.lock:
+                self.counters["runs"] += 1
+                self.counters[outcome] += 1
+                self.latencies.append(time.perf_counter() - started)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "latency_p50": percentile(self.latencies, 50),
+                "latency_p95": percentile(self.latencies, 95),
+                "compiled_cached": len(self.compiled),
+            }
+
+
+@st.cache_resource
+def get_chart_engine(bgcolor):
+    engine = ChartEngine(bgcolor)
+    get_metrics_registry().register_collector("chart_engine", engine.metrics)
+    engine.warm_up()
+    return engine
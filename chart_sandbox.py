@@ -0,0 +1,172 @@
+import ast
+import json
+import marshal
+import os
+import pickle
+import sys
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; workers then run without CPU and memory limits
+    resource = None
+
+## -------------------------------------------------------------------------------------------------
+## Chart code transform ----------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+# This module is also the chart workers' entry point, so it must not import streamlit (workers have
+# no secrets and no script run context); pandas and plotly are only imported in the workers
+
+FIGURE_NAME = "__figure__"
+
+
+class ChartCodeTransformer(ast.NodeTransformer):
+    # Strips streamlit out of Waii's generated code: `st.plotly_chart(fig, ...)` becomes an
+    # assignment to FIGURE_NAME, any other st call is dropped, and so are the streamlit imports
+    def __init__(self, streamlit_names):
+        self.streamlit_names = streamlit_names
+        self.found_figure = False
+
+    def visit_Import(self, node):
+        node.names = [alias for alias in node.names if alias.name.split(".")[0] != "streamlit"]
+        return node if node.names else ast.Pass()
+
+    def visit_ImportFrom(self, node):
+        return ast.Pass() if (node.module or "").split(".")[0] == "streamlit" else node
+
+    def visit_Expr(self, node):
+        call = node.value
+        if not (isinstance(call, ast.Call) and self.is_streamlit_call(call)):
+            return self.generic_visit(node)
+        if call.func.attr == "plotly_chart" and call.args:
+            self.found_figure = True
+            return ast.copy_location(ast.Assign(targets=[ast.Name(FIGURE_NAME, ast.Store())], value=call.args[0]), node)
+        return ast.Pass()
+
+    def is_streamlit_call(self, call):
+        func = call.func
+        while isinstance(func, ast.Attribute) and isinstance(func.value, ast.Attribute):
+            func = func.value
+        return isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in self.streamlit_names
+
+
+def streamlit_names(tree):
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.asname or alias.name for alias in node.names if alias.name == "streamlit")
+    return names or {"st"}
+
+
+def compile_chart_code(chart_code, bgcolor, filename="<waii-chart>"):
+    # Parse once, transform, append the styling as AST statements and compile; the result is
+    # marshalled so the workers can load it without parsing the source again
+    tree = ast.parse(chart_code, filename)
+    transformer = ChartCodeTransformer(streamlit_names(tree))
+    tree = transformer.visit(tree)
+    if not transformer.found_figure:
+        # Code that draws nothing itself is expected to leave its figure in `fig`
+        tree.body.extend(ast.parse("{0} = globals().get('fig')".format(FIGURE_NAME)).body)
+    styling = "if {0} is not None:\n    {0}.update_layout(paper_bgcolor={1!r}, plot_bgcolor={1!r})".format(FIGURE_NAME, bgcolor)
+    tree.body.extend(ast.parse(styling).body)
+    ast.fix_missing_locations(tree)
+    return marshal.dumps(compile(tree, filename, "exec"))
+
+
+## -------------------------------------------------------------------------------------------------
+## Chart workers -----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+CODE_OBJECTS = {}
+CODE_OBJECTS_MAX = 256
+CPU_SECONDS_PER_CHART = None
+
+
+def limit_worker_resources(cpu_seconds, memory_bytes):
+    # Runaway code gets a MemoryError, or SIGXCPU (which kills the worker), instead of starving the server
+    global CPU_SECONDS_PER_CHART
+    CPU_SECONDS_PER_CHART = cpu_seconds
+    if resource is not None and memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+    # Pay for the chart libraries when the worker starts rather than on its first chart; imported
+    # only for that, so unused here
+    import pandas  # noqa: F401
+    import plotly.express  # noqa: F401
+
+
+def limit_cpu_for_next_chart():
+    # RLIMIT_CPU counts the whole life of the process, so each chart gets its budget on top of
+    # what the worker has already used
+    if resource is None or not CPU_SECONDS_PER_CHART:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+    soft = int(usage.ru_utime + usage.ru_stime) + CPU_SECONDS_PER_CHART
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+
+def widen_table(table):
+    # Results are stored with the narrowest integer and float types that hold them; chart code
+    # gets pandas' usual int64 and float64 columns back
+    import pyarrow as pa
+
+    columns = []
+    for column in table.columns:
+        if pa.types.is_signed_integer(column.type) and column.type != pa.int64():
+            column = column.cast(pa.int64())
+        elif pa.types.is_floating(column.type) and column.type != pa.float64():
+            column = column.cast(pa.float64())
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+def run_chart_code(code_hash, code, table):
+    import plotly.io as pio
+
+    code_object = CODE_OBJECTS.get(code_hash)
+    if code_object is None:
+        if len(CODE_OBJECTS) >= CODE_OBJECTS_MAX:
+            CODE_OBJECTS.clear()
+        code_object = CODE_OBJECTS[code_hash] = marshal.loads(code)
+    limit_cpu_for_next_chart()
+    namespace = {"df": widen_table(table).to_pandas()}
+    exec(code_object, namespace)
+    fig = namespace.get(FIGURE_NAME)
+    if fig is None or not hasattr(fig, "to_json"):
+        raise ValueError("The chart code did not produce a plotly figure")
+    # Streamlit's chart theme replaces plotly's default template anyway, and leaving it out of the
+    # returned figure makes redrawing it cheaper
+    if fig.layout.template == pio.templates[pio.templates.default]:
+        fig.layout.template = {}
+    return fig.to_json()
+
+
+def send(protocol_out, response):
+    protocol_out.write(json.dumps(response).encode() + b"\n")
+    protocol_out.flush()
+
+
+def serve(protocol_in, protocol_out, cpu_seconds, memory_bytes):
+    # One request at a time: a pickled (code_hash, code, table) in from the server, one line of JSON
+    # out. The chart code runs in this process and can reach the protocol, so what goes back to the
+    # server is only ever parsed as JSON, never unpickled
+    limit_worker_resources(cpu_seconds, memory_bytes)
+    send(protocol_out, {"status": "ready"})
+    while True:
+        try:
+            request = pickle.load(protocol_in)
+        except EOFError:
+            return
+        try:
+            response = {"status": "ok", "figure": run_chart_code(*request)}
+        except Exception as error:
+            response = {"status": "error", "type": type(error).__name__, "message": str(error)}
+        send(protocol_out, response)
+
+
+if __name__ == "__main__":
+    # Started by chart_engine as `python -m chart_sandbox '[cpu_seconds, memory_bytes]'`. The protocol
+    # keeps the original stdout; anything the chart code prints goes to stderr instead
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    serve(sys.stdin.buffer, protocol_out, *json.loads(sys.argv[1]))
@@ -0,0 +1,190 @@
+import contextvars
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from instrumentation import get_metrics_registry, span
+from local_refinement import get_local_refiner
+from result_store import ResultTable
+from waii_functions import chat_response_parts, get_chat_latency_stats, percentile, stream_chat_response
+
+## -------------------------------------------------------------------------------------------------
+## Chat jobs ---------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+# At most this many questions are with Waii (and so on the warehouse) at once; the rest wait in line
+CHAT_JOB_WORKERS = st.secrets[ENV].get("CHAT_JOB_WORKERS", 8)
+CHAT_JOB_QUEUE_MAX = st.secrets[ENV].get("CHAT_JOB_QUEUE_MAX", 200)
+CHAT_JOB_POLL_SECONDS = 0.5
+QUEUED, RUNNING, COMPLETED, FAILED, CANCELLED = "queued", "running", "completed", "failed", "cancelled"
+
+
+class ChatJob:
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.status = QUEUED
+        # Replaced (never mutated) by the worker, so a session always reads a consistent snapshot
+        self.parts = {}
+        self.step = None
+        self.chat_uuid = None
+        self.error = None
+        self.subscribers = 1
+        self.cancel_requested = threading.Event()
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        # The first step, SQL or rows the waiting session can show
+        self.first_part_at = None
+        self.finished_at = None
+
+    @property
+    def done(self):
+        return self.status in (COMPLETED, FAILED, CANCELLED)
+
+    def message(self):
+        # Each session gets its own ResultTable around the shared Arrow table, as with cached answers
+        message = {"name": "Otto", **self.parts}
+        message.setdefault("text", "")
+        if message.get("data") is not None:
+            message["data"] = ResultTable(message["data"].table())
+        message["timings"] = self.timings()
+        return message
+
+    def timings(self):
+        finished = self.finished_at or time.perf_counter()
+        return {
+            "time_to_first_token": (self.first_part_at or finished) - self.submitted_at,
+            "time_to_complete": finished - self.submitted_at,
+        }
+
+
+class ChatJobQueue:
+    # Questions run on a fixed pool of threads instead of the sessions' script threads. The same
+    # question (same key: tenant, role and conversation) asked again while it is still in flight
+    # joins the existing job rather than sending Waii a second one
+    def __init__(self, workers=CHAT_JOB_WORKERS, queue_max=CHAT_JOB_QUEUE_MAX, latency_stats=None, refiner=None):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.latency_stats = latency_stats
+        self.refiner = refiner
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chat-job")
+        self.in_flight = {}
+        self.queued = deque()
+        self.running = 0
+        self.counters = Counter()
+        self.queue_waits = deque(maxlen=500)
+        self.lock = threading.Lock()
+
+    def submit(self, key, client, request, on_complete=None, refine_from=None):
+        # on_complete(job) runs on the worker once the answer is in, even if every session left.
+        # refine_from is the answer a follow-up refines, tried locally before asking Waii chat
+        with self.lock:
+            job = self.in_flight.get(key)
+            if job is not None:
+                job.subscribers += 1
+                self.counters["coalesced"] += 1
+                return job
+            if len(self.queued) >= self.queue_max:
+                self.counters["rejected"] += 1
+                raise RuntimeError("Otto is answering too many questions right now; please try again shortly")
+            job = self.in_flight[key] = ChatJob(key, request)
+            self.queued.append(job)
+            self.counters["submitted"] += 1
+        # The worker keeps the session's tenant and trace for its metrics and spans
+        self.executor.submit(contextvars.copy_context().run, self._run, job, client, on_complete, refine_from)
+        return job
+
+    def cancel(self, job):
+        # Only stops the job once no other session is waiting for it. Waii has no cancel call, so a
+        # running job stops polling and its answer is dropped
+        with self.lock:
+            job.subscribers -= 1
+            if job.subscribers > 0 or job.done:
+                return
+            job.cancel_requested.set()
+            if self.in_flight.get(job.key) is job:
+                del self.in_flight[job.key]
+            if job.status == QUEUED:
+                self.queued.remove(job)
+                self._finish(job, CANCELLED)
+
+    def position(self, job):
+        with self.lock:
+            return self.queued.index(job) if job in self.queued else 0
+
+    def _run(self, job, client, on_complete, refine_from=None):
+        with self.lock:
+            if job.done:
+                return
+            self.queued.remove(job)
+            job.status = RUNNING
+            self.running += 1
+            job.started_at = time.perf_counter()
+            self.queue_waits.append(job.started_at - job.submitted_at)
+        try:
+            with span("chat_job.run", coalesced=job.subscribers - 1):
+                refined = None
+                if refine_from is not None and self.refiner is not None:
+                    job.step = "Refining the previous answer"
+                    refined = self.refiner.refine(client, job.request.ask, refine_from)
+                if refined is not None:
+                    # No chat_uuid: follow-ups continue the parent's Waii conversation, with this
+                    # turn as context (local_refinement.chat_context)
+                    job.first_part_at = time.perf_counter()
+                    job.parts = refined
+                elif not job.cancel_requested.is_set():
+                    for response in stream_chat_response(client, job.request):
+                        if job.cancel_requested.is_set():
+                            break
+                        parts = chat_response_parts(response, skip=job.parts.keys())
+                        # Waii sends the text last, with the finished answer; the session shows
+                        # the step, SQL and row count while it waits
+                        if job.first_part_at is None and (parts or response.current_step):
+                            job.first_part_at = time.perf_counter()
+                        job.chat_uuid = response.chat_uuid or job.chat_uuid
+                        job.step = response.current_step.value if response.current_step else job.step
+                        job.parts = {**job.parts, **parts}
+        except Exception as error:
+            print(error)
+            job.error = error
+        with self.lock:
+            self.running -= 1
+            if self.in_flight.get(job.key) is job:
+                del self.in_flight[job.key]
+            self._finish(job, CANCELLED if job.cancel_requested.is_set() else FAILED if job.error else COMPLETED)
+        if job.status == COMPLETED:
+            # Local answers would drag the chat latency the savings are measured against
+            if self.latency_stats is not None and not job.parts.get("refined_locally"):
+                timings = job.timings()
+                self.latency_stats.record(timings["time_to_first_token"], timings["time_to_complete"])
+            if on_complete is not None:
+                try:
+                    on_complete(job)
+                except Exception as error:
+                    print(error)
+
+    def _finish(self, job, status):
+        job.finished_at = time.perf_counter()
+        job.status = status
+        self.counters[status] += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "queued": len(self.queued),
+                "running": self.running,
+                "queue_wait_p50": percentile(self.queue_waits, 50),
+                "queue_wait_p95": percentile(self.queue_waits, 95),
+            }
+
+
+@st.cache_resource
+def get_chat_job_queue():
+    queue = ChatJobQueue(latency_stats=get_chat_latency_stats(), refiner=get_local_refiner())
+    get_metrics_registry().register_collector("chat_jobs", queue.metrics)
+    return queue
@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import pyarrow as pa
+import streamlit as st
+
+from instrumentation import get_metrics_registry, traced
+from result_store import ResultTable
+
+## -------------------------------------------------------------------------------------------------
+## Conversation store ------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+CONVERSATION_DB = st.secrets[ENV].get("CONVERSATION_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".otto", "conversations.sqlite3"))
+# Turns (a question and its answer) rendered when a conversation opens, and per "Load earlier"
+CONVERSATION_WINDOW_TURNS = st.secrets[ENV].get("CONVERSATION_WINDOW_TURNS", 10)
+CONVERSATION_MAX_MESSAGES = st.secrets[ENV].get("CONVERSATION_MAX_MESSAGES", 1000)
+# Larger results are not written; the restored answer keeps its text, SQL and chart
+CONVERSATION_MAX_RESULT_BYTES = 32 * 1024 * 1024
+MESSAGE_FIELDS = ("text", "sql", "query_uuid", "chart", "cached_at", "precomputed_at", "render_cache", "timings", "data_dropped", "refined_locally")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    name TEXT NOT NULL,
+    body TEXT NOT NULL,
+    data BLOB
+);
+CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_id, tenant_id, id);
+CREATE TABLE IF NOT EXISTS conversations (
+    user_id TEXT NOT NULL,
+    tenant_id TEXT NOT NULL,
+    prev_response_uuid TEXT,
+    question_chain TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, tenant_id)
+);
+"""
+
+
+def encode_result(data, max_bytes=CONVERSATION_MAX_RESULT_BYTES):
+    # Arrow IPC stream, zstd-compressed; None when the result is too large to keep
+    sink = pa.BufferOutputStream()
+    table = data.table()
+    with pa.ipc.new_stream(sink, table.schema, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+        writer.write_table(table)
+    buffer = sink.getvalue()
+    return buffer.to_pybytes() if buffer.size <= max_bytes else None
+
+
+def decode_result(blob):
+    return ResultTable(pa.ipc.open_stream(pa.py_buffer(blob)).read_all())
+
+
+class ConversationStore:
+    # One SQLite database per process; every user's messages in order, with the Waii conversation
+    # state needed to continue it, so a reload or reconnect restores it without asking Waii again
+    def __init__(self, path=CONVERSATION_DB, max_messages=CONVERSATION_MAX_MESSAGES):
+        self.path = path
+        self.max_messages = max_messages
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.written_states = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def _encode(self, message):
+        body = {field: message[field] for field in MESSAGE_FIELDS if message.get(field) is not None}
+        data = None
+        if message.get("data") is not None:
+            data = encode_result(message["data"])
+            if data is None:
+                body["data_dropped"] = True
+        return body, data
+
+    def _decode(self, row):
+        message_id, name, body, data = row
+        message = {"name": name, **json.loads(body), "stored_id": message_id}
+        if data is not None:
+            message["data"] = decode_result(data)
+        message["stored_render_key"] = (message.get("render_cache") or {}).get("key")
+        return message
+
+    @traced("conversation.sync")
+    def sync(self, user_id, tenant_id, messages, prev_response_uuid, question_chain):
+        # Writes the messages that are not stored yet, chart figures rendered since the last sync and
+        # the conversation state, in one transaction. Cheap when nothing changed: no SQL at all
+        new_messages = [message for message in messages if "stored_id" not in message]
+        rendered = [
+            message
+            for message in messages
+            if "stored_id" in message and (message.get("render_cache") or {}).get("key") != message.get("stored_render_key")
+        ]
+        state = (prev_response_uuid, json.dumps(list(question_chain)))
+        if not new_messages and not rendered and self.written_states.get((user_id, tenant_id)) == state:
+            return 0
+        encoded = [self._encode(message) for message in new_messages]
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            for message, (body, data) in zip(new_messages, encoded):
+                cursor = self.connection.execute(
+                    "INSERT INTO messages (user_id, tenant_id, created_at, name, body, data) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, tenant_id, now, message["name"], json.dumps(body, default=str), data),
+                )
+                message["stored_id"] = cursor.lastrowid
+                message["stored_render_key"] = (message.get("render_cache") or {}).get("key")
+            for message in rendered:
+                body, _ = self._encode({**message, "data": None})
+                self.connection.execute("UPDATE messages SET body = ? WHERE id = ?", (json.dumps(body, default=str), message["stored_id"]))
+                message["stored_render_key"] = (message.get("render_cache") or {}).get("key")
+            self.connection.execute(
+                "INSERT INTO conversations (user_id, tenant_id, prev_response_uuid, question_chain, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, tenant_id) DO UPDATE SET prev_response_uuid = excluded.prev_response_uuid, "
+                "question_chain = excluded.question_chain, updated_at = excluded.updated_at",
+                (user_id, tenant_id, *state, now),
+            )
+            if new_messages:
+                # Keep the newest max_messages per user
+                self.connection.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND tenant_id = ? AND id <= "
+                    "(SELECT id FROM messages WHERE user_id = ? AND tenant_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                    (user_id, tenant_id, user_id, tenant_id, self.max_messages),
+                )
+            self.counters["messages_written"] += len(new_messages)
+            self.counters["figures_written"] += len(rendered)
+            self.counters["bytes_written"] += sum(len(data) for _, data in encoded if data is not None)
+            self.counters["syncs"] += 1
+            self.written_states[(user_id, tenant_id)] = state
+        return len(new_messages) + len(rendered)
+
+    @traced("conversation.load")
+    def load(self, user_id, tenant_id, limit, before_id=None):
+        # The last `limit` messages (before `before_id`, when paging back), oldest first, and how many
+        # stored messages come before them
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, name, body, data FROM messages WHERE user_id = ? AND tenant_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                (user_id, tenant_id, before_id if before_id is not None else 2**63 - 1, limit),
+            ).fetchall()
+            earlier = 0
+            if rows:
+                earlier = self.connection.execute(
+                    "SELECT COUNT(*) FROM messages WHERE user_id = ? AND tenant_id = ? AND id < ?", (user_id, tenant_id, rows[-1][0])
+                ).fetchone()[0]
+            self.counters["messages_loaded"] += len(rows)
+        return [self._decode(row) for row in reversed(rows)], earlier
+
+    def load_state(self, user_id, tenant_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT prev_response_uuid, question_chain FROM conversations WHERE user_id = ? AND tenant_id = ?", (user_id, tenant_id)
+            ).fetchone()
+            if row is None:
+                return None, []
+            self.written_states[(user_id, tenant_id)] = tuple(row)
+        return row[0], json.loads(row[1])
+
+    def delete_user(self, user_id):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+            self.connection.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
+            for key in [key for key in self.written_states if key[0] == user_id]:
+                del self.written_states[key]
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+@st.cache_resource
+def get_conversation_store():
+    store = ConversationStore()
+    get_metrics_registry().register_collector("conversations", store.metrics)
+    return store
@@ -0,0 +1,246 @@
+import bisect
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+
+## -------------------------------------------------------------------------------------------------
+## Metrics -----------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+# Spans are appended to this file as JSON lines when set; TRACE_SAMPLE_RATE thins them out
+TRACE_FILE = st.secrets[ENV].get("TRACE_FILE")
+TRACE_SAMPLE_RATE = st.secrets[ENV].get("TRACE_SAMPLE_RATE", 1.0)
+# The metrics page (?admin=metrics&token=...) and the /metrics endpoint are off unless configured
+ADMIN_TOKEN = st.secrets[ENV].get("ADMIN_TOKEN")
+METRICS_PORT = st.secrets[ENV].get("METRICS_PORT")
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+NO_TENANT = "none"
+
+current_tenant = contextvars.ContextVar("current_tenant", default=NO_TENANT)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.counters = defaultdict(int)
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.histograms[(name, tuple(sorted(labels.items())))].observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def register_collector(self, name, collect):
+        # Components that already keep their own numbers (the auth client, chart engine, answer
+        # cache, ...) are read when the metrics are rendered instead of being pushed here
+        self.collectors[name] = collect
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append("# TYPE otto_{0} histogram".format(name))
+            for (histogram_name, labels), histogram in histograms:
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append("otto_{0}_bucket{1} {2}".format(name, prometheus_labels(labels + (("le", bound),)), cumulative))
+                lines.append("otto_{0}_sum{1} {2}".format(name, prometheus_labels(labels), histogram.sum))
+                lines.append("otto_{0}_count{1} {2}".format(name, prometheus_labels(labels), histogram.count))
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append("# TYPE otto_{0} counter".format(name))
+            lines.extend("otto_{0}{1} {2}".format(name, prometheus_labels(labels), value) for (counter_name, labels), value in counters if counter_name == name)
+        for collector_name, collect in sorted(self.collectors.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                print(e)
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append("# TYPE otto_{0}_{1} gauge".format(collector_name, key))
+                    lines.append("otto_{0}_{1} {2}".format(collector_name, key, value))
+        return "\n".join(lines) + "\n"
+
+
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')) for key, value in labels) + "}"
+
+
+# Module-level rather than st.cache_resource: spans also close on threads with no script run
+# context (to_thread auth calls, the warm-up and chart worker threads, the /metrics server)
+METRICS_REGISTRY = MetricsRegistry()
+
+
+def get_metrics_registry():
+    return METRICS_REGISTRY
+
+
+## -------------------------------------------------------------------------------------------------
+## Tracing -----------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+
+class TraceWriter:
+    def __init__(self, path, sample_rate=TRACE_SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.file = open(path, "a", buffering=1) if path else None
+        self.lock = threading.Lock()
+
+    def sampled(self):
+        return self.file is not None and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def write(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+
+TRACE_WRITER = TraceWriter(TRACE_FILE)
+
+
+def get_trace_writer():
+    return TRACE_WRITER
+
+
+class span:
+    # Times a block as one stage: an otto_stage_seconds observation labelled with the stage, tenant
+    # and outcome, plus a JSON line in the trace file (when enabled) linked to its parent span
+    def __init__(self, stage, **attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        parent = current_span.get()
+        self.sampled = parent["sampled"] if parent else get_trace_writer().sampled()
+        self.record = {
+            "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent["span_id"] if parent else None,
+            "sampled": self.sampled,
+        }
+        self.token = current_span.set(self.record)
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __exit__(self, exc_type, exc, traceback):
+        elapsed = time.perf_counter() - self.started
+        current_span.reset(self.token)
+        status = "error" if exc_type else "ok"
+        tenant = current_tenant.get()
+        get_metrics_registry().observe("stage_seconds", elapsed, stage=self.stage, tenant=tenant, status=status)
+        if self.sampled:
+            get_trace_writer().write(
+                {
+                    "trace_id": self.record["trace_id"],
+                    "span_id": self.record["span_id"],
+                    "parent_id": self.record["parent_id"],
+                    "stage": self.stage,
+                    "tenant": tenant,
+                    "pid": os.getpid(),
+                    "start": self.started_at,
+                    "duration_ms": round(elapsed * 1000, 3),
+                    "status": status,
+                    "error": repr(exc) if exc is not None else None,
+                    **({"attributes": self.attributes} if self.attributes else {}),
+                }
+            )
+        return False
+
+
+def traced(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def set_tenant(tenant_id):
+    current_tenant.set(tenant_id or NO_TENANT)
+
+
+## -------------------------------------------------------------------------------------------------
+## Metrics pages -----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+
+def admin_requested():
+    return bool(ADMIN_TOKEN) and st.query_params.get("admin") == "metrics" and st.query_params.get("token") == ADMIN_TOKEN
+
+
+def render_metrics_page():
+    metrics_text = get_metrics_registry().render_prometheus()
+    st.subheader("Metrics")
+    st.download_button("Download", metrics_text, file_name="otto-metrics.txt")
+    st.code(metrics_text, language="text")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def start_metrics_server(port=METRICS_PORT):
+    # A Prometheus scrape target next to the Streamlit server, started once per process
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", int(port)), MetricsHandler)
+    server.registry = get_metrics_registry()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
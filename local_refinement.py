@@ -0,0 +1,272 @@
+import json
+import threading
+import time
+from collections import Counter, deque
+
+import streamlit as st
+from waii_sdk_py.query import QueryGenerationRequest
+from waii_sdk_py.semantic_context import SemanticStatement
+
+from instrumentation import get_metrics_registry, span
+from result_store import ResultTable, compact_table
+from waii_functions import get_chat_latency_stats, percentile
+
+## -------------------------------------------------------------------------------------------------
+## Local refinement --------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+LOCAL_REFINEMENT = st.secrets[ENV].get("LOCAL_REFINEMENT", True)
+# Waii returns at most this many rows (its max_returned_rows); a result at the cap may be missing
+# rows and is never refined
+WAII_RESULT_ROW_LIMIT = st.secrets[ENV].get("WAII_RESULT_ROW_LIMIT", 10_000)
+# Average warehouse credits one chat question costs; only used to report the credits saved
+WAREHOUSE_CREDITS_PER_QUERY = st.secrets[ENV].get("WAREHOUSE_CREDITS_PER_QUERY")
+PARENT_TABLE = "parent_result"
+AGGREGATE_FUNCTIONS = {
+    "count", "count_star", "sum", "avg", "mean", "min", "max", "median", "mode", "any_value", "first", "last",
+    "stddev", "stddev_pop", "stddev_samp", "variance", "var_pop", "var_samp", "listagg", "string_agg",
+    "array_agg", "list", "approx_count_distinct", "quantile", "quantile_cont", "quantile_disc", "bool_and", "bool_or",
+}
+
+
+def serialize_select(connection, sql):
+    # DuckDB's parse tree for a single SELECT, or None when it is anything else or does not parse
+    serialized = json.loads(connection.execute("SELECT json_serialize_sql(?::VARCHAR)", [sql]).fetchone()[0])
+    if serialized.get("error") or len(serialized["statements"]) != 1:
+        return None
+    return serialized if serialized["statements"][0]["node"]["type"] == "SELECT_NODE" else None
+
+
+def walk(node):
+    if isinstance(node, dict):
+        yield node
+        for value in node.values():
+            yield from walk(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from walk(value)
+
+
+def canonical(node):
+    # Two parse trees compare equal when they differ only in where their text sat in the query
+    def strip(value):
+        if isinstance(value, dict):
+            return {key: strip(item) for key, item in value.items() if key != "query_location"}
+        if isinstance(value, list):
+            return [strip(item) for item in value]
+        return value
+
+    return json.dumps(strip(node), sort_keys=True)
+
+
+def conjuncts(where_clause):
+    if where_clause is None:
+        return []
+    if where_clause["class"] == "CONJUNCTION" and where_clause["type"] == "CONJUNCTION_AND":
+        return [conjunct for child in where_clause["children"] for conjunct in conjuncts(child)]
+    return [where_clause]
+
+
+def is_plain_select(node):
+    # The parent's rows must be exactly the rows its FROM and WHERE select, one per source row:
+    # no grouping, aggregates, windows, DISTINCT, LIMIT or CTEs
+    if node["cte_map"]["map"] or node["group_expressions"] or node["group_sets"] or node["having"] or node["qualify"] or node["sample"]:
+        return False
+    if any(modifier["type"] != "ORDER_MODIFIER" for modifier in node["modifiers"]):
+        return False
+    for expression in walk(node["select_list"]):
+        if expression.get("class") in ("WINDOW", "SUBQUERY"):
+            return False
+        if expression.get("class") == "FUNCTION" and expression["function_name"].lower() in AGGREGATE_FUNCTIONS:
+            return False
+    return True
+
+
+def parent_columns(node, result_columns):
+    # Source column (lower case) -> the parent result's column holding it
+    by_name = {column.lower(): column for column in result_columns}
+    columns = {}
+    for expression in node["select_list"]:
+        if expression["class"] == "STAR" and not expression["exclude_list"] and not expression["replace_list"] and not expression["columns"]:
+            columns.update(by_name)
+        elif expression["class"] == "COLUMN_REF":
+            output = (expression["alias"] or expression["column_names"][-1]).lower()
+            if output in by_name:
+                columns[expression["column_names"][-1].lower()] = by_name[output]
+    return columns
+
+
+def refinement_sql(connection, parent_sql, result_columns, sql):
+    # When `sql` only narrows, orders or aggregates what `parent_sql` selected (same FROM, the
+    # parent's filters plus more, only columns the parent returned), the same query over the
+    # parent's rows; None otherwise
+    parent, child = serialize_select(connection, parent_sql), serialize_select(connection, sql)
+    if parent is None or child is None:
+        return None
+    parent_node, node = parent["statements"][0]["node"], child["statements"][0]["node"]
+    if not is_plain_select(parent_node) or node["cte_map"]["map"] or node["sample"]:
+        return None
+    if canonical(node["from_table"]) != canonical(parent_node["from_table"]):
+        return None
+    parent_filters = {canonical(conjunct) for conjunct in conjuncts(parent_node["where_clause"])}
+    filters = conjuncts(node["where_clause"])
+    if not parent_filters <= {canonical(conjunct) for conjunct in filters}:
+        return None
+    remaining = [conjunct for conjunct in filters if canonical(conjunct) not in parent_filters]
+    if not remaining:
+        node["where_clause"] = None
+    elif len(remaining) == 1:
+        node["where_clause"] = remaining[0]
+    else:
+        node["where_clause"] = {"class": "CONJUNCTION", "type": "CONJUNCTION_AND", "alias": "", "children": remaining}
+
+    columns = parent_columns(parent_node, result_columns)
+    aliases = {expression["alias"].lower() for expression in node["select_list"] if expression["alias"]}
+    for expression in walk({key: value for key, value in node.items() if key != "from_table"}):
+        if expression.get("class") == "SUBQUERY":
+            return None
+        if expression.get("class") == "STAR":
+            expression["relation_name"] = ""
+        if expression.get("class") == "COLUMN_REF":
+            name = expression["column_names"][-1].lower()
+            if name in columns:
+                expression["column_names"] = [columns[name]]
+            elif not (len(expression["column_names"]) == 1 and name in aliases):
+                return None
+    node["from_table"] = {
+        "type": "BASE_TABLE", "alias": "", "sample": None, "catalog_name": "", "schema_name": "",
+        "table_name": PARENT_TABLE, "column_name_alias": [], "at_clause": None,
+    }
+    return connection.execute("SELECT json_deserialize_sql(?::JSON)", [json.dumps(child)]).fetchone()[0]
+
+
+class LocalRefiner:
+    # Follow-ups that refine the previous answer ("only the critical ones", "sort by age", "count
+    # them by asset") are answered with DuckDB over the rows the session already holds. Waii still
+    # writes the SQL (a query generation, which does not touch the warehouse); only when that SQL is
+    # a refinement of the parent query is it run locally, otherwise the question goes to Waii chat
+    def __init__(self, row_limit=WAII_RESULT_ROW_LIMIT, credits_per_query=WAREHOUSE_CREDITS_PER_QUERY, latency_stats=None):
+        import duckdb
+
+        self.database = duckdb.connect()
+        self.row_limit = row_limit
+        self.credits_per_query = credits_per_query
+        self.latency_stats = latency_stats
+        self.counters = Counter()
+        self.local_seconds = deque(maxlen=500)
+        self.seconds_saved = 0.0
+        self.lock = threading.Lock()
+
+    def refine(self, client, question, parent):
+        # Parts of the answer computed locally, or None to fall back to Waii chat.
+        # parent: {"sql", "query_uuid", "data"} of the answer being followed up
+        start = time.perf_counter()
+        try:
+            table = parent["data"].table()
+        except OSError as e:
+            # A spilled parent the session has since discarded
+            print(e)
+            return self._fall_back("parent_missing")
+        if table.num_rows >= self.row_limit:
+            return self._fall_back("parent_truncated")
+        try:
+            with span("refine.generate_query"):
+                generated = client.query.generate(QueryGenerationRequest(ask=question, parent_uuid=parent["query_uuid"]))
+        except Exception as e:
+            print(e)
+            return self._fall_back("generate_error")
+        if not generated.query:
+            return self._fall_back("no_query")
+        # A cursor is a connection of its own, so the parent registered here is private to this job
+        connection = self.database.cursor()
+        try:
+            with span("refine.rewrite"):
+                sql = refinement_sql(connection, parent["sql"], table.column_names, generated.query)
+            if sql is not None:
+                with span("refine.execute", rows=table.num_rows):
+                    connection.register(PARENT_TABLE, table)
+                    result = compact_table(connection.execute(sql).to_arrow_table())
+        except Exception as e:
+            # Snowflake SQL DuckDB cannot run (functions, casts) is answered by Waii instead
+            print(e)
+            return self._fall_back("local_error")
+        finally:
+            connection.close()
+        if sql is None:
+            return self._fall_back("not_a_refinement")
+        elapsed = time.perf_counter() - start
+        self._record(elapsed, table.num_rows)
+        return {
+            "text": f"{result.num_rows:,} rows, refined from the previous answer's {table.num_rows:,} rows without querying the warehouse.\n\n<data>",
+            "sql": generated.query,
+            "query_uuid": generated.uuid,
+            "data": ResultTable(result),
+            "refined_locally": True,
+        }
+
+    def _fall_back(self, reason):
+        with self.lock:
+            self.counters["fallbacks"] += 1
+            self.counters["fallback_" + reason] += 1
+        return None
+
+    def _record(self, elapsed, rows):
+        # Saved per answer: what a chat answer takes right now (median) less the local one
+        chat_seconds = self.latency_stats.summary()["time_to_complete_p50"] if self.latency_stats is not None else None
+        with self.lock:
+            self.counters["local_answers"] += 1
+            self.counters["rows_refined"] += rows
+            self.local_seconds.append(elapsed)
+            if chat_seconds is not None:
+                self.seconds_saved += max(chat_seconds - elapsed, 0.0)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.counters,
+                # Every local answer is a warehouse query Waii did not run
+                "warehouse_queries_avoided": self.counters["local_answers"],
+                "warehouse_credits_saved": self.counters["local_answers"] * self.credits_per_query if self.credits_per_query is not None else None,
+                "local_seconds_p50": percentile(self.local_seconds, 50),
+                "local_seconds_p95": percentile(self.local_seconds, 95),
+                "seconds_saved": self.seconds_saved,
+            }
+
+
+@st.cache_resource
+def get_local_refiner():
+    refiner = LocalRefiner(latency_stats=get_chat_latency_stats())
+    get_metrics_registry().register_collector("local_refinement", refiner.metrics)
+    return refiner
+
+
+def chat_context(messages):
+    # Follow-ups refined locally since the last Waii chat answer are not in Waii's conversation;
+    # the next chat question carries them as context.
+    # The question being asked is already the last message
+    turns = []
+    for index in range(len(messages) - 1, 0, -1):
+        message = messages[index]
+        if message["name"] != "Otto" or not message.get("sql"):
+            continue
+        if not message.get("refined_locally"):
+            break
+        question = messages[index - 1]["text"] if messages[index - 1]["name"] == "user" else ""
+        turns.append(f"Earlier in this conversation the user asked \"{question}\", answered with this SQL:\n{message['sql']}")
+    if not turns:
+        return None
+    return [SemanticStatement(statement=turn) for turn in reversed(turns)]
+
+
+def refinement_parent(messages):
+    # The answer a new question follows up, when it can be refined locally: the last answer, with
+    # its SQL, rows and Waii query. The question itself is already the last message
+    if not LOCAL_REFINEMENT:
+        return None
+    for message in reversed(messages):
+        if message["name"] == "Otto":
+            if message.get("sql") and message.get("query_uuid") and message.get("data") is not None:
+                return {"sql": message["sql"], "query_uuid": message["query_uuid"], "data": message["data"]}
+            return None
+    return None
@@ -0,0 +1,125 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+from instrumentation import get_metrics_registry
+from result_store import ResultTable
+
+## -------------------------------------------------------------------------------------------------
+## Answer cache ------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+ANSWER_CACHE_TTL_SECONDS = 600
+ANSWER_CACHE_MAX_ENTRIES = 1000
+ANSWER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.! ").lower()
+
+
+def question_cache_key(tenant_id, tenant_role, question, parent_questions=()):
+    # Follow-ups are keyed by the whole chain of questions before them, not the parent uuid, so the
+    # same conversation asked in another session is a hit while the same words in a different
+    # conversation are not
+    return (tenant_id, tenant_role, tuple(parent_questions), normalize_question(question))
+
+
+class AnswerCache:
+    def __init__(self, ttl_seconds=ANSWER_CACHE_TTL_SECONDS, max_entries=ANSWER_CACHE_MAX_ENTRIES, max_bytes=ANSWER_CACHE_MAX_BYTES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry["cached_at"] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, message, chat_uuid):
+        # Only the immutable Arrow table is shared; every session gets its own ResultTable around it,
+        # so spilling a result in one session never affects another
+        data = message.get("data")
+        table = data.table() if data is not None else None
+        entry = {
+            "text": message.get("text", ""),
+            "sql": message.get("sql"),
+            "chart": message.get("chart"),
+            "query_uuid": message.get("query_uuid"),
+            "refined_locally": message.get("refined_locally", False),
+            "table": table,
+            "render_cache": message.get("render_cache"),
+            "chat_uuid": chat_uuid,
+            "cached_at": time.time(),
+            "nbytes": table.nbytes if table is not None else 0,
+        }
+        if entry["nbytes"] > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.bytes += entry["nbytes"]
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def remember_render(self, key, render_cache):
+        with self.lock:
+            if key in self.entries and render_cache:
+                self.entries[key]["render_cache"] = render_cache
+
+    def _remove(self, key):
+        self.bytes -= self.entries.pop(key)["nbytes"]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+def message_from_cache(entry):
+    message = {"name": "Otto", "text": entry["text"], "cached_at": entry["cached_at"]}
+    if entry["sql"]:
+        message["sql"] = entry["sql"]
+    if entry["chart"]:
+        message["chart"] = entry["chart"]
+    if entry["query_uuid"]:
+        message["query_uuid"] = entry["query_uuid"]
+    if entry["refined_locally"]:
+        message["refined_locally"] = True
+    if entry["table"] is not None:
+        message["data"] = ResultTable(entry["table"])
+    if entry["render_cache"]:
+        message["render_cache"] = dict(entry["render_cache"])
+    return message
+
+
+@st.cache_resource
+def get_answer_cache():
+    cache = AnswerCache()
+    get_metrics_registry().register_collector("answer_cache", cache.stats)
+    return cache
+
@@ -0,0 +1,295 @@
+import contextvars
+import hashlib
+import hmac
+import os
+import re
+import secrets
+import shutil
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlencode, urlsplit
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import streamlit as st
+
+from instrumentation import get_metrics_registry, span
+from waii_functions import percentile
+
+## -------------------------------------------------------------------------------------------------
+## Result exports ----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+EXPORT_DIR = st.secrets[ENV].get("EXPORT_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".otto", "exports"))
+EXPORT_CACHE_MAX_BYTES = st.secrets[ENV].get("EXPORT_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024)
+# Larger results are exported by a background job the user starts, not when the download is clicked
+EXPORT_BACKGROUND_ROWS = st.secrets[ENV].get("EXPORT_BACKGROUND_ROWS", 100_000)
+EXPORT_WORKERS = st.secrets[ENV].get("EXPORT_WORKERS", 2)
+# st.download_button holds the whole file in memory while it is downloaded; larger exports are only
+# offered through the export server
+EXPORT_DOWNLOAD_MAX_BYTES = st.secrets[ENV].get("EXPORT_DOWNLOAD_MAX_BYTES", 256 * 1024 * 1024)
+# With a port (and the URL it is reachable at), prepared exports are streamed from disk by their own
+# server through signed links; otherwise st.download_button sends them
+EXPORT_PORT = st.secrets[ENV].get("EXPORT_PORT")
+EXPORT_URL = st.secrets[ENV].get("EXPORT_URL")
+# Shared by every process serving the same links; a random key only works within this process
+EXPORT_SIGNING_KEY = st.secrets[ENV].get("EXPORT_SIGNING_KEY") or secrets.token_hex(32)
+EXPORT_LINK_SECONDS = 3600
+EXPORT_CHUNK_ROWS = 64 * 1024
+EXPORT_SEND_BYTES = 1024 * 1024
+EXPORT_OPEN_ATTEMPTS = 3
+XLSX_MAX_ROWS = 1_048_575
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+EXPORT_FILE_NAME = re.compile(r"^[0-9a-f]{40}\.(csv|parquet|xlsx)$")
+
+
+class HashingSink:
+    def __init__(self, digest):
+        self.digest = digest
+        self.closed = False
+
+    def write(self, data):
+        self.digest.update(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def result_digest(result):
+    # A hash of the result's contents, computed once per ResultTable: the same rows (a cached answer
+    # in another session, the same answer restored later) share their exported files. Rows are
+    # hashed in fixed windows so the way Arrow happened to chunk the table does not matter
+    if result.digest is None:
+        table = result.table()
+        digest = hashlib.blake2b(digest_size=20)
+        with span("export.digest", rows=table.num_rows):
+            with pa.ipc.new_stream(pa.PythonFile(HashingSink(digest), mode="w"), table.schema) as writer:
+                for offset in range(0, table.num_rows, EXPORT_CHUNK_ROWS):
+                    writer.write_table(table.slice(offset, EXPORT_CHUNK_ROWS).combine_chunks())
+        result.digest = digest.hexdigest()
+    return result.digest
+
+
+def write_csv(table, path):
+    with pa_csv.CSVWriter(path, table.schema) as writer:
+        for batch in table.to_batches(EXPORT_CHUNK_ROWS):
+            writer.write_batch(batch)
+
+
+def write_parquet(table, path):
+    with pq.ParquetWriter(path, table.schema, compression="zstd") as writer:
+        for batch in table.to_batches(EXPORT_CHUNK_ROWS):
+            writer.write_batch(batch)
+
+
+def write_xlsx(table, path):
+    # constant_memory flushes each row to disk once the next one starts. Excel stops at 1,048,576
+    # rows (with the header), so longer results are cut there
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(path, {"constant_memory": True, "remove_timezone": True})
+    sheet = workbook.add_worksheet("Result")
+    sheet.write_row(0, 0, table.column_names)
+    row = 1
+    for batch in table.slice(0, XLSX_MAX_ROWS).to_batches(EXPORT_CHUNK_ROWS):
+        for values in zip(*(column.to_pylist() for column in batch.columns)):
+            sheet.write_row(row, 0, values)
+            row += 1
+    workbook.close()
+
+
+EXPORT_WRITERS = {"csv": write_csv, "parquet": write_parquet, "xlsx": write_xlsx}
+
+
+class ResultExports:
+    # Exported files on local disk, one per result contents and format, written batch by batch from
+    # the result's Arrow table. The same export requested while it is being written joins the
+    # running one; the least recently used files go once the directory outgrows its budget
+    def __init__(self, directory=EXPORT_DIR, max_bytes=EXPORT_CACHE_MAX_BYTES, workers=EXPORT_WORKERS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+        self.in_flight = {}
+        self.counters = Counter()
+        self.write_seconds = deque(maxlen=500)
+        self.lock = threading.Lock()
+
+    def path(self, digest, export_format):
+        return os.path.join(self.directory, "{0}.{1}".format(digest, export_format))
+
+    def cached(self, result, export_format):
+        # The exported file when it is already on disk; only once the result has been hashed, so
+        # rendering a message never reads or hashes its rows
+        if result.digest is None:
+            return None
+        path = self.path(result.digest, export_format)
+        return path if os.path.exists(path) else None
+
+    def submit(self, result, export_format):
+        # A background export: a future for the exported file's path
+        return self.executor.submit(contextvars.copy_context().run, self.export, result, export_format)
+
+    def export(self, result, export_format):
+        path = self.path(result_digest(result), export_format)
+        with self.lock:
+            running = self.in_flight.get(path)
+            if running is not None:
+                self.counters["coalesced"] += 1
+            elif os.path.exists(path):
+                # Touched, so eviction goes by last use
+                os.utime(path)
+                self.counters["hits"] += 1
+                return path
+            else:
+                writing = self.in_flight[path] = Future()
+        if running is not None:
+            return running.result()
+        try:
+            self._write(result.table(), export_format, path)
+            writing.set_result(path)
+        except Exception as e:
+            print(e)
+            with self.lock:
+                self.counters["failures"] += 1
+            writing.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[path]
+        return path
+
+    def open_file(self, result, export_format):
+        # The exported file, opened for reading: an open file stays readable when it is evicted
+        # meanwhile, and one evicted between exporting and opening it is exported again
+        for attempt in range(EXPORT_OPEN_ATTEMPTS):
+            path = self.export(result, export_format)
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                if attempt == EXPORT_OPEN_ATTEMPTS - 1:
+                    raise
+                with self.lock:
+                    self.counters["evicted_before_read"] += 1
+
+    def _write(self, table, export_format, path):
+        started = time.perf_counter()
+        temporary = path + ".tmp"
+        with span("export.write", format=export_format, rows=table.num_rows):
+            EXPORT_WRITERS[export_format](table, temporary)
+        os.replace(temporary, path)
+        with self.lock:
+            self.counters["written"] += 1
+            self.counters["bytes_written"] += os.path.getsize(path)
+            self.write_seconds.append(time.perf_counter() - started)
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        # Never the file just written, even when it alone is over the budget
+        with self.lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if EXPORT_FILE_NAME.match(entry.name) and entry.path != keep:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            used = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if used <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                used -= size
+                self.counters["evicted"] += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "in_flight": len(self.in_flight),
+                "write_seconds_p50": percentile(self.write_seconds, 50),
+                "write_seconds_p95": percentile(self.write_seconds, 95),
+            }
+
+
+@st.cache_resource
+def get_result_exports():
+    exports = ResultExports()
+    get_metrics_registry().register_collector("exports", exports.metrics)
+    return exports
+
+
+## -------------------------------------------------------------------------------------------------
+## Export downloads --------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+
+def export_signature(name, expires, key=EXPORT_SIGNING_KEY):
+    return hmac.new(key.encode(), "{0}:{1}".format(name, expires).encode(), hashlib.sha256).hexdigest()
+
+
+def export_link(path, file_name, base_url=EXPORT_URL, seconds=EXPORT_LINK_SECONDS):
+    # A link to the export server that works for `seconds`; the file names are content hashes, and
+    # the signature keeps anyone without the link from fetching them
+    name = os.path.basename(path)
+    expires = int(time.time() + seconds)
+    query = urlencode({"expires": expires, "signature": export_signature(name, expires), "file_name": file_name})
+    return "{0}/exports/{1}?{2}".format(base_url.rstrip("/"), name, query)
+
+
+class ExportHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        directory, _, name = url.path.rpartition("/")
+        try:
+            expires = int(query.get("expires", 0))
+        except ValueError:
+            expires = 0
+        if directory != "/exports" or not EXPORT_FILE_NAME.match(name):
+            self.send_error(404)
+            return
+        if expires < time.time() or not hmac.compare_digest(query.get("signature", ""), export_signature(name, expires)):
+            self.send_error(403)
+            return
+        try:
+            file = open(os.path.join(self.server.exports.directory, name), "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with file:
+            # Sent from disk a chunk at a time, however large the file
+            self.send_response(200)
+            self.send_header("Content-Type", EXPORT_FORMATS[name.rsplit(".", 1)[1]])
+            self.send_header("Content-Length", str(os.fstat(file.fileno()).st_size))
+            self.send_header("Content-Disposition", "attachment; filename*=UTF-8''" + quote(query.get("file_name") or name))
+            self.end_headers()
+            shutil.copyfileobj(file, self.wfile, EXPORT_SEND_BYTES)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource
+def start_export_server(port=EXPORT_PORT):
+    # Started once per process, next to the Streamlit server, when configured
+    if not port or not EXPORT_URL:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", int(port)), ExportHandler)
+    server.exports = get_result_exports()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
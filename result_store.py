@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import streamlit as st
+
+from chart_sandbox import widen_table
+
+## -------------------------------------------------------------------------------------------------
+## Compact results ---------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+SESSION_RESULT_BUDGET_BYTES = 64 * 1024 * 1024
+DICTIONARY_ENCODE_MAX_RATIO = 0.5
+INTEGER_TYPES = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+
+
+def compact_column(column):
+    # Repetitive strings become dictionaries, integers the smallest type that holds them,
+    # and floats float32 when that loses nothing
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    if len(column) == 0 or column.null_count == len(column):
+        return column
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        if pc.count_distinct(column).as_py() <= DICTIONARY_ENCODE_MAX_RATIO * len(column):
+            return pc.dictionary_encode(column)
+        return column
+    if pa.types.is_integer(column.type) and pa.types.is_signed_integer(column.type):
+        bounds = pc.min_max(column)
+        low, high = bounds["min"].as_py(), bounds["max"].as_py()
+        for integer_type in INTEGER_TYPES:
+            info = np.iinfo(integer_type.to_pandas_dtype())
+            if info.min <= low and high <= info.max:
+                return column.cast(integer_type)
+        return column
+    if pa.types.is_float64(column.type):
+        narrowed = column.cast(pa.float32(), safe=False)
+        if pc.all(pc.or_kleene(pc.equal(narrowed.cast(pa.float64()), column), pc.is_nan(column))).as_py() is not False:
+            return narrowed
+    return column
+
+
+def compact_table(table):
+    return pa.table([compact_column(column) for column in table.columns], names=table.column_names)
+
+
+def table_from_rows(rows, column_names=None):
+    # Arrow reads Waii's row dicts straight into columns, with no DataFrame in between. The columns
+    # are Waii's column definitions, so a key missing from some rows (even the first) is still a
+    # column; a column mixing types (e.g. numbers and strings) becomes strings on its own
+    names = list(column_names) if column_names else list(dict.fromkeys(key for row in rows for key in row))
+    columns = []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        try:
+            columns.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            columns.append(pa.array([None if value is None else str(value) for value in values], type=pa.string()))
+    return compact_table(pa.table(columns, names=names))
+
+
+class ResultTable:
+    def __init__(self, table):
+        self.id = uuid.uuid4().hex
+        self._table = table
+        self.path = None
+        self.num_rows = table.num_rows
+        self.columns = pd.Index(table.column_names)
+        self.nbytes = table.nbytes
+        self.profile = None
+        self.digest = None
+
+    @classmethod
+    def from_rows(cls, rows, column_names=None):
+        return cls(table_from_rows(rows, column_names))
+
+    @classmethod
+    def from_pandas(cls, df):
+        return cls(compact_table(pa.Table.from_pandas(df, preserve_index=False)))
+
+    @property
+    def shape(self):
+        return (self.num_rows, len(self.columns))
+
+    @property
+    def in_memory(self):
+        return self._table is not None
+
+    def __len__(self):
+        return self.num_rows
+
+    def table(self):
+        if self._table is not None:
+            return self._table
+        # Spilled results are memory-mapped back; the pages stay backed by the file, not the heap
+        with pa.memory_map(self.path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def to_pandas(self):
+        # Chart code expects pandas; the frame is built on demand and not kept, since the chart
+        # figure it feeds is cached with the message
+        return widen_table(self.table()).to_pandas()
+
+    def spill(self, directory):
+        if self._table is None:
+            return 0
+        self.path = os.path.join(directory, self.id + ".arrow")
+        with pa.OSFile(self.path, "wb") as sink, pa.ipc.new_file(sink, self._table.schema) as writer:
+            writer.write_table(self._table)
+        freed = self.nbytes
+        self._table = None
+        return freed
+
+
+class ResultStore:
+    def __init__(self, budget_bytes=SESSION_RESULT_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.results = []
+        self.directory = None
+        self.lock = threading.Lock()
+
+    @property
+    def bytes_in_memory(self):
+        return sum(result.nbytes for result in self.results if result.in_memory)
+
+    def add(self, result):
+        with self.lock:
+            self.results.append(result)
+            self._enforce_budget()
+        return result
+
+    def discard(self, result):
+        # Results of messages that left the conversation window; a spilled one's file goes with it
+        with self.lock:
+            if result in self.results:
+                self.results.remove(result)
+        if result.path is not None and os.path.exists(result.path):
+            os.remove(result.path)
+
+    def _enforce_budget(self):
+        # Oldest results go to disk first; the newest one always stays in memory
+        in_memory = [result for result in self.results[:-1] if result.in_memory]
+        used = self.bytes_in_memory
+        while used > self.budget_bytes and in_memory:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="otto-results-")
+                weakref.finalize(self, shutil.rmtree, self.directory, True)
+            used -= in_memory.pop(0).spill(self.directory)
+
+
+def get_session_result_store():
+    if "result_store" not in st.session_state:
+        st.session_state.result_store = ResultStore()
+    return st.session_state.result_store
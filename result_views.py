@@ -0,0 +1,385 @@
+import hashlib
+import json
+import math
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import streamlit as st
+
+from chart_engine import get_chart_engine
+from chart_sandbox import widen_table
+from instrumentation import traced
+from result_store import ResultTable
+
+## -------------------------------------------------------------------------------------------------
+## Large results -----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+LARGE_RESULT_ROWS = st.secrets[ENV].get("LARGE_RESULT_ROWS", 10_000)
+RESULT_PAGE_ROWS = st.secrets[ENV].get("RESULT_PAGE_ROWS", 1_000)
+CHART_MAX_POINTS = st.secrets[ENV].get("CHART_MAX_POINTS", 2_000)
+CHART_TOP_N = st.secrets[ENV].get("CHART_TOP_N", 20)
+OTHER_LABEL = "Other"
+
+
+def render_table(container, data, key):
+    # Small results go to the browser whole; large ones one page at a time, sliced from the
+    # (possibly memory-mapped) Arrow table without copying
+    table = data.table() if isinstance(data, ResultTable) else pa.Table.from_pandas(data, preserve_index=False)
+    if table.num_rows <= LARGE_RESULT_ROWS:
+        container.dataframe(table, width="stretch")
+        return
+    page_count = math.ceil(table.num_rows / RESULT_PAGE_ROWS)
+    page = container.number_input(f"Page (of {page_count:,})", min_value=1, max_value=page_count, value=1, key=f"page-{key}")
+    start = (page - 1) * RESULT_PAGE_ROWS
+    container.dataframe(table.slice(start, RESULT_PAGE_ROWS), width="stretch")
+    container.caption(f"Rows {start + 1:,}–{min(start + RESULT_PAGE_ROWS, table.num_rows):,} of {table.num_rows:,}")
+
+
+def reduce_figure(fig, max_points=CHART_MAX_POINTS, top_n=CHART_TOP_N):
+    # Works on the built figure, so it applies to Waii's generated code and autoplot alike. Only
+    # traces carrying more than max_points points are reduced; smaller charts are left as drawn
+    bars = [trace for trace in fig.data if trace.type == "bar"]
+    if sum(point_count(trace) for trace in bars) > max_points:
+        aggregate_categories(bars, top_n)
+    for trace in fig.data:
+        if trace.type == "pie" and point_count(trace) > max_points:
+            aggregate_categories([trace], top_n)
+        elif trace.type in ("scatter", "scattergl"):
+            downsample_trace(trace, max_points)
+    return fig
+
+
+def point_count(trace):
+    categories = trace[category_arrays(trace)[0]]
+    return 0 if categories is None else len(categories)
+
+
+def category_arrays(trace):
+    if trace.type == "pie":
+        return "labels", "values"
+    return ("y", "x") if trace.orientation == "h" else ("x", "y")
+
+
+def aggregate_categories(traces, top_n):
+    # Sum repeated categories (what stacked bar segments add up to anyway) and fold everything past
+    # the top_n - 1 largest totals, across all traces, into one "Other" category
+    sums = []
+    totals = defaultdict(float)
+    for trace in traces:
+        category_name, value_name = category_arrays(trace)
+        categories, values = trace[category_name], trace[value_name]
+        if categories is None or values is None or len(categories) <= top_n:
+            sums.append(None)
+            continue
+        summed = pd.Series(np.asarray(values, dtype=float), index=pd.Index(categories)).groupby(level=0, sort=False).sum()
+        sums.append(summed)
+        for category, value in summed.items():
+            totals[category] += value
+    if not totals:
+        return
+    keep = set(pd.Series(totals).nlargest(top_n - 1).index) if len(totals) > top_n else set(totals)
+    for trace, summed in zip(traces, sums):
+        if summed is None:
+            continue
+        category_name, value_name = category_arrays(trace)
+        kept = summed[summed.index.isin(keep)]
+        other = summed[~summed.index.isin(keep)].sum()
+        categories, values = list(kept.index), list(kept.values)
+        if other:
+            categories.append(OTHER_LABEL)
+            values.append(other)
+        clear_point_arrays(trace)
+        trace[category_name], trace[value_name] = categories, values
+
+
+def downsample_trace(trace, max_points):
+    if trace.y is None or len(trace.y) <= max_points:
+        return
+    y = np.asarray(trace.y)
+    if "lines" in (trace.mode or "lines") and np.issubdtype(y.dtype, np.number):
+        indices = min_max_indices(y.astype(float), max(1, (max_points - 2) // 2))
+    else:
+        indices = np.linspace(0, len(y) - 1, max_points).astype(int)
+    x = np.asarray(trace.x) if trace.x is not None else np.arange(len(y))
+    clear_point_arrays(trace)
+    trace.x, trace.y = x[indices], y[indices]
+
+
+def min_max_indices(y, buckets):
+    # Keep each bucket's lowest and highest point, so peaks and dips survive the downsampling
+    size = math.ceil(len(y) / buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[: len(y)] = y
+    rows = padded.reshape(buckets, size)
+    lows = np.where(np.isnan(rows), np.inf, rows)
+    highs = np.where(np.isnan(rows), -np.inf, rows)
+    offsets = np.arange(buckets) * size
+    indices = np.concatenate(
+        [
+            (offsets + lows.argmin(axis=1))[np.isfinite(lows.min(axis=1))],
+            (offsets + highs.argmax(axis=1))[np.isfinite(highs.max(axis=1))],
+            [0, len(y) - 1],
+        ]
+    )
+    return np.unique(indices[indices < len(y)])
+
+
+def clear_point_arrays(trace):
+    # Per-point extras no longer line up once points are merged or dropped
+    for name in ("customdata", "hovertext", "text", "ids"):
+        if name in trace and trace[name] is not None:
+            trace[name] = None
+    for name in ("marker.color", "marker.colors"):
+        if name in trace and trace[name] is not None and not isinstance(trace[name], str):
+            trace[name] = None
+    if trace.hovertemplate and "customdata" in trace.hovertemplate:
+        trace.hovertemplate = None
+
+
+## -------------------------------------------------------------------------------------------------
+## Chart recommendation ----------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+PROFILE_SAMPLE_ROWS = 100_000
+PIE_MAX_CATEGORIES = 6
+SUNBURST_MAX_CATEGORIES = 20
+
+
+def arrow_kind(data_type):
+    if pa.types.is_dictionary(data_type):
+        data_type = data_type.value_type
+    if pa.types.is_boolean(data_type):
+        return "boolean"
+    if pa.types.is_integer(data_type) or pa.types.is_floating(data_type) or pa.types.is_decimal(data_type):
+        return "numeric"
+    if pa.types.is_temporal(data_type):
+        return "temporal"
+    if pa.types.is_string(data_type) or pa.types.is_large_string(data_type):
+        return "categorical"
+    return "other"
+
+
+def pandas_kind(series):
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return "boolean"
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return "temporal"
+    # Object columns are classified from their values instead of being converted
+    inferred = pd.api.types.infer_dtype(series.dropna().iloc[:1000], skipna=True)
+    if inferred in ("integer", "floating", "mixed-integer-float", "decimal"):
+        return "numeric"
+    if inferred in ("datetime", "datetime64", "date"):
+        return "temporal"
+    if inferred == "boolean":
+        return "boolean"
+    return "categorical"
+
+
+def profile_result(data):
+    # Column kinds come from the schema and cardinalities from an evenly spaced sample, so profiling
+    # takes bounded time and copies at most the sample; the profile is kept with the result
+    if isinstance(data, ResultTable):
+        if data.profile is None:
+            data.profile = profile_table(data.table())
+        return data.profile
+    # pandas copies attrs onto derived frames, so a frame's profile is only reused if it still fits
+    profile = data.attrs.get("profile")
+    if profile is None or profile["rows"] != len(data) or [column["name"] for column in profile["columns"]] != list(data.columns):
+        profile = data.attrs["profile"] = profile_frame(data)
+    return profile
+
+
+def profile_table(table):
+    step = max(1, table.num_rows // PROFILE_SAMPLE_ROWS)
+    sample = table if step == 1 else table.take(pa.array(range(0, table.num_rows, step)))
+    columns = []
+    for field in table.schema:
+        columns.append({"name": field.name, "kind": arrow_kind(field.type), "distinct": count_distinct(sample[field.name])})
+    return {"rows": table.num_rows, "sampled": step > 1, "columns": columns}
+
+
+def count_distinct(column):
+    if pa.types.is_dictionary(column.type):
+        return len(pc.unique(column)) - (1 if column.null_count else 0)
+    return pc.count_distinct(column).as_py()
+
+
+def profile_frame(df):
+    step = max(1, len(df) // PROFILE_SAMPLE_ROWS)
+    sample = df.iloc[::step]
+    columns = []
+    for index, name in enumerate(df.columns):
+        column = sample.iloc[:, index]
+        columns.append({"name": name, "kind": pandas_kind(column), "distinct": int(column.nunique())})
+    return {"rows": len(df), "sampled": step > 1, "columns": columns}
+
+
+def recommend_chart(profile, chart_type=None):
+    columns = profile["columns"]
+    if profile["rows"] < 2 or not columns:
+        return None
+    dimensions = [column for column in columns if column["kind"] in ("categorical", "temporal", "boolean")]
+    measures = [column for column in columns if column["kind"] == "numeric"]
+
+    # The first column is the x axis when it is a dimension, as Waii usually puts the label first
+    x = columns[0] if columns[0]["kind"] != "numeric" else (dimensions[0] if dimensions else columns[0])
+    y = next((column for column in measures if column is not x), None)
+    if y is None:
+        # Only labels: count rows per category
+        return {"type": chart_type or "bar", "x": x["name"], "y": None, "path": [x["name"]]} if x["kind"] != "numeric" else None
+
+    if chart_type is None:
+        if x["kind"] == "temporal":
+            chart_type = "line"
+        elif x["kind"] == "numeric":
+            chart_type = "scatter"
+        elif len(dimensions) >= 2 and all(column["distinct"] <= SUNBURST_MAX_CATEGORIES for column in dimensions[:3]):
+            chart_type = "sunburst"
+        elif x["distinct"] <= PIE_MAX_CATEGORIES:
+            chart_type = "pie"
+        else:
+            chart_type = "bar"
+    path = [x["name"]] + [column["name"] for column in dimensions if column is not x and column["kind"] == "categorical"][:2]
+    return {"type": chart_type, "x": x["name"], "y": y["name"], "path": path}
+
+
+def chart_frame(data, spec, max_points=CHART_MAX_POINTS, top_n=CHART_TOP_N):
+    # Reduce to what the chart will show before plotly sees it: sums per category (or per path)
+    # for bar/pie/sunburst, min/max-preserving samples for line and scatter
+    names = list(dict.fromkeys([spec["x"]] + spec["path"] + ([spec["y"]] if spec["y"] else [])))
+    if isinstance(data, ResultTable):
+        table = widen_table(data.table().select(names))
+    else:
+        frame = data[names]
+        if spec["y"] and not pd.api.types.is_numeric_dtype(frame[spec["y"]].dtype):
+            frame = frame.assign(**{spec["y"]: pd.to_numeric(frame[spec["y"]], errors="coerce")})
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+
+    if spec["y"] is None:
+        counted = table.group_by([spec["x"]]).aggregate([([], "count_all")]).rename_columns([spec["x"], "count"])
+        return top_categories(counted, spec["x"], "count", max_points, top_n)
+    if spec["type"] in ("bar", "pie"):
+        summed = table.group_by([spec["x"]]).aggregate([(spec["y"], "sum")]).rename_columns([spec["x"], spec["y"]])
+        return top_categories(summed, spec["x"], spec["y"], max_points, top_n)
+    if spec["type"] == "sunburst":
+        return table.group_by(spec["path"]).aggregate([(spec["y"], "sum")]).rename_columns(spec["path"] + [spec["y"]]).to_pandas()
+    if spec["type"] == "line":
+        table = table.take(pc.sort_indices(table, sort_keys=[(spec["x"], "ascending")]))
+        if table.num_rows > max_points:
+            y = table[spec["y"]].to_numpy(zero_copy_only=False).astype(float)
+            table = table.take(pa.array(min_max_indices(y, max(1, (max_points - 2) // 2))))
+        return table.to_pandas()
+    if table.num_rows > max_points:
+        table = table.take(pa.array(np.linspace(0, table.num_rows - 1, max_points).astype(int)))
+    return table.to_pandas()
+
+
+def top_categories(summed, category, value, max_points, top_n):
+    # Same top-N plus "Other" folding as reduce_figure, done on the grouped Arrow table so plotly
+    # never sees more than max_points categories
+    if summed.num_rows <= max_points:
+        return summed.to_pandas()
+    order = pc.sort_indices(summed, sort_keys=[(value, "descending")])
+    top = summed.take(order[: top_n - 1]).to_pandas()
+    other = pc.sum(summed.take(order[top_n - 1 :])[value]).as_py()
+    top[category] = top[category].astype(object)
+    top.loc[len(top)] = [OTHER_LABEL, other]
+    return top
+
+
+## -------------------------------------------------------------------------------------------------
+## Chart figures -----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+PLOT_BGCOLOR = "#244466"
+
+
+@traced("chart.autoplot")
+def autoplot(df_, chart_type=None):
+    # Works from the result's cached column profile; chart_type overrides the recommended type.
+    # plotly is imported on first use, so sessions that never draw a chart do not pay for it
+    import plotly.express as px
+
+    spec = recommend_chart(profile_result(df_), chart_type)
+    if spec is None:
+        return None
+    df = chart_frame(df_, spec)
+    y_col = spec["y"] or "count"
+    if spec["type"] == "bar":
+        fig = px.bar(df, x=spec["x"], y=y_col)
+    elif spec["type"] == "line":
+        fig = px.line(df, x=spec["x"], y=y_col)
+    elif spec["type"] == "pie":
+        fig = px.pie(df, values=y_col, names=spec["x"])
+    elif spec["type"] == "sunburst":
+        fig = px.sunburst(df, path=spec["path"], values=y_col)
+    elif spec["type"] == "scatter":
+        fig = px.scatter(df, x=spec["x"], y=y_col)
+    else:
+        raise ValueError("Invalid chart type")
+    return reduce_figure(fig)
+
+
+def styled_figure_json(fig):
+    import plotly.io as pio
+
+    # Streamlit's chart theme replaces plotly's default template anyway, and leaving it out of the
+    # stored figure makes redrawing it several times cheaper
+    if fig.layout.template == pio.templates[pio.templates.default]:
+        fig.layout.template = {}
+    fig.update_layout(paper_bgcolor=PLOT_BGCOLOR, plot_bgcolor=PLOT_BGCOLOR)
+    return reduce_figure(fig).to_json()
+
+
+@traced("chart.build")
+def chart_figure_json(data, waii_chart_spec):
+    # Waii's code runs in the chart engine's worker processes, never on the session's thread; only
+    # the figure's JSON comes back, and it is reduced here like any other figure
+    import plotly.graph_objects as go
+
+    table = data.table() if isinstance(data, ResultTable) else pa.Table.from_pandas(data, preserve_index=False)
+    figure_json = get_chart_engine(PLOT_BGCOLOR).render(waii_chart_spec, table)
+    return reduce_figure(go.Figure(json.loads(figure_json))).to_json()
+
+
+def message_hash(message):
+    digest = hashlib.sha1()
+    for part in ("text", "sql", "chart"):
+        digest.update(repr(message.get(part)).encode())
+    if message.get("data") is not None:
+        digest.update(repr((message["data"].shape, list(message["data"].columns))).encode())
+    return digest.hexdigest()
+
+
+def cached_chart_figure(message, df):
+    # The figure is built once per message and kept in the message record, so reruns redraw it from
+    # JSON instead of executing the chart code again; a changed message gets a fresh entry. None when
+    # there are no rows to draw from (a chart-only answer)
+    if df is None:
+        return None
+    key = message_hash(message)
+    render_cache = message.get("render_cache")
+    if render_cache is None or render_cache["key"] != key:
+        render_cache = {"key": key, "figure": None, "error": None}
+        try:
+            render_cache["figure"] = chart_figure_json(df, message["chart"])
+        except Exception as e:
+            print("Error rendering chart. This was the code:\n\n", message["chart"], "\n\nThis was the error:", e)
+            render_cache["error"] = str(e)
+            try:
+                # Fall back to a chart recommended from the data itself
+                fig = autoplot(df)
+                if fig is not None:
+                    render_cache["figure"] = styled_figure_json(fig)
+            except Exception as e:
+                # Rows spilled to disk and since discarded cannot be drawn either
+                print("Error drawing a chart from the data:", e)
+        message["render_cache"] = render_cache
+    return render_cache
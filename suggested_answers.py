@@ -0,0 +1,283 @@
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+import streamlit as st
+from waii_sdk_py.chat import ChatRequest
+
+from chat_jobs import CHAT_JOB_POLL_SECONDS, COMPLETED, get_chat_job_queue
+from conversation_store import decode_result, encode_result
+from instrumentation import get_metrics_registry, set_tenant, span
+from result_cache import normalize_question, question_cache_key
+from result_store import ResultTable
+from result_views import cached_chart_figure
+from waii_functions import SUGGESTED_QUESTIONS, get_waii_client_registry
+
+## -------------------------------------------------------------------------------------------------
+## Suggested answers -------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+# Refreshing costs warehouse time for every active tenant, so it stays opt-in; answers already on
+# disk are served either way
+WARM_UP_SUGGESTED_QUESTIONS = st.secrets[ENV].get("WARM_UP_SUGGESTED_QUESTIONS", False)
+SUGGESTED_ANSWERS_DIR = st.secrets[ENV].get(
+    "SUGGESTED_ANSWERS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".otto", "suggested")
+)
+SUGGESTED_REFRESH_SECONDS = st.secrets[ENV].get("SUGGESTED_REFRESH_SECONDS", 3600)
+# At most one tenant refreshes at a time, and the next one starts this long after it finished
+SUGGESTED_STAGGER_SECONDS = st.secrets[ENV].get("SUGGESTED_STAGGER_SECONDS", 5)
+# Tenants nobody has signed in from for this long are no longer refreshed
+SUGGESTED_IDLE_SECONDS = st.secrets[ENV].get("SUGGESTED_IDLE_SECONDS", 7 * 24 * 3600)
+# Older answers are not served (a refresh that keeps failing must not show last week's data)
+SUGGESTED_MAX_AGE_SECONDS = st.secrets[ENV].get("SUGGESTED_MAX_AGE_SECONDS", 24 * 3600)
+TENANT_FILE = "tenant.json"
+
+
+def file_key(*parts):
+    return hashlib.sha1("\0".join(parts).encode()).hexdigest()[:16]
+
+
+def write_atomic(path, data):
+    # A reader (or a restart) never sees half a file: the old one stays until the new one is complete
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+class SuggestedAnswers:
+    # The sidebar's questions answered ahead of time for every active tenant role and kept on disk:
+    # text, SQL, rows (Arrow IPC) and the drawn Plotly figure. A background thread refreshes one
+    # tenant at a time; each tenant has a fixed slot in the refresh interval (from a hash of its
+    # key), so tenants that signed in together do not all hit the warehouse together
+    def __init__(
+        self,
+        chat_job_queue,
+        client_factory,
+        directory=SUGGESTED_ANSWERS_DIR,
+        refresh_seconds=SUGGESTED_REFRESH_SECONDS,
+        stagger_seconds=SUGGESTED_STAGGER_SECONDS,
+        idle_seconds=SUGGESTED_IDLE_SECONDS,
+        max_age_seconds=SUGGESTED_MAX_AGE_SECONDS,
+        questions=SUGGESTED_QUESTIONS,
+        refresh=WARM_UP_SUGGESTED_QUESTIONS,
+    ):
+        self.chat_job_queue = chat_job_queue
+        self.client_factory = client_factory
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self.stagger_seconds = stagger_seconds
+        self.idle_seconds = idle_seconds
+        self.max_age_seconds = max_age_seconds
+        self.questions = questions
+        self.tenants = {}
+        self.answers = {}
+        self.counters = Counter()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+        if refresh:
+            threading.Thread(target=self._refresh_loop, name="suggested-answers", daemon=True).start()
+
+    def _load(self):
+        # Answers materialized before a restart are served straight away, and their tenants keep
+        # being refreshed while they are active
+        for name in os.listdir(self.directory):
+            tenant_directory = os.path.join(self.directory, name)
+            try:
+                with open(os.path.join(tenant_directory, TENANT_FILE)) as file:
+                    tenant = json.load(file)
+                key = (tenant["tenant_id"], tenant["tenant_role"])
+                data_files = set()
+                for file_name in os.listdir(tenant_directory):
+                    if file_name.endswith(".json") and file_name != TENANT_FILE:
+                        with open(os.path.join(tenant_directory, file_name)) as file:
+                            entry = json.load(file)
+                        self.answers[key + (normalize_question(entry["question"]),)] = {**entry, "table": None}
+                        data_files.add(entry["data_file"])
+                # Rows left behind by a refresh that stopped halfway
+                for file_name in os.listdir(tenant_directory):
+                    if file_name.endswith((".arrow", ".tmp")) and file_name not in data_files:
+                        os.remove(os.path.join(tenant_directory, file_name))
+            except (OSError, ValueError, KeyError) as e:
+                print("Skipping suggested answers in {0}: {1}".format(tenant_directory, e))
+                continue
+            self.tenants[key] = {"active_at": tenant["active_at"], "next_refresh": self._next_refresh(key)}
+
+    def _tenant_directory(self, tenant_id, tenant_role):
+        return os.path.join(self.directory, file_key(tenant_id, tenant_role))
+
+    def _refreshed_at(self, key):
+        # When the tenant's answers were last all refreshed; None while any is missing
+        entries = [self.answers.get(key + (normalize_question(question),)) for question in self.questions]
+        return None if None in entries else min(entry["refreshed_at"] for entry in entries)
+
+    def _next_refresh(self, key):
+        # The tenant's first slot at least half an interval after its last refresh; now if it has none
+        refreshed_at = self._refreshed_at(key)
+        if refreshed_at is None:
+            return time.time()
+        phase = int(file_key(*key), 16) % self.refresh_seconds
+        earliest = refreshed_at + self.refresh_seconds / 2
+        return phase + math.ceil((earliest - phase) / self.refresh_seconds) * self.refresh_seconds
+
+    def register(self, tenant_id, tenant_role):
+        # Called on every run of a signed-in session: keeps the tenant's answers refreshed
+        key = (tenant_id, tenant_role)
+        with self.lock:
+            tenant = self.tenants.get(key)
+            if tenant is None:
+                tenant = self.tenants[key] = {"next_refresh": self._next_refresh(key)}
+                self.wake.set()
+            tenant["active_at"] = time.time()
+
+    def get(self, tenant_id, tenant_role, question):
+        # The materialized answer as a message and its Waii conversation, or None
+        key = (tenant_id, tenant_role, normalize_question(question))
+        with self.lock:
+            entry = self.answers.get(key)
+        if entry is None or time.time() - entry["refreshed_at"] > self.max_age_seconds:
+            return None
+        table = entry["table"]
+        if table is None and entry["data_file"]:
+            try:
+                with open(os.path.join(self._tenant_directory(tenant_id, tenant_role), entry["data_file"]), "rb") as file:
+                    table = decode_result(file.read()).table()
+            except OSError as e:
+                # Replaced by a refresh in the meantime
+                print(e)
+                return None
+            with self.lock:
+                if self.answers.get(key) is entry:
+                    entry["table"] = table
+        message = {"name": "Otto", "text": entry["text"], "precomputed_at": entry["refreshed_at"]}
+        for part in ("sql", "query_uuid", "chart"):
+            if entry.get(part):
+                message[part] = entry[part]
+        if table is not None:
+            message["data"] = ResultTable(table)
+        if entry.get("render_cache"):
+            message["render_cache"] = dict(entry["render_cache"])
+        with self.lock:
+            self.counters["served"] += 1
+        return message, entry["chat_uuid"]
+
+    def _refresh_loop(self):
+        while True:
+            self.wake.clear()
+            now = time.time()
+            with self.lock:
+                due = [(tenant["next_refresh"], key) for key, tenant in self.tenants.items() if now - tenant["active_at"] <= self.idle_seconds]
+            if not due:
+                self.wake.wait()
+                continue
+            next_refresh, key = min(due)
+            if next_refresh > now:
+                # A newly registered tenant wakes the loop early
+                self.wake.wait(next_refresh - now)
+                continue
+            self.refresh_tenant(*key)
+            time.sleep(self.stagger_seconds)
+
+    def refresh_tenant(self, tenant_id, tenant_role):
+        # Through the chat job queue, so refreshes count against the same Waii slots as users and a
+        # user asking the same question meanwhile joins the refresh instead of sending another
+        set_tenant(tenant_id)
+        try:
+            with span("suggested.refresh_tenant"):
+                client = self.client_factory(tenant_role)
+                for question in self.questions:
+                    self._refresh_question(client, tenant_id, tenant_role, question)
+        except Exception as e:
+            print(e)
+            with self.lock:
+                self.counters["failures"] += 1
+        key = (tenant_id, tenant_role)
+        with self.lock:
+            self.counters["tenant_refreshes"] += 1
+            self.tenants[key]["next_refresh"] = max(self._next_refresh(key), time.time() + self.refresh_seconds / 2)
+
+    def _refresh_question(self, client, tenant_id, tenant_role, question):
+        try:
+            job = self.chat_job_queue.submit(question_cache_key(tenant_id, tenant_role, question), client, ChatRequest(ask=question))
+        except RuntimeError as e:
+            # The queue is full of users' questions; this one waits for the next refresh
+            print(e)
+            with self.lock:
+                self.counters["skipped"] += 1
+            return
+        while not job.done:
+            time.sleep(CHAT_JOB_POLL_SECONDS)
+        if job.status != COMPLETED or not job.parts.get("text"):
+            with self.lock:
+                self.counters["failures"] += 1
+            return
+        message = job.message()
+        if message.get("chart") and message.get("data") is not None:
+            with span("suggested.draw_chart"):
+                cached_chart_figure(message, message["data"])
+        self._store(tenant_id, tenant_role, question, message, job.chat_uuid)
+
+    def _store(self, tenant_id, tenant_role, question, message, chat_uuid):
+        # Rows first, then the answer that points at them, then the tenant record
+        refreshed_at = time.time()
+        tenant_directory = self._tenant_directory(tenant_id, tenant_role)
+        os.makedirs(tenant_directory, exist_ok=True)
+        name = file_key(normalize_question(question))
+        table = message["data"].table() if message.get("data") is not None else None
+        data_file = None
+        if table is not None:
+            blob = encode_result(message["data"])
+            if blob is not None:
+                data_file = "{0}-{1}.arrow".format(name, int(refreshed_at * 1000))
+                write_atomic(os.path.join(tenant_directory, data_file), blob)
+        entry = {
+            "question": question,
+            "text": message["text"],
+            "sql": message.get("sql"),
+            "query_uuid": message.get("query_uuid"),
+            "chart": message.get("chart"),
+            "render_cache": message.get("render_cache"),
+            "chat_uuid": chat_uuid,
+            "refreshed_at": refreshed_at,
+            "data_file": data_file,
+        }
+        write_atomic(os.path.join(tenant_directory, name + ".json"), json.dumps(entry).encode())
+        key = (tenant_id, tenant_role)
+        with self.lock:
+            active_at = self.tenants.get(key, {}).get("active_at", refreshed_at)
+            previous = self.answers.get(key + (normalize_question(question),))
+            self.answers[key + (normalize_question(question),)] = {**entry, "table": table}
+            self.counters["answers_refreshed"] += 1
+        tenant = {"tenant_id": tenant_id, "tenant_role": tenant_role, "active_at": active_at}
+        write_atomic(os.path.join(tenant_directory, TENANT_FILE), json.dumps(tenant).encode())
+        if previous is not None and previous["data_file"] and previous["data_file"] != data_file:
+            try:
+                os.remove(os.path.join(tenant_directory, previous["data_file"]))
+            except OSError:
+                pass
+
+    def metrics(self):
+        with self.lock:
+            now = time.time()
+            ages = [now - entry["refreshed_at"] for entry in self.answers.values()]
+            return {
+                **self.counters,
+                "tenants": len(self.tenants),
+                "active_tenants": sum(now - tenant["active_at"] <= self.idle_seconds for tenant in self.tenants.values()),
+                "answers": len(self.answers),
+                "oldest_answer_seconds": max(ages) if ages else None,
+            }
+
+
+@st.cache_resource
+def get_suggested_answers():
+    suggested = SuggestedAnswers(get_chat_job_queue(), get_waii_client_registry().get)
+    get_metrics_registry().register_collector("suggested_answers", suggested.metrics)
+    return suggested
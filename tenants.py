@@ -0,0 +1,112 @@
+import threading
+from typing import NamedTuple
+
+import streamlit as st
+
+## -------------------------------------------------------------------------------------------------
+## Tenant index ------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+
+
+class Tenant(NamedTuple):
+    name: str
+    tenant_id: str
+    role: str
+    domain: str
+
+
+class DomainTrieNode:
+    __slots__ = ("children", "exact", "wildcard")
+
+    def __init__(self):
+        self.children = {}
+        self.exact = None
+        self.wildcard = None
+
+
+def normalize_domain(domain):
+    return domain.strip().strip(".").lower()
+
+
+class TenantIndex:
+    # Built once from TENANTS_BY_DOMAIN and never changed. Domains are stored label by label from the
+    # top-level domain down, so a lookup costs the number of labels in the address whatever the
+    # number of tenants. "acme.com" matches only acme.com; "*.acme.com" matches any subdomain of it;
+    # the most specific entry wins
+    def __init__(self, tenants_by_domain, version=1):
+        self.version = version
+        self.root = DomainTrieNode()
+        self.size = 0
+        for domain, config in tenants_by_domain.items():
+            try:
+                tenant = Tenant(config["NAME"], config["TENANT_ID"], config["ROLE"], normalize_domain(domain))
+            except (KeyError, TypeError) as e:
+                print("Skipping tenant {0}: missing {1}".format(domain, e))
+                continue
+            self._insert(tenant)
+
+    def _insert(self, tenant):
+        wildcard = tenant.domain.startswith("*.")
+        node = self.root
+        for label in reversed((tenant.domain[2:] if wildcard else tenant.domain).split(".")):
+            node = node.children.setdefault(label, DomainTrieNode())
+        if wildcard:
+            node.wildcard = tenant
+        else:
+            node.exact = tenant
+        self.size += 1
+
+    def lookup(self, domain):
+        labels = normalize_domain(domain).split(".")
+        node = self.root
+        match = None
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.children.get(label)
+            if node is None:
+                return match
+            # A wildcard covers names with at least one more label below it
+            if node.wildcard is not None and depth < len(labels):
+                match = node.wildcard
+        return node.exact if node.exact is not None else match
+
+    def resolve(self, email):
+        # The tenant for a user's email address, or None when their domain has no tenant
+        _, at, domain = email.rpartition("@")
+        return self.lookup(domain) if at else None
+
+    def __len__(self):
+        return self.size
+
+
+def load_tenants_by_domain():
+    return st.secrets.to_dict()[ENV].get("TENANTS_BY_DOMAIN", {})
+
+
+class TenantDirectory:
+    # Holds the current index; when the secrets file changes a new index is built and swapped in,
+    # and its version tells sessions to resolve their tenant again
+    def __init__(self, load=load_tenants_by_domain):
+        self.load = load
+        self.index = TenantIndex(load())
+        self.lock = threading.Lock()
+
+    def reload(self, *args, **kwargs):
+        with self.lock:
+            try:
+                self.index = TenantIndex(self.load(), self.index.version + 1)
+            except Exception as e:
+                # A broken secrets file keeps the last good index
+                print(e)
+
+
+@st.cache_resource
+def get_tenant_directory():
+    directory = TenantDirectory()
+    st.secrets.file_change_listener.connect(directory.reload, weak=False)
+    return directory
+
+
+def get_tenant_index():
+    return get_tenant_directory().index
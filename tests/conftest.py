@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from benchmarks.support import offline_secrets, use_secrets
+
+# The app modules read st.secrets when imported
+use_secrets(offline_secrets())
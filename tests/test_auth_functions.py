@@ -0,0 +1,107 @@
+import asyncio
+import time
+
+import pytest
+import requests
+
+import auth_functions
+from auth_functions import AuthApiClient, CircuitBreaker, CircuitOpenError
+from benchmarks.fake_identity_toolkit import FakeIdentityToolkit
+
+
+def test_rejected_token_leaves_no_account_info_fetch_behind(monkeypatch):
+    def slow_account_info(id_token):
+        time.sleep(0.3)
+        return {"users": [{"emailVerified": True}]}
+
+    def reject(id_token):
+        raise ValueError("Token expired")
+
+    monkeypatch.setattr(auth_functions, "FIREBASE_PROJECT_ID", "otto-project")
+    monkeypatch.setattr(auth_functions, "sign_in_with_email_and_password", lambda email, password: {"idToken": "token"})
+    monkeypatch.setattr(auth_functions, "get_account_info", slow_account_info)
+    monkeypatch.setattr(auth_functions, "verify_id_token", reject)
+
+    async def attempt():
+        with pytest.raises(ValueError, match="expired"):
+            await auth_functions.sign_in_async("analyst@example.com", "hunter22")
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(attempt()) == []
+
+
+@pytest.fixture
+def identity_toolkit():
+    fake = FakeIdentityToolkit(latency=0).start()
+    fake.add_user("analyst@example.com", "hunter22")
+    yield fake
+    fake.stop()
+
+
+def account_info_payload(fake):
+    return {"idToken": fake.mint_id_token("analyst@example.com")}
+
+
+def test_server_errors_are_retried_until_one_succeeds(identity_toolkit):
+    client = AuthApiClient(identity_toolkit.relyingparty_url, "fake-key", backoff_seconds=0)
+    identity_toolkit.fail_next(2)
+    assert client.post("getAccountInfo", account_info_payload(identity_toolkit))["users"]
+    assert identity_toolkit.calls["getAccountInfo"] == 3
+    assert (client.retries, client.failures, client.circuit_breaker.state) == (2, 0, "closed")
+
+
+def test_exhausted_retries_raise_and_count_one_failure(identity_toolkit):
+    client = AuthApiClient(identity_toolkit.relyingparty_url, "fake-key", max_retries=2, backoff_seconds=0)
+    identity_toolkit.fail_next(3)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.post("getAccountInfo", account_info_payload(identity_toolkit))
+    assert identity_toolkit.calls["getAccountInfo"] == 3
+    assert (client.retries, client.failures) == (2, 1)
+
+
+def test_calls_with_side_effects_are_only_retried_when_rate_limited(identity_toolkit):
+    client = AuthApiClient(identity_toolkit.relyingparty_url, "fake-key", backoff_seconds=0)
+    identity_toolkit.fail_next(1, status=503)
+    with pytest.raises(requests.exceptions.HTTPError):
+        client.post("getOobConfirmationCode", {"requestType": "VERIFY_EMAIL"}, retry_server_errors=False)
+    identity_toolkit.fail_next(1, status=429)
+    client.post("getOobConfirmationCode", {"requestType": "VERIFY_EMAIL"}, retry_server_errors=False)
+    assert identity_toolkit.calls["getOobConfirmationCode"] == 3
+
+
+def test_client_errors_are_neither_retried_nor_counted_against_the_circuit(identity_toolkit):
+    client = AuthApiClient(identity_toolkit.relyingparty_url, "fake-key", backoff_seconds=0, circuit_breaker=CircuitBreaker(failure_threshold=1))
+    with pytest.raises(requests.exceptions.HTTPError, match="INVALID_PASSWORD"):
+        client.post("verifyPassword", {"email": "analyst@example.com", "password": "wrong"})
+    assert identity_toolkit.calls["verifyPassword"] == 1
+    assert (client.retries, client.failures, client.circuit_breaker.state) == (0, 0, "closed")
+
+
+def test_open_circuit_fails_fast_without_calling_upstream(identity_toolkit):
+    client = AuthApiClient(identity_toolkit.relyingparty_url, "fake-key", max_retries=0, circuit_breaker=CircuitBreaker(failure_threshold=2))
+    identity_toolkit.fail_next(2)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.post("getAccountInfo", account_info_payload(identity_toolkit))
+    with pytest.raises(CircuitOpenError):
+        client.post("getAccountInfo", account_info_payload(identity_toolkit))
+    assert identity_toolkit.calls["getAccountInfo"] == 2
+    assert client.circuit_breaker.state == "open"
+
+
+def test_half_open_circuit_closes_on_success_and_reopens_on_one_failure():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    breaker.opened_at -= 30
+    assert breaker.state == "half-open"
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    breaker.opened_at -= 30
+    breaker.record_success()
+    assert (breaker.state, breaker.failures) == ("closed", 0)
@@ -0,0 +1,48 @@
+import json
+
+import pyarrow as pa
+import pytest
+
+from chart_engine import ChartCodeError, ChartEngine, chart_error
+from result_store import ResultTable
+
+TABLE = pa.table({"SEVERITY": ["critical", "high"], "CVSS_SCORE": [9.8, 7.5]})
+
+
+@pytest.fixture(scope="module")
+def engine():
+    return ChartEngine("#244466", workers=1)
+
+
+def test_figure_comes_back_as_json(engine):
+    code = "import plotly.express as px\nimport streamlit as st\nst.plotly_chart(px.bar(df, x='SEVERITY', y='CVSS_SCORE'))"
+    figure = json.loads(engine.render(code, TABLE))
+    assert figure["data"][0]["type"] == "bar"
+
+
+def test_chart_code_error_is_rebuilt_from_json(engine):
+    with pytest.raises(KeyError, match="ASSET"):
+        engine.render("fig = df['ASSET']", TABLE)
+
+
+def test_chart_code_sees_wide_dtypes(engine):
+    # Stored results are compacted to int8 and float32 here; the chart code must not see that
+    data = ResultTable.from_rows([{"SEVERITY": "critical", "FINDINGS": 3, "CVSS_SCORE": 9.5}, {"SEVERITY": "high", "FINDINGS": 1, "CVSS_SCORE": 7.5}])
+    assert data.table().schema.field("FINDINGS").type == pa.int8()
+    assert data.table().schema.field("CVSS_SCORE").type == pa.float32()
+    code = "import plotly.express as px\nassert str(df['FINDINGS'].dtype) == 'int64', df.dtypes\nassert str(df['CVSS_SCORE'].dtype) == 'float64', df.dtypes\nfig = px.bar(df, x='SEVERITY', y='FINDINGS')"
+    assert json.loads(engine.render(code, data.table()))["data"][0]["type"] == "bar"
+    assert list(map(str, data.to_pandas().dtypes))[1:] == ["int64", "float64"]
+
+
+def test_crafted_pickle_from_the_worker_is_not_loaded(engine):
+    # The chart code can reach the worker's end of the protocol
+    code = "import pickle, sys\nout = sys.modules['__main__'].protocol_out\nout.write(pickle.dumps(('ok', 'pwned')))\nout.flush()"
+    with pytest.raises(RuntimeError, match="stopped"):
+        engine.render(code, TABLE)
+
+
+def test_unknown_error_types_become_chart_code_errors():
+    assert isinstance(chart_error({"status": "error", "type": "ValueError", "message": "no"}), ValueError)
+    assert isinstance(chart_error({"status": "error", "type": "SystemExit", "message": "no"}), ChartCodeError)
+    assert isinstance(chart_error({"status": "error", "type": "PlotlyError", "message": "no"}), ChartCodeError)
@@ -0,0 +1,87 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from waii_sdk_py.chat import ChatResponse, ChatResponseStep
+
+from chat_jobs import CANCELLED, COMPLETED, QUEUED, ChatJobQueue
+
+
+class GatedChat:
+    # A Waii chat that answers only once released, so tests can act while a job is in flight
+    def __init__(self):
+        self.released = threading.Event()
+        self.submitted = []
+
+    def submit_chat_message(self, request):
+        self.submitted.append(request.ask)
+        return SimpleNamespace(uuid="job-{0}".format(len(self.submitted)))
+
+    def get_chat_response(self, request):
+        self.released.wait(5)
+        return ChatResponse(response="Patch the open criticals first.", current_step=ChatResponseStep.completed, chat_uuid="chat-1")
+
+
+def gated_client():
+    return SimpleNamespace(chat=GatedChat())
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def question(ask="Which vulnerabilities are open?"):
+    return SimpleNamespace(ask=ask)
+
+
+def test_same_question_in_flight_joins_the_running_job():
+    jobs, client, completed = ChatJobQueue(workers=2), gated_client(), []
+    first = jobs.submit("acme/analyst/chat-1", client, question(), on_complete=completed.append)
+    second = jobs.submit("acme/analyst/chat-1", client, question())
+    assert second is first and first.subscribers == 2
+
+    client.chat.released.set()
+    wait_until(lambda: first.done)
+    assert first.status == COMPLETED and first.parts["text"]
+    assert client.chat.submitted == ["Which vulnerabilities are open?"]
+    assert completed == [first]
+    assert (jobs.metrics()["submitted"], jobs.metrics()["coalesced"]) == (1, 1)
+
+
+def test_cancel_waits_for_the_last_subscriber():
+    jobs, client = ChatJobQueue(workers=2), gated_client()
+    job = jobs.submit("acme/analyst/chat-1", client, question())
+    jobs.submit("acme/analyst/chat-1", client, question())
+    wait_until(lambda: client.chat.submitted)
+
+    jobs.cancel(job)
+    assert not job.cancel_requested.is_set() and jobs.in_flight["acme/analyst/chat-1"] is job
+
+    jobs.cancel(job)
+    assert job.cancel_requested.is_set() and "acme/analyst/chat-1" not in jobs.in_flight
+    # Asked again after everyone left, the question starts a job of its own
+    assert jobs.submit("acme/analyst/chat-1", client, question()) is not job
+
+    client.chat.released.set()
+    wait_until(lambda: job.done)
+    assert job.status == CANCELLED
+
+
+def test_cancelled_queued_job_never_reaches_waii():
+    jobs, client = ChatJobQueue(workers=1), gated_client()
+    running = jobs.submit("acme/analyst/chat-1", client, question())
+    queued = jobs.submit("acme/analyst/chat-2", client, question("What is my risk as a CISO?"))
+    wait_until(lambda: client.chat.submitted)
+    assert queued.status == QUEUED and jobs.position(queued) == 0
+
+    jobs.cancel(queued)
+    assert queued.status == CANCELLED and not jobs.queued
+
+    client.chat.released.set()
+    wait_until(lambda: running.done)
+    jobs.executor.shutdown(wait=True)
+    assert client.chat.submitted == ["Which vulnerabilities are open?"]
+    assert jobs.metrics()["cancelled"] == 1
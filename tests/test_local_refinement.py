@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import duckdb
+import pyarrow as pa
+
+from local_refinement import PARENT_TABLE, LocalRefiner, refinement_sql
+from result_store import ResultTable
+
+PARENT_SQL = "SELECT CVE_ID, SEVERITY, CVSS_SCORE FROM VULNERABILITIES WHERE STATUS = 'open'"
+COLUMNS = ["CVE_ID", "SEVERITY", "CVSS_SCORE"]
+
+
+def parent_table():
+    return pa.table({
+        "CVE_ID": ["CVE-2024-00001", "CVE-2024-00002", "CVE-2024-00003"],
+        "SEVERITY": ["critical", "high", "critical"],
+        "CVSS_SCORE": [9.8, 7.5, 9.1],
+    })
+
+
+def generating(query):
+    def generate(request):
+        if isinstance(query, Exception):
+            raise query
+        return SimpleNamespace(query=query, uuid="generated-query")
+
+    return SimpleNamespace(query=SimpleNamespace(generate=generate))
+
+
+def test_narrowing_query_runs_over_the_parent_rows():
+    connection = duckdb.connect()
+    sql = refinement_sql(connection, PARENT_SQL, COLUMNS, PARENT_SQL + " AND SEVERITY = 'critical' ORDER BY CVSS_SCORE DESC")
+    assert PARENT_TABLE in sql and "STATUS" not in sql
+    connection.register(PARENT_TABLE, parent_table())
+    assert connection.execute(sql).fetchall() == [("CVE-2024-00001", "critical", 9.8), ("CVE-2024-00003", "critical", 9.1)]
+
+
+def test_broader_query_is_not_a_refinement():
+    connection = duckdb.connect()
+    assert refinement_sql(connection, PARENT_SQL, COLUMNS, "SELECT CVE_ID, SEVERITY, CVSS_SCORE FROM VULNERABILITIES") is None
+
+
+def test_aliased_expression_over_a_column_the_parent_dropped_is_not_a_refinement():
+    connection = duckdb.connect()
+    parent_sql = "SELECT CVE_ID, CVSS_SCORE * 10 AS RISK FROM VULNERABILITIES"
+    sql = "SELECT CVE_ID, CVSS_SCORE * 10 AS RISK FROM VULNERABILITIES WHERE CVSS_SCORE > 9"
+    assert refinement_sql(connection, parent_sql, ["CVE_ID", "RISK"], sql) is None
+
+
+def test_refine_answers_a_refinement_locally():
+    refiner = LocalRefiner()
+    parent = {"sql": PARENT_SQL, "query_uuid": "parent-query", "data": ResultTable(parent_table())}
+    parts = refiner.refine(generating(PARENT_SQL + " AND SEVERITY = 'high'"), "Only the high ones", parent)
+    assert parts["refined_locally"] and parts["query_uuid"] == "generated-query"
+    assert parts["data"].table().column("CVE_ID").to_pylist() == ["CVE-2024-00002"]
+
+
+def test_refine_falls_back_to_chat():
+    refiner = LocalRefiner()
+    parent = {"sql": PARENT_SQL, "query_uuid": "parent-query", "data": ResultTable(parent_table())}
+    assert refiner.refine(generating("SELECT ASSET, COUNT(*) FROM ASSET_FINDINGS GROUP BY ASSET"), "How do I fix that one?", parent) is None
+    assert refiner.refine(generating(RuntimeError("Waii is down")), "Only the critical ones", parent) is None
+    truncated = LocalRefiner(row_limit=3)
+    assert truncated.refine(generating(PARENT_SQL + " AND SEVERITY = 'high'"), "Only the high ones", parent) is None
+    assert refiner.metrics()["fallback_not_a_refinement"] == 1
+    assert refiner.metrics()["fallback_generate_error"] == 1
+    assert truncated.metrics()["fallback_parent_truncated"] == 1
@@ -0,0 +1,23 @@
+import os
+
+import pyarrow as pa
+
+from result_exports import ResultExports
+from result_store import ResultTable
+
+
+def test_export_evicted_before_read_is_exported_again(tmp_path):
+    exports = ResultExports(directory=str(tmp_path))
+    result = ResultTable(pa.table({"CVE_ID": ["CVE-2024-00001", "CVE-2024-00002"], "CVSS_SCORE": [9.8, 7.5]}))
+    os.remove(exports.export(result, "csv"))
+    with exports.open_file(result, "csv") as file:
+        assert file.read().startswith(b'"CVE_ID","CVSS_SCORE"')
+
+
+def test_open_export_stays_readable_when_evicted(tmp_path):
+    exports = ResultExports(directory=str(tmp_path), max_bytes=0)
+    result = ResultTable(pa.table({"SEVERITY": ["critical", "high"]}))
+    with exports.open_file(result, "csv") as file:
+        exports.export(ResultTable(pa.table({"SEVERITY": ["low"]})), "csv")
+        assert not os.path.exists(exports.path(result.digest, "csv"))
+        assert b"critical" in file.read()
@@ -0,0 +1,34 @@
+import os
+
+import plotly.graph_objects as go
+import pyarrow as pa
+
+from result_store import ResultTable
+from result_views import CHART_MAX_POINTS, CHART_TOP_N, OTHER_LABEL, cached_chart_figure, reduce_figure
+
+
+def test_small_categorical_chart_is_unchanged():
+    categories = ["Asset {0}".format(index) for index in range(CHART_TOP_N * 2)]
+    values = list(range(len(categories)))
+    fig = go.Figure([go.Bar(x=categories, y=values), go.Pie(labels=categories, values=values)])
+    before = fig.to_json()
+    assert reduce_figure(fig).to_json() == before
+
+
+def test_large_categorical_chart_is_folded_into_other():
+    categories = ["Asset {0}".format(index) for index in range(CHART_MAX_POINTS + 1)]
+    fig = reduce_figure(go.Figure([go.Bar(x=categories, y=list(range(len(categories))))]))
+    assert len(fig.data[0].x) == CHART_TOP_N
+    assert fig.data[0].x[-1] == OTHER_LABEL
+
+
+def test_chart_without_rows_draws_nothing():
+    assert cached_chart_figure({"name": "Otto", "text": "<chart>", "chart": "fig = None"}, None) is None
+
+
+def test_chart_over_discarded_rows_draws_nothing(tmp_path):
+    data = ResultTable(pa.table({"SEVERITY": ["critical", "high"], "CVSS_SCORE": [9.8, 7.5]}))
+    data.spill(str(tmp_path))
+    os.remove(data.path)
+    render_cache = cached_chart_figure({"name": "Otto", "text": "<chart>", "chart": "fig = None", "data": data}, data)
+    assert render_cache["figure"] is None and render_cache["error"]
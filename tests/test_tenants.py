@@ -0,0 +1,56 @@
+from tenants import TenantDirectory, TenantIndex
+
+
+def tenant(name, role):
+    return {"NAME": name, "TENANT_ID": name.lower(), "ROLE": role}
+
+
+INDEX = TenantIndex(
+    {
+        "acme.com": tenant("Acme", "ACME_ROLE"),
+        "*.acme.com": tenant("Acme Subsidiaries", "ACME_SUBSIDIARY_ROLE"),
+        "*.eu.acme.com": tenant("Acme Europe", "ACME_EU_ROLE"),
+        "labs.eu.acme.com": tenant("Acme Labs", "ACME_LABS_ROLE"),
+        "Globex.COM.": tenant("Globex", "GLOBEX_ROLE"),
+        "initech.com": {"NAME": "Initech"},
+    }
+)
+
+
+def test_exact_domain_matches_only_itself():
+    assert INDEX.lookup("globex.com").role == "GLOBEX_ROLE"
+    assert INDEX.lookup("mail.globex.com") is None
+    assert INDEX.lookup("com") is None
+
+
+def test_wildcard_matches_subdomains_but_not_the_domain_itself():
+    assert INDEX.lookup("acme.com").role == "ACME_ROLE"
+    assert INDEX.lookup("mail.acme.com").role == "ACME_SUBSIDIARY_ROLE"
+    assert INDEX.lookup("a.b.acme.com").role == "ACME_SUBSIDIARY_ROLE"
+    assert TenantIndex({"*.acme.com": tenant("Acme", "ACME_ROLE")}).lookup("acme.com") is None
+
+
+def test_most_specific_entry_wins():
+    assert INDEX.lookup("eu.acme.com").role == "ACME_SUBSIDIARY_ROLE"
+    assert INDEX.lookup("paris.eu.acme.com").role == "ACME_EU_ROLE"
+    assert INDEX.lookup("labs.eu.acme.com").role == "ACME_LABS_ROLE"
+    assert INDEX.lookup("x.labs.eu.acme.com").role == "ACME_EU_ROLE"
+
+
+def test_resolve_takes_the_domain_after_the_last_at():
+    assert INDEX.resolve("Analyst@Mail.ACME.com").role == "ACME_SUBSIDIARY_ROLE"
+    assert INDEX.resolve('"odd@name"@globex.com').role == "GLOBEX_ROLE"
+    assert INDEX.resolve("acme.com") is None
+    assert INDEX.resolve("analyst@unknown.org") is None
+
+
+def test_incomplete_tenants_are_skipped():
+    assert INDEX.lookup("initech.com") is None
+    assert len(INDEX) == 5
+
+
+def test_broken_reload_keeps_the_last_good_index():
+    configs = [{"acme.com": tenant("Acme", "ACME_ROLE")}, None]
+    directory = TenantDirectory(load=lambda: configs.pop(0))
+    directory.reload()
+    assert directory.index.version == 1 and directory.index.lookup("acme.com").name == "Acme"
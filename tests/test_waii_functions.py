@@ -0,0 +1,9 @@
+from waii_functions import WaiiClientRegistry
+
+
+def test_idle_clients_are_evicted_with_their_creation_locks():
+    registry = WaiiClientRegistry(client_factory=lambda tenant_role: object(), idle_seconds=-1)
+    first = registry.get("ACME_ROLE")
+    assert registry.get("GLOBEX_ROLE") is not first
+    assert list(registry.clients) == ["GLOBEX_ROLE"]
+    assert list(registry.creation_locks) == ["GLOBEX_ROLE"]
@@ -1,41 +1,21 @@
+import json
+import os
 import re
+import time
 import streamlit as st
-import plotly.express as px
-from auth_functions import sign_in, create_account, sign_out, reset_password
-
-
-def render_auth_form():
-    auth_form = st.form("auth_form")
-    email = auth_form.text_input("Email")
-    password = auth_form.text_input("Password", type="password")
-    sign_in_button = auth_form.form_submit_button("Sign In", use_container_width=True)
-    sign_up_button = auth_form.form_submit_button("Sign Up", use_container_width=True)
-    password_reset_button = auth_form.form_submit_button("Forgot Password?", use_container_width=True)
-
-    if sign_in_button:
-        sign_in(email, password)
-
-    if sign_up_button:
-        create_account(email, password)
-
-    if password_reset_button:
-        reset_password(email)
-
-    if "auth_success" in st.session_state:
-        auth_form.success(st.session_state.auth_success)
-    if "auth_warning" in st.session_state:
-        auth_form.warning(st.session_state.auth_warning)
-
-
-def render_account_panel():
-    with st.sidebar.container(border=True, height=160):
-        if "user_info" in st.session_state:
-            st.markdown(
-                f"User: `{st.session_state.user_info['users'][0]['email']}`\n\nAccount: `{st.session_state.tenant_name}`"
-            )
-        if st.button("Sign Out", use_container_width=True):
-            sign_out()
-            st.rerun()
+from assets import asset_url, get_asset_registry
+from instrumentation import traced
+from result_exports import (
+    EXPORT_BACKGROUND_ROWS,
+    EXPORT_DOWNLOAD_MAX_BYTES,
+    EXPORT_FORMATS,
+    export_link,
+    get_result_exports,
+    start_export_server,
+)
+from result_store import ResultTable
+from result_views import PLOT_BGCOLOR, cached_chart_figure, render_table
+from waii_functions import SUGGESTED_QUESTIONS
 
 
 def split_and_insert(text, replacements):
@@ -55,163 +35,239 @@ def split_and_insert(text, replacements):
     return result
 
 
-def autoplot(df_, chart_type="bar"):
-    df = df_.copy().infer_objects()
-    if len(df.columns) == 0:
-        return None
-    elif len(df.columns) == 1:
-        df["x"] = df.columns[0]
-        df = df[["x", df.columns[0]]]
-    num_rows = df.shape[0]
-    if num_rows < 2:
-        return None
-    x_col = df.columns[0]
-    # Make y column first numeric column
-    y_col = None
-    for col in df.columns[1:]:
-        if df[col].dtype in ["int64", "float64"]:
-            y_col = col
-            break
-    if y_col is None:
-        return None
-    if chart_type == "bar":
-        fig = px.bar(df, x=x_col, y=y_col)
-    elif chart_type == "line":
-        fig = px.line(df, x=x_col, y=y_col)
-    elif chart_type == "pie":
-        fig = px.pie(df, values=y_col, names=x_col)
-    elif chart_type == "sunburst":
-        path = [x_col]
-        for i in range(1, len(df.columns)):
-            # Ensure column is not numeric
-            if df[df.columns[i]].dtype == "object":
-                path.append(df.columns[i])
-        fig = px.sunburst(df, path=path, values=y_col)
+def render_chart_style():
+    st.markdown(
+        f"""
+        <style>
+        .stPlotlyChart {{
+        outline: 10px solid {PLOT_BGCOLOR};
+        border-radius: 5px;
+        }}
+        </style>
+        """,
+        unsafe_allow_html=True,
+    )
+
+
+@traced("render.chart_block")
+def chart_block(figure_json):
+    render_chart_style()
+    st.plotly_chart(json.loads(figure_json), width="stretch")
+
+
+def render_chart(message, df):
+    if not ("chart" in message and message["chart"]):
+        return
+    render_cache = cached_chart_figure(message, df)
+    if render_cache is not None and render_cache["figure"]:
+        chart_block(render_cache["figure"])
+
+
+def render_data(data, lazy=False):
+    if not isinstance(data, ResultTable):
+        render_table(st.expander("Data", expanded=False) if lazy else st, data, key=id(data))
+    elif lazy or not data.in_memory:
+        # The table is only read (from disk, if it was spilled) and sent once the user opens it
+        data_expander = st.expander(f"Data ({len(data):,} rows)", expanded=False, key=f"data-{data.id}", on_change="rerun")
+        if data_expander.open:
+            render_table(data_expander, data, key=data.id)
     else:
-        raise ValueError("Invalid chart type")
-    return fig
-
-
-def add_background_and_corner_radius(code: str) -> str:
-    # Line to add the background color and corner radius
-    customization_line = "fig.update_layout(paper_bgcolor='#244466', " "plot_bgcolor='#244466')\n"
-
-    # Find the location to insert the customization line
-    split_lines = code.split("\n")
-    for i, line in enumerate(split_lines):
-        if "st.plotly_chart(fig" in line:
-            split_lines.insert(i, customization_line)
-            break
-
-    # Reassemble the modified code
-    return "\n".join(split_lines)
-
-
-def chart_block(df, waii_chart_spec=None):
-    if waii_chart_spec:
-        try:
-            PLOT_BGCOLOR = "#244466"
-
-            st.markdown(
-                f"""
-                <style>
-                .stPlotlyChart {{
-                outline: 10px solid {PLOT_BGCOLOR};
-                border-radius: 5px;
-                }}
-                </style>
-                """,
-                unsafe_allow_html=True,
+        render_table(st, data, key=data.id)
+
+
+def format_age(timestamp):
+    minutes = int((time.time() - timestamp) // 60)
+    if minutes < 1:
+        return "just now"
+    if minutes < 120:
+        return f"{minutes} min ago"
+    return f"{minutes // 60} h ago"
+
+
+def render_message_body(message, exports=True):
+    if message.get("cached_at"):
+        st.caption("Answer reused from " + format_age(message["cached_at"]))
+    if message.get("precomputed_at"):
+        st.caption("Precomputed answer, refreshed " + format_age(message["precomputed_at"]))
+    if message.get("refined_locally"):
+        st.caption("Refined from the previous answer's data")
+    if message.get("data_dropped"):
+        st.caption("The data for this answer was too large to keep; ask again to see it")
+    replacements = {}
+    df = None
+    includes_chart = False
+    if "sql" in message and message["sql"]:
+        replacements["<sql>"] = ("sql", message["sql"])
+    if "data" in message and message["data"] is not None:
+        df = message["data"]
+        replacements["<data>"] = ("data", df)
+    if "chart" in message and message["chart"]:
+        replacements["<chart>"] = ("chart", message["chart"])
+    blocks = split_and_insert(message["text"], replacements)
+    includes_data = False
+    for block in blocks:
+        if isinstance(block, str):
+            st.markdown(block)
+        else:
+            if block[0] == "sql":
+                st.code(block[1], language="sql")
+            elif block[0] == "data":
+                includes_data = True
+                render_data(block[1])
+            elif block[0] == "chart":
+                includes_chart = True
+                render_chart(message, df)
+    if not includes_chart and df is not None:
+        render_chart(message, df)
+    if "sql" in message and message["sql"] and ("sql", message["sql"]) not in blocks:
+        st.expander("SQL Query", expanded=False).code(message["sql"], language="sql")
+    if "data" in message and message["data"] is not None and not includes_data:
+        render_data(df, lazy=True)
+    if "chart" in message and message["chart"]:
+        st.expander("Waii Chart Specification", expanded=False).code(message["chart"], language="python")
+    if exports and isinstance(df, ResultTable):
+        render_export(df)
+
+
+EXPORT_POLL_SECONDS = 1
+
+
+def read_export(data, export_format):
+    with get_result_exports().open_file(data, export_format) as file:
+        return file.read()
+
+
+def forget_exports(data):
+    # Export jobs of a result that left the conversation; its files stay in the shared cache
+    jobs = st.session_state.get("exports", {})
+    for export_format in EXPORT_FORMATS:
+        jobs.pop((data.id, export_format), None)
+
+
+def export_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def start_export(data, export_format):
+    st.session_state.exports[(data.id, export_format)] = get_result_exports().submit(data, export_format)
+
+
+@st.fragment(run_every=EXPORT_POLL_SECONDS)
+def render_pending_export(job):
+    if job.done():
+        st.rerun()
+    st.caption("Preparing…")
+
+
+def render_export(data):
+    # Downloads of the whole result, never built on a rerun. Small results are exported when the
+    # button is clicked, on Streamlit's download thread; larger ones by a background job the user
+    # starts, and once it is done they are streamed by the export server when there is one. A job
+    # is dropped once its file is in the export cache
+    exports = get_result_exports()
+    server = start_export_server()
+    jobs = st.session_state.setdefault("exports", {})
+    for column, export_format in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS):
+        label = export_format.upper()
+        file_name = f"otto-result.{export_format}"
+        path = exports.cached(data, export_format)
+        job = jobs.get((data.id, export_format))
+        if job is not None and job.done() and job.exception() is None:
+            path = path or job.result()
+            del jobs[(data.id, export_format)]
+            job = None
+        if path is not None and server is not None:
+            column.link_button(label, export_link(path, file_name), icon=":material/download:")
+        elif path is not None and (export_size(path) or 0) > EXPORT_DOWNLOAD_MAX_BYTES:
+            column.caption(f"{label}: too large to download here")
+        elif path is not None or len(data) <= EXPORT_BACKGROUND_ROWS:
+            column.download_button(
+                label,
+                lambda export_format=export_format: read_export(data, export_format),
+                file_name=file_name,
+                mime=EXPORT_FORMATS[export_format],
+                key=f"export-{data.id}-{export_format}",
+                on_click="ignore",
+                icon=":material/download:",
             )
-            modified_chart_spec = add_background_and_corner_radius(waii_chart_spec)
-            exec(modified_chart_spec, {"df": df})
-        except Exception as e:
-            print("Error rendering chart. This was the code:\n\n", modified_chart_spec, "\n\nThis was the error:", e)
-            # st.write(e)
+        elif job is not None and not job.done():
+            with column:
+                render_pending_export(job)
+        else:
+            column.button(f"Prepare {label}", key=f"prepare-{data.id}-{export_format}", on_click=start_export, args=(data, export_format))
+            if job is not None:
+                column.caption("Export failed; try again")
 
 
+@traced("render.message")
 def render_message(message, persist=False):
     if persist:
         st.session_state.messages.append(message)
-    with st.chat_message(message["name"], avatar="bot_avatar.svg" if message["name"] == "Otto" else None):
-        replacements = {}
-        df = None
-        includes_chart = False
-        if "sql" in message and message["sql"]:
-            replacements["<sql>"] = ("sql", message["sql"])
-        if "data" in message and message["data"] is not None:
-            df = message["data"]
-            replacements["<data>"] = ("data", df)
-        if "chart" in message and message["chart"]:
-            replacements["<chart>"] = ("chart", message["chart"])
-        blocks = split_and_insert(message["text"], replacements)
-        for block in blocks:
-            if isinstance(block, str):
-                st.markdown(block)
-            else:
-                if block[0] == "sql":
-                    st.code(block[1], language="sql")
-                elif block[0] == "data":
-                    st.dataframe(block[1], use_container_width=True)
-                elif block[0] == "chart":
-                    includes_chart = True
-                    chart_block(df, waii_chart_spec=(message["chart"] if "chart" in message else None))
-        if not includes_chart and df is not None:
-            chart_block(df, waii_chart_spec=(message["chart"] if "chart" in message else None))
-        if "sql" in message and message["sql"] and ("sql", message["sql"]) not in blocks:
-            st.expander("SQL Query", expanded=False).code(message["sql"], language="sql")
-        if "data" in message and message["data"] is not None:
-            st.expander("Data", expanded=False).dataframe(df, use_container_width=True)
-        if "chart" in message and message["chart"]:
-            st.expander("Waii Chart Specification", expanded=False).code(message["chart"], language="python")
+    with st.chat_message(message["name"], avatar=asset_url("bot_avatar.svg") if message["name"] == "Otto" else None):
+        render_message_body(message)
+
+
+def partial_message(message, parts):
+    # The answer so far, updated in place on every poll so its rows are wrapped once and its chart
+    # drawn once; rows and chart fill the same <data> and <chart> slots as in the finished answer
+    if parts.get("data") is not None and message.get("data") is None:
+        message["data"] = ResultTable(parts["data"].table())
+    if parts.get("chart"):
+        message["chart"] = parts["chart"]
+    message["text"] = "\n\n".join(slot for slot, part in (("<data>", "data"), ("<chart>", "chart")) if message.get(part) is not None)
+    return message
+
+
+def render_chat_job(job, message, queue_position=0):
+    # Progress of a question being answered in the background: Waii's current step and SQL, then the
+    # rows and the chart as each arrives. message holds the answer so far between polls. Returns
+    # True when the user cancels it
+    with st.chat_message("Otto", avatar=asset_url("bot_avatar.svg")):
+        if job.status == "queued":
+            label = "Waiting for a free slot" + (f" ({queue_position} ahead)" if queue_position else "")
+        else:
+            label = job.step or "Routing Request"
+        status = st.status(label, expanded=bool(job.parts.get("sql")))
+        if job.parts.get("sql"):
+            status.code(job.parts["sql"], language="sql")
+        partial = partial_message(message, job.parts)
+        if partial["text"]:
+            render_message_body(partial, exports=False)
+        return st.button("Cancel", key=f"cancel-{id(job)}")
 
 
 def render_placeholder_image(opacity=0.4, enforce_aspect_ratio=True):
-    with open("bot.svg", "rb") as f:
-        bot_svg = f.read()
-
-    # Edit bot_svg to add style
-    bot_svg = bot_svg.replace(b"<svg", b'<svg style="width: 70%; height: auto; object-fit: contain;"')
+    bot_svg = get_asset_registry().text("bot-placeholder.svg")
     st.write(
         f"""
                 <div style="width: 100%; {'aspect-ratio: 1 / 1;' if enforce_aspect_ratio else ''} display: flex; justify-content: center; align-items: center; position: relative; overflow: hidden; opacity: {opacity};">
-                    {bot_svg.decode()}
+                    {bot_svg}
                 </div>
                 """,
         unsafe_allow_html=True,
     )
 
 
-import base64
-from pathlib import Path
-
-
-def img_to_bytes(img_path):
-    img_bytes = Path(img_path).read_bytes()
-    encoded = base64.b64encode(img_bytes).decode()
-    return encoded
-
-
-def img_to_html(img_path):
-    img_html = "<img src='data:image/png;base64,{}' class='img-fluid'>".format(img_to_bytes(img_path))
-    return img_html
+def suggest_question(question):
+    st.session_state.pending_prompt = question
 
 
-def render_sidebar_tips():
-    with open("bot-small.svg", "rb") as f:
-        bot_svg = f.read()
+def render_sidebar_tips(disabled=False):
     st.sidebar.info(
         f"""
 
-![bot](data:image/svg+xml;base64,{base64.b64encode(bot_svg).decode()})
+![bot]({asset_url("bot-small.svg")})
 
 ## Hi, I'm OTTO!
         
 I'm your trusty cybersecurity assistant, here to help you navigate your infrastructure, answer your questions, and provide actionable insights to keep your organization secure.
 
 ## Things you can ask me:
-- Which vulnerabilities should I be most concerned about?
-- How can I improve my security posture?
-- What is my risk as a CISO?\n
         """
     )
+    # Asked like a typed question; their answers are usually precomputed and shown straight away
+    for index, question in enumerate(SUGGESTED_QUESTIONS):
+        st.sidebar.button(question, key=f"suggested-{index}", on_click=suggest_question, args=(question,), disabled=disabled)
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import deque
+
+import streamlit as st
+from waii_sdk_py import Waii
+from waii_sdk_py.chat import ChatResponseStep
+from waii_sdk_py.common import GetObjectRequest
+
+from instrumentation import get_metrics_registry, span, traced
+from result_store import ResultTable
+
+## -------------------------------------------------------------------------------------------------
+## Waii clients ------------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+ENV = st.secrets["ENV"]
+WAII_API_KEY = st.secrets[ENV]["WAII_API_KEY"]
+WAII_API_URL = st.secrets[ENV]["WAII_API_URL"]
+SNOWFLAKE_WAREHOUSE = st.secrets[ENV]["SNOWFLAKE_WAREHOUSE"]
+SNOWFLAKE_DATABASE = st.secrets[ENV]["SNOWFLAKE_DATABASE"]
+SNOWFLAKE_ACCOUNT = st.secrets[ENV]["SNOWFLAKE_ACCOUNT"]
+SNOWFLAKE_USER = st.secrets[ENV]["SNOWFLAKE_USER"]
+WAII_CLIENT_IDLE_SECONDS = 1800
+SUGGESTED_QUESTIONS = [
+    "Which vulnerabilities should I be most concerned about?",
+    "How can I improve my security posture?",
+    "What is my risk as a CISO?",
+]
+
+
+def waii_connection_key(tenant_role):
+    return f"snowflake://{SNOWFLAKE_USER}@{SNOWFLAKE_ACCOUNT}/{SNOWFLAKE_DATABASE}?role={tenant_role}&warehouse={SNOWFLAKE_WAREHOUSE}"
+
+
+@traced("waii.create_client")
+def create_waii_client(tenant_role, url=WAII_API_URL, api_key=WAII_API_KEY):
+    # Each tenant gets its own client (and so its own scope) instead of sharing the global WAII,
+    # so activating one tenant's role can never change the connection another session queries
+    client = Waii()
+    client.initialize(url=url, api_key=api_key)
+    client.database.activate_connection(waii_connection_key(tenant_role))
+    return client
+
+
+class WaiiClientRegistry:
+    def __init__(self, client_factory=create_waii_client, idle_seconds=WAII_CLIENT_IDLE_SECONDS):
+        self.client_factory = client_factory
+        self.idle_seconds = idle_seconds
+        self.clients = {}
+        self.creation_locks = {}
+        self.lock = threading.Lock()
+        self.clients_created = 0
+
+    def get(self, tenant_role):
+        with self.lock:
+            self._evict_idle()
+            entry = self.clients.get(tenant_role)
+            if entry is not None:
+                entry[1] = time.time()
+                return entry[0]
+            creation_lock = self.creation_locks.setdefault(tenant_role, threading.Lock())
+
+        # Only one session per tenant pays for initialize/activate; the others wait and reuse it
+        with creation_lock:
+            with self.lock:
+                entry = self.clients.get(tenant_role)
+            if entry is None:
+                client = self.client_factory(tenant_role)
+                entry = [client, time.time()]
+                with self.lock:
+                    self.clients[tenant_role] = entry
+                    self.clients_created += 1
+            return entry[0]
+
+    def _evict_idle(self):
+        now = time.time()
+        for tenant_role in [role for role, (_, last_used) in self.clients.items() if now - last_used > self.idle_seconds]:
+            del self.clients[tenant_role]
+            self.creation_locks.pop(tenant_role, None)
+
+
+@st.cache_resource
+def get_waii_client_registry():
+    return WaiiClientRegistry()
+
+
+def get_waii_client(tenant_role):
+    return get_waii_client_registry().get(tenant_role)
+
+
+## -------------------------------------------------------------------------------------------------
+## Chat responses ----------------------------------------------------------------------------------
+## -------------------------------------------------------------------------------------------------
+
+CHAT_POLL_INTERVAL_SECONDS = 0.25
+CHAT_TIMEOUT_SECONDS = 300
+
+
+def stream_chat_response(client, request, poll_interval=CHAT_POLL_INTERVAL_SECONDS, timeout=CHAT_TIMEOUT_SECONDS):
+    # Submit the question as a job and yield each polled snapshot, so the UI can show the SQL,
+    # rows and chart as Waii produces them instead of waiting for the whole answer
+    with span("waii.submit_chat_message"):
+        job = client.chat.submit_chat_message(request)
+    deadline = time.time() + timeout
+    while True:
+        with span("waii.get_chat_response"):
+            response = client.chat.get_chat_response(GetObjectRequest(uuid=job.uuid))
+        yield response
+        if response.current_step == ChatResponseStep.completed:
+            return
+        if time.time() >= deadline:
+            raise TimeoutError("Waii did not answer within {0} seconds".format(timeout))
+        time.sleep(poll_interval)
+
+
+def chat_response_parts(response, skip=()):
+    # Whatever parts of the answer have arrived so far, in the shape of a chat message;
+    # parts listed in skip were already taken from an earlier snapshot and are not rebuilt
+    response_data = response.response_data
+    parts = {}
+    if response.response and "text" not in skip:
+        parts["text"] = response.response
+    if response_data and response_data.query and response_data.query.query and "sql" not in skip:
+        parts["sql"] = response_data.query.query
+        if response_data.query.uuid:
+            parts["query_uuid"] = response_data.query.uuid
+    if response_data and response_data.data and response_data.data.rows is not None and "data" not in skip:
+        column_names = [column.name for column in response_data.data.column_definitions or []]
+        with span("result.from_rows", rows=len(response_data.data.rows)):
+            parts["data"] = ResultTable.from_rows(response_data.data.rows, column_names)
+    if response_data and response_data.chart and response_data.chart.chart_spec and "chart" not in skip:
+        parts["chart"] = response_data.chart.chart_spec.plot
+    return parts
+
+
+class ChatLatencyStats:
+    def __init__(self, window=500):
+        self.time_to_first_token = deque(maxlen=window)
+        self.time_to_complete = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, time_to_first_token, time_to_complete):
+        with self.lock:
+            self.time_to_first_token.append(time_to_first_token)
+            self.time_to_complete.append(time_to_complete)
+
+    def summary(self):
+        with self.lock:
+            return {
+                "count": len(self.time_to_complete),
+                "time_to_first_token_p50": percentile(self.time_to_first_token, 50),
+                "time_to_first_token_p95": percentile(self.time_to_first_token, 95),
+                "time_to_complete_p50": percentile(self.time_to_complete, 50),
+                "time_to_complete_p95": percentile(self.time_to_complete, 95),
+            }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+@st.cache_resource
+def get_chat_latency_stats():
+    stats = ChatLatencyStats()
+    get_metrics_registry().register_collector("chat_latency", stats.summary)
+    return stats